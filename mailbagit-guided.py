@@ -1,3 +1,7 @@
+import multiprocessing
 from mailbagit import guided
 
-guided()
+if __name__ == "__main__":
+    # needed for worker processes in pyinstaller executables
+    multiprocessing.freeze_support()
+    guided()
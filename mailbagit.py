@@ -1,3 +1,7 @@
+import multiprocessing
 from mailbagit import cli
 
-cli()
+if __name__ == "__main__":
+    # needed for worker processes in pyinstaller executables
+    multiprocessing.freeze_support()
+    cli()
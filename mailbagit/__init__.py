@@ -183,12 +183,65 @@ mailbagit_options.add_argument("--css", help="Path to a CSS file to customize PD
 mailbagit_options.add_argument(
     "-c", "--compress", help="Compress the mailbag as ZIP, TAR, or TAR.GZ.", nargs=None, choices=["tar", "zip", "tar.gz"]
 )
+mailbagit_options.add_argument(
+    "--html-parser",
+    help="Parser used to format HTML for derivatives. lxml is much faster for large messages, but must be installed separately.",
+    default="html.parser",
+    choices=["html.parser", "lxml"],
+    nargs=None,
+)
+mailbagit_options.add_argument(
+    "--link-images",
+    help="Links inline images in HTML and PDF derivatives to the files in the attachments directory instead of embedding them.",
+    default=False,
+    action="store_true",
+)
+mailbagit_options.add_argument(
+    "--compact-html",
+    help="Writes HTML for HTML and PDF derivatives without re-indenting it, which is faster and makes smaller files.",
+    default=False,
+    action="store_true",
+)
+mailbagit_options.add_argument(
+    "--pdf-workers",
+    help="Number of PDF derivatives to render at the same time. pdf-chrome keeps a browser running for each.",
+    default=1,
+    type=int,
+    nargs=None,
+)
+mailbagit_options.add_argument(
+    "--pdf-timeout",
+    help="Seconds to wait for a PDF derivative to render before giving up on it.",
+    default=120,
+    type=int,
+    nargs=None,
+)
+mailbagit_options.add_argument(
+    "--mbox-max-size",
+    help="Largest size in MB for MBOX derivative files. Larger folders are split into numbered files, like Inbox.0001.mbox.",
+    default=None,
+    type=int,
+    nargs=None,
+)
 mailbagit_options.add_argument(
     "-r", "--dry-run", help="A dry run performs a trial run with no changes made.", default=False, action="store_true"
 )
 mailbagit_options.add_argument(
     "-k", "--keep", help="Leaves source email as-is and makes a copy into a mailbag.", default=False, action="store_true"
 )
+mailbagit_options.add_argument(
+    "--keep-strategy",
+    help="How to copy source email with --keep. auto tries reflink, then copy. hardlink shares files with the source, so changing them also changes the mailbag.",
+    default="auto",
+    choices=["auto", "reflink", "hardlink", "copy"],
+    nargs=None,
+)
+mailbagit_options.add_argument(
+    "--dedup-attachments",
+    help="Writes attachments with identical content once and hardlinks any duplicates to it.",
+    default=False,
+    action="store_true",
+)
 mailbagit_options.add_argument(
     "-l", "--external-links", help="Crawl and add external <a> links to WARC derivatives", default=False, action="store_true"
 )
@@ -299,6 +352,14 @@ def main(args):
         error_msg = "processes must be valid integer > 0"
         mailbag_parser.error((error_msg))
 
+    if args.pdf_workers < 1 or args.pdf_timeout < 1:
+        error_msg = "pdf-workers and pdf-timeout must be valid integers > 0"
+        mailbag_parser.error((error_msg))
+
+    if args.mbox_max_size is not None and args.mbox_max_size < 1:
+        error_msg = "mbox-max-size must be valid integer > 0"
+        mailbag_parser.error((error_msg))
+
     # Raise and error and exit when given multiple inputs
     if len(args.path) > 1:
         error_msg = (
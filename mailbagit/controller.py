@@ -91,6 +91,49 @@ class Controller:
         # HT https://stackoverflow.com/questions/1094841/get-human-readable-version-of-file-size
         return str(size) + units[0] if size < 1024 else self.human_size(size >> 10, units[1:])
 
+    def write_error_reports(self, message, error_dir, warn_dir, error_csv, warn_csv):
+        """
+        Writes the stack traces of any errors and warnings for a message,
+        and adds the message to the error and warning CSV reports
+
+        Parameters:
+            message (Email): Email model object
+            error_dir (Path): Directory for error reports
+            warn_dir (Path): Directory for warning reports
+            error_csv (List): Lines for error.csv
+            warn_csv (List): Lines for warnings.csv
+        """
+        if len(message.Errors) > 0:
+            error_stack_trace = []
+            warn_stack_trace = []
+            for error in message.Errors:
+                if error.Level.lower() == "warn":
+                    warn_stack_trace.append(error.StackTrace)
+                else:
+                    error_stack_trace.append(error.StackTrace)
+
+            # Write Error Report
+            if len(error_stack_trace) > 0:
+                if not os.path.isdir(error_dir):
+                    # making error directory if error is present
+                    os.mkdir(error_dir)
+                error_csv.append(self.message_to_csv(message, "error"))
+                error_trace_file = os.path.join(error_dir, str(message.Mailbag_Message_ID) + ".txt")
+                with open(error_trace_file, "w", encoding="utf-8") as f:
+                    f.write("\n".join(error_stack_trace))
+                    f.close()
+
+            # Write Warning Report
+            if len(warn_stack_trace) > 0:
+                if not os.path.isdir(warn_dir):
+                    # making warn directory if error is present
+                    os.mkdir(warn_dir)
+                warn_csv.append(self.message_to_csv(message, "warn"))
+                warn_trace_file = os.path.join(warn_dir, str(message.Mailbag_Message_ID) + ".txt")
+                with open(warn_trace_file, "w", encoding="utf-8") as f:
+                    f.write("\n".join(warn_stack_trace))
+                    f.close()
+
     def generate_mailbag(self):
 
         # Create folder mailbag folder before writing mailbag.csv
@@ -105,6 +148,11 @@ class Controller:
             mailbag_dir = os.path.join(source_parent_dir, self.args.mailbag)
         mailbag_name = os.path.basename(self.args.mailbag)
         attachments_dir = os.path.join(str(mailbag_dir), "data", "attachments")
+        # Digests of attachments already written, so duplicates are hardlinked instead
+        if getattr(self.args, "dedup_attachments", False):
+            attachment_index = {}
+        else:
+            attachment_index = None
         error_dir = os.path.join(os.path.dirname(mailbag_dir), str(mailbag_name) + "_errors")
         warn_dir = os.path.join(os.path.dirname(mailbag_dir), str(mailbag_name) + "_warnings")
 
@@ -143,11 +191,6 @@ class Controller:
                 if len(d.derivative_agent_version) > 0:
                     bag.info[d.derivative_format.upper() + "-Agent-Version"] = d.derivative_agent_version
 
-        # do stuff you ought to do with per-account info here
-        # mail_account.account_data()
-        # for d in derivatives:
-        #    d.do_task_per_account()
-
         # Setting up mailbag.csv
         csv_data = []
         mailbag_message_id = 0
@@ -155,6 +198,8 @@ class Controller:
         csv_portion = [self.csv_headers]
         error_csv = [self.csv_headers]
         warn_csv = [self.csv_headers]
+        # Messages waiting for derivatives to finish before their errors are reported
+        unreported = {}
 
         # Count total no. of messages and set start time
         total_messages = mail_account.number_of_messages
@@ -171,7 +216,7 @@ class Controller:
             if len(message.Attachments) > 0:
                 if not os.path.isdir(attachments_dir) and not self.args.dry_run:
                     os.mkdir(attachments_dir)
-                controller.writeAttachmentsToDisk(self.args.dry_run, attachments_dir, message)
+                controller.writeAttachmentsToDisk(self.args.dry_run, attachments_dir, message, attachment_index)
 
             # Setting up CSV data
             # checking if the count of messages exceed 100000 and creating a new portion if it exceeds
@@ -189,37 +234,15 @@ class Controller:
             for d in derivatives:
                 message = d.do_task_per_message(message)
 
-            # Error and Warning Reports
-            if len(message.Errors) > 0:
-                error_stack_trace = []
-                warn_stack_trace = []
-                for error in message.Errors:
-                    if error.Level.lower() == "warn":
-                        warn_stack_trace.append(error.StackTrace)
-                    else:
-                        error_stack_trace.append(error.StackTrace)
-
-                # Write Error Report
-                if len(error_stack_trace) > 0:
-                    if not os.path.isdir(error_dir):
-                        # making error directory if error is present
-                        os.mkdir(error_dir)
-                    error_csv.append(self.message_to_csv(message, "error"))
-                    error_trace_file = os.path.join(error_dir, str(message.Mailbag_Message_ID) + ".txt")
-                    with open(error_trace_file, "w", encoding="utf-8") as f:
-                        f.write("\n".join(error_stack_trace))
-                        f.close()
+            # Remove any attachments spooled to temporary files
+            for attachment in message.Attachments:
+                attachment.cleanup()
 
-                # Write Warning Report
-                if len(warn_stack_trace) > 0:
-                    if not os.path.isdir(warn_dir):
-                        # making warn directory if error is present
-                        os.mkdir(warn_dir)
-                    warn_csv.append(self.message_to_csv(message, "warn"))
-                    warn_trace_file = os.path.join(warn_dir, str(message.Mailbag_Message_ID) + ".txt")
-                    with open(warn_trace_file, "w", encoding="utf-8") as f:
-                        f.write("\n".join(warn_stack_trace))
-                        f.close()
+            # Write error reports, unless a derivative is still processing the message in the background
+            unreported[message.Mailbag_Message_ID] = message
+            pending = set().union(*(d.pending_messages() for d in derivatives))
+            for message_id in [message_id for message_id in unreported if not message_id in pending]:
+                self.write_error_reports(unreported.pop(message_id), error_dir, warn_dir, error_csv, warn_csv)
 
             # Show progress
             # If progress%(total_messages/100)==0 then show progress
@@ -232,6 +255,22 @@ class Controller:
                     mailbag_message_id, total_messages, start_time, prefix="Progress ", suffix="Complete", print_End=print_End
                 )
 
+        # Finish any derivatives still processing messages in the background and report their errors
+        for d in derivatives:
+            try:
+                d.do_task_per_account()
+            except Exception as e:
+                desc = "Error finishing " + d.derivative_name + " derivatives"
+                account_errors = common.handle_error([], e, desc)
+                if not os.path.isdir(error_dir):
+                    # making error directory if error is present
+                    os.mkdir(error_dir)
+                error_trace_file = os.path.join(error_dir, d.derivative_name + ".txt")
+                with open(error_trace_file, "w", encoding="utf-8") as f:
+                    f.write("\n".join(error.StackTrace for error in account_errors))
+        for message in unreported.values():
+            self.write_error_reports(message, error_dir, warn_dir, error_csv, warn_csv)
+
         # Write any empty email folders to derivatives subdirectories
         if "empty_folder_paths" in mail_account.account_data:
             if not os.path.isdir(warn_dir):
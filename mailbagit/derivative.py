@@ -20,6 +20,10 @@ class Derivative(ABC):
     # Registry of derivatives, key = cls.derivative_name, value = cls
     registry = {}
 
+    # Whether the derivative uses message.HTML_Body. Formats may skip expensive work,
+    # like de-encapsulating HTML from RTF bodies, when no requested derivative needs it.
+    requires_html_body = True
+
     def __init_subclass__(cls, **kwargs):
         """Enforce derivative descriptive attributes on subclasses, register them"""
         derivative_attrs = ["derivative_name", "derivative_format", "derivative_agent", "derivative_agent_version"]
@@ -37,13 +41,21 @@ class Derivative(ABC):
         If not taking any other steps, the implementation of this can simple be `super()`
         """
         self.args = args
+        # Options for formatting HTML, defaulting like the CLI when they aren't in args, e.g. for API callers
+        self.html_parser = getattr(args, "html_parser", "html.parser")
+        self.link_images = getattr(args, "link_images", False)
+        self.compact_html = getattr(args, "compact_html", False)
         self.format_subdirectory = join(mailbag_dir, "data", self.derivative_format)
         if not args.dry_run:
             makedirs(self.format_subdirectory)
 
     @abstractmethod
     def do_task_per_account(self):
-        """Perform any tasks that should happen once per whole account."""
+        """Perform any tasks that should happen once per whole account, after all messages are processed.
+        Derivatives that process messages in the background must finish them here.
+
+        This is called by the controller once all messages are processed. Any exception raised here
+        is reported as an error for the derivative instead of stopping the mailbag from being written."""
         pass
 
     @abstractmethod
@@ -51,6 +63,11 @@ class Derivative(ABC):
         """Perform any tasks that should happen once per message"""
         pass
 
+    def pending_messages(self):
+        """Mailbag_Message_IDs of messages this derivative is still processing in the background.
+        Errors are only reported for a message once no derivative is still processing it."""
+        return set()
+
 
 def import_derivatives(dirs=None):
     if not dirs:
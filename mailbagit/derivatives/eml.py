@@ -31,7 +31,7 @@ class EmlDerivative(Derivative):
         super().__init__(args, mailbag_dir)
 
     def do_task_per_account(self):
-        print(self.account.account_data())
+        pass
 
     def do_task_per_message(self, message):
 
@@ -110,15 +110,12 @@ class EmlDerivative(Derivative):
                             desc = "Error writing body for EML derivative"
                             errors = common.handle_error(errors, e, desc)
 
-                        # Get list of <img> files that might reference attachments
-                        if message.HTML_Body:
-                            inline_files = derivative.inlineAttachments(message.HTML_Body, message.HTML_Encoding)
-                        else:
-                            inline_files = {}
+                        # Get the attachments referenced by <img> tags
+                        inline_cids = derivative.inlineContentIDs(message, self.html_parser)
 
                         # Attachments
                         try:
-                            for attachment in message.Attachments:
+                            for i, attachment in enumerate(message.Attachments):
                                 mimeType = attachment.MimeType
                                 if mimeType is None:
                                     mimeType = "application/octet-stream"
@@ -126,17 +123,19 @@ class EmlDerivative(Derivative):
                                     errors = common.handle_error(errors, None, desc, "error")
                                 mimeType = mimeType.split("/")
                                 part = MIMEBase(mimeType[0], mimeType[1])
-                                part.set_payload(attachment.File)
+                                part.set_payload(attachment.read())
                                 encoders.encode_base64(part)
 
                                 # Check if the attachment is inline in the HTML
-                                if attachment.Content_ID in inline_files.values():
+                                if i in inline_cids:
                                     content_disposition = "inline"
-                                    part.add_header("Content-ID", attachment.Content_ID)
-                                elif attachment.Name in inline_files.keys():
-                                    # If the source was MSG or PST, we generated attachment.Content_ID so it won't match
-                                    content_disposition = "inline"
-                                    part.add_header("Content-ID", "<" + inline_files[attachment.Name] + ">")
+                                    if attachment.Content_ID and derivative.normalizeCID(attachment.Content_ID) == derivative.normalizeCID(
+                                        inline_cids[i]
+                                    ):
+                                        part.add_header("Content-ID", attachment.Content_ID)
+                                    else:
+                                        # If the source was MSG or PST, we generated attachment.Content_ID so it won't match
+                                        part.add_header("Content-ID", "<" + inline_cids[i] + ">")
                                 else:
                                     content_disposition = "attachment"
                                     part.add_header("Content-ID", attachment.Content_ID)
@@ -21,7 +21,7 @@ class ExampleDerivative(Derivative):
         super().__init__(args, mailbag_dir)
 
     def do_task_per_account(self):
-        print(self.account.account_data())
+        pass
 
     def do_task_per_message(self, message):
         print(self.format_subdirectory)
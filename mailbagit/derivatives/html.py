@@ -22,7 +22,7 @@ class HtmlDerivative(Derivative):
         super().__init__(args, mailbag_dir)
 
     def do_task_per_account(self):
-        log.debug(self.account.account_data())
+        pass
 
     def do_task_per_message(self, message):
 
@@ -45,7 +45,15 @@ class HtmlDerivative(Derivative):
                 # Calling helper function to get formatted html
                 html_formatted = None
                 try:
-                    html_formatted, encoding = derivative.htmlFormatting(message, self.args.css, headers=False)
+                    html_formatted, encoding = derivative.htmlFormatting(
+                        message,
+                        self.args.css,
+                        headers=False,
+                        html_parser=self.html_parser,
+                        link_images=self.link_images,
+                        html_dir=out_dir,
+                        compact=self.compact_html,
+                    )
                 except Exception as e:
                     desc = "Error formatting HTML for HTML derivative"
                     errors = common.handle_error(errors, e, desc)
@@ -1,8 +1,12 @@
 from mailbagit.loggerx import get_logger
-import mailbox
+import csv
+import io
 import os
+import time
+from collections import OrderedDict
 import mailbagit.helper.common as common
 import mailbagit.helper.derivative as derivative
+from email.generator import BytesGenerator
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
@@ -11,23 +15,123 @@ import platform
 
 log = get_logger()
 
+# Line endings for MBOX files, like the mailbox module
+linesep = os.linesep.encode("ascii")
+
 from mailbagit.derivative import Derivative
 
 
 class MboxDerivative(Derivative):
     derivative_name = "mbox"
     derivative_format = "mbox"
-    derivative_agent = mailbox.__name__
+    derivative_agent = BytesGenerator.__module__
     derivative_agent_version = platform.python_version()
 
+    # Most MBOX files kept open at once, the least recently used is closed when another one is needed
+    max_open_files = 64
+
     def __init__(self, email_account, args, mailbag_dir):
         log.debug(f"Setup {self.derivative_name} derivatives")
 
         # Sets up self.format_subdirectory
         super().__init__(args, mailbag_dir)
 
+        # Open MBOX files by path, in order of use
+        self.open_files = OrderedDict()
+
+        # With --mbox-max-size, the number of the file each folder is being written to,
+        # and an index of the file and offset of each message, written next to mailbag.csv
+        self.mailbag_dir = mailbag_dir
+        self.max_size = None
+        self.file_numbers = {}
+        self.index = None
+        if getattr(args, "mbox_max_size", None):
+            self.max_size = args.mbox_max_size * 1024 * 1024
+            if not args.dry_run:
+                self.index_file = open(os.path.join(mailbag_dir, "mbox-index.csv"), "w", encoding="utf-8", newline="")
+                self.index = csv.writer(self.index_file)
+                self.index.writerow(["Mailbag-Message-ID", "File", "Offset", "Length"])
+
     def do_task_per_account(self):
-        log.debug(self.account.account_data())
+        while self.open_files:
+            self.close_mbox(next(iter(self.open_files)))
+        if self.index:
+            self.index_file.close()
+
+    def open_mbox(self, filename):
+        """
+        Gets an MBOX file to add messages to. MBOX files are kept open for appending
+        until they are the least recently used of max_open_files or the account is finished,
+        so messages are appended without opening and syncing the file for every message.
+        Since messages are only appended, files that are reopened are never read.
+
+        Parameters:
+            filename (str): Path to the MBOX file
+
+        Returns:
+            file: The MBOX file, open for appending
+        """
+        if filename in self.open_files:
+            self.open_files.move_to_end(filename)
+        else:
+            if len(self.open_files) >= self.max_open_files:
+                self.close_mbox(next(iter(self.open_files)))
+            self.open_files[filename] = open(filename, "ab")
+        return self.open_files[filename]
+
+    def close_mbox(self, filename):
+        """
+        Writes any buffered messages to an MBOX file, syncs it, and closes it.
+
+        Parameters:
+            filename (str): Path to the MBOX file
+        """
+        f = self.open_files.pop(filename)
+        try:
+            f.flush()
+            os.fsync(f.fileno())
+        except Exception as e:
+            log.error("Error closing MBOX derivative " + str(filename) + ": " + str(e))
+        finally:
+            f.close()
+
+    def add_message(self, filename, message, mbox_message):
+        """
+        Adds a message to an MBOX file and records where it was written in the index, if there is one.
+        Messages are written like the mailbox module does, starting with a From_ line and followed by a blank line,
+        with lines starting with "From " in the body escaped as ">From ". If writing fails, the partial message is removed.
+
+        Parameters:
+            filename (str): Path to the MBOX file
+            message (Email): The message being written
+            mbox_message (email.message.Message): The message to add to the MBOX file
+
+        Returns:
+            int: The size of the MBOX file after adding the message
+        """
+        f = self.open_mbox(filename)
+        buffer = io.BytesIO()
+        BytesGenerator(buffer, mangle_from_=True, maxheaderlen=0).flatten(mbox_message)
+        data = buffer.getvalue().replace(b"\n", linesep)
+        if not data.endswith(linesep):
+            data += linesep
+        from_line = mbox_message.get_unixfrom()
+        if not from_line:
+            from_line = "From MAILER-DAEMON " + time.asctime(time.gmtime())
+
+        start = f.tell()
+        try:
+            f.write(from_line.encode("ascii") + linesep)
+            f.write(data)
+            stop = f.tell()
+            f.write(linesep)
+        except BaseException:
+            f.truncate(start)
+            raise
+        if self.index:
+            path = os.path.relpath(filename, self.mailbag_dir).replace(os.sep, "/")
+            self.index.writerow([message.Mailbag_Message_ID, path, start, stop - start])
+        return f.tell()
 
     def do_task_per_message(self, message):
 
@@ -44,6 +148,11 @@ class MboxDerivative(Derivative):
                 else:
                     out_dir = os.path.join(self.format_subdirectory, os.path.dirname(message.Derivatives_Path.strip("/")))
                     filename = os.path.join(out_dir, os.path.basename(message.Derivatives_Path.strip(os.sep)) + ".mbox")
+                if self.max_size:
+                    # Folders are split into numbered files, like Inbox.0001.mbox
+                    folder_filename = filename
+                    file_number = self.file_numbers.setdefault(folder_filename, 1)
+                    filename = folder_filename[: -len(".mbox")] + "." + str(file_number).zfill(4) + ".mbox"
                 errors = common.check_path_length(out_dir, errors)
                 errors = common.check_path_length(filename, errors)
             except Exception as e:
@@ -62,12 +171,10 @@ class MboxDerivative(Derivative):
 
                 try:
 
-                    mbox = mailbox.mbox(filename)
-                    mbox.lock()
-
+                    size = 0
                     fullObjectWrite = False
                     if message.Message:
-                        mbox.add(message.Message)
+                        size = self.add_message(filename, message, message.Message)
                     elif message.Headers:
                         msg = MIMEMultipart("mixed")
                         cs = charset.Charset("utf-8")
@@ -108,32 +215,31 @@ class MboxDerivative(Derivative):
                             desc = "Error writing body for MBOX derivative"
                             errors = common.handle_error(errors, e, desc)
 
-                        # Get list of <img> files that might reference attachments
-                        if message.HTML_Body:
-                            inline_files = derivative.inlineAttachments(message.HTML_Body, message.HTML_Encoding)
-                        else:
-                            inline_files = {}
+                        # Get the attachments referenced by <img> tags
+                        inline_cids = derivative.inlineContentIDs(message, self.html_parser)
 
                         # Attachments
                         try:
-                            for attachment in message.Attachments:
+                            for i, attachment in enumerate(message.Attachments):
                                 mimeType = attachment.MimeType
                                 if mimeType is None:
                                     mimeType = "text/plain"
                                     log.warn("Mime type not found for the attachment. For MBOX, set as " + mimeType + ".")
                                 mimeType = mimeType.split("/")
                                 part = MIMEBase(mimeType[0], mimeType[1])
-                                part.set_payload(attachment.File)
+                                part.set_payload(attachment.read())
                                 encoders.encode_base64(part)
 
                                 # Check if the attachment is inline in the HTML
-                                if attachment.Content_ID in inline_files.values():
-                                    content_disposition = "inline"
-                                    part.add_header("Content-ID", attachment.Content_ID)
-                                elif attachment.Name in inline_files.keys():
-                                    # If the source was MSG or PST, we generated attachment.Content_ID so it won't match
+                                if i in inline_cids:
                                     content_disposition = "inline"
-                                    part.add_header("Content-ID", "<" + inline_files[attachment.Name] + ">")
+                                    if attachment.Content_ID and derivative.normalizeCID(attachment.Content_ID) == derivative.normalizeCID(
+                                        inline_cids[i]
+                                    ):
+                                        part.add_header("Content-ID", attachment.Content_ID)
+                                    else:
+                                        # If the source was MSG or PST, we generated attachment.Content_ID so it won't match
+                                        part.add_header("Content-ID", "<" + inline_cids[i] + ">")
                                 else:
                                     content_disposition = "attachment"
                                     part.add_header("Content-ID", attachment.Content_ID)
@@ -144,14 +250,16 @@ class MboxDerivative(Derivative):
                             desc = "Error writing attachment(s) to MBOX derivative"
                             errors = common.handle_error(errors, e, desc)
 
-                        mbox.add(msg)
+                        size = self.add_message(filename, message, msg)
 
                     else:
                         desc = "Unable to create MBOX as no body or headers present for " + str(message.Mailbag_Message_ID)
                         errors = common.handle_error(errors, None, desc, "error")
 
-                    mbox.flush()
-                    mbox.unlock()
+                    # Starts the next file for the folder once this one is full
+                    if self.max_size and size >= self.max_size:
+                        self.close_mbox(filename)
+                        self.file_numbers[folder_filename] += 1
 
                 except Exception as e:
                     desc = "Error writing MBOX derivative"
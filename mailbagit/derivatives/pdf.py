@@ -22,6 +22,58 @@ except:
 
 log = get_logger()
 
+
+class WkhtmltopdfRenderer:
+    """
+    Renders PDFs for a RenderPool thread by running wkhtmltopdf, which reads the HTML from stdin.
+    wkhtmltopdf is killed if it takes longer than the timeout.
+    Errors are error level if no PDF was created, so the pool retries them, otherwise warnings.
+    """
+
+    def __init__(self, timeout, attachments_dir=None):
+        self.timeout = timeout
+        self.attachments_dir = attachments_dir
+
+    def render(self, message, html, pdf_name):
+        errors = []
+        command = [
+            wkhtmltopdf,
+            "--disable-javascript",
+            "-",
+            os.path.abspath(pdf_name),
+        ]
+        if self.attachments_dir:
+            # Newer versions of wkhtmltopdf block local files unless they are allowed
+            command[2:2] = ["--allow", os.path.abspath(self.attachments_dir)]
+        log.debug("Running " + " ".join(command))
+        p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = p.communicate(input=html.encode("utf-8"), timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.communicate()
+            derivative.deleteFile(pdf_name)
+            desc = "Timed out converting to " + str(message.Mailbag_Message_ID) + ".pdf after " + str(self.timeout) + " seconds"
+            return common.handle_error(errors, None, desc, "error")
+        if p.returncode == 0:
+            log.debug("Successfully created " + str(message.Mailbag_Message_ID) + ".pdf")
+        else:
+            if stdout:
+                log.debug("Output converting to " + str(message.Mailbag_Message_ID) + ".pdf: " + stdout.decode("utf-8"))
+            if stderr or not os.path.isfile(pdf_name):
+                desc = (
+                    "Error converting to "
+                    + str(message.Mailbag_Message_ID)
+                    + ".pdf: "
+                    + stderr.decode("utf-8").replace("\r", "\n").replace("\n\n", "\n")
+                )
+                errors = common.handle_error(errors, None, desc, "warn" if os.path.isfile(pdf_name) else "error")
+        return errors
+
+    def close(self):
+        pass
+
+
 if not skip_registry:
 
     class PDFDerivative(Derivative):
@@ -40,9 +92,26 @@ if not skip_registry:
 
             # Sets up self.format_subdirectory
             super().__init__(args, mailbag_dir)
+            self.pdf_timeout = getattr(args, "pdf_timeout", 120)
+            self.pdf_workers = getattr(args, "pdf_workers", 1)
+            attachments_dir = os.path.join(mailbag_dir, "data", "attachments") if self.link_images else None
+
+            # Runs wkhtmltopdf in the background for up to --pdf-workers messages at a time
+            if not args.dry_run:
+                self.pool = derivative.RenderPool(
+                    lambda: WkhtmltopdfRenderer(self.pdf_timeout, attachments_dir), self.pdf_workers, retry=True
+                )
+            else:
+                self.pool = None
 
         def do_task_per_account(self):
-            print(self.account.account_data())
+            if self.pool:
+                self.pool.close()
+
+        def pending_messages(self):
+            if self.pool:
+                return self.pool.pending_messages()
+            return set()
 
         def do_task_per_message(self, message):
 
@@ -51,61 +120,40 @@ if not skip_registry:
             try:
 
                 out_dir = os.path.join(self.format_subdirectory, message.Derivatives_Path)
-                filename = os.path.join(out_dir, str(message.Mailbag_Message_ID))
+                pdf_name = os.path.join(out_dir, str(message.Mailbag_Message_ID) + ".pdf")
                 errors = common.check_path_length(out_dir, errors)
-                html_name = filename + ".html"
-                pdf_name = filename + ".pdf"
                 errors = common.check_path_length(pdf_name, errors)
 
                 if message.HTML_Body is None and message.Text_Body is None:
                     desc = "No HTML or plain text body for " + str(message.Mailbag_Message_ID) + ", no PDF derivative created"
                     errors = common.handle_error(errors, None, desc, "warn")
                 else:
-                    log.debug("Writing HTML to " + str(html_name) + " and converting to " + str(pdf_name))
+                    log.debug("Converting to " + str(pdf_name))
                     # Calling helper function to get formatted html
                     try:
-                        html_formatted, encoding = derivative.htmlFormatting(message, self.args.css)
+                        html_formatted, encoding = derivative.htmlFormatting(
+                            message,
+                            self.args.css,
+                            html_parser=self.html_parser,
+                            link_images=self.link_images,
+                            compact=self.compact_html,
+                        )
                     except Exception as e:
                         desc = "Error formatting HTML for PDF derivative"
                         errors = common.handle_error(errors, e, desc)
-
-                    if not self.args.dry_run:
-                        try:
-                            if not os.path.isdir(out_dir):
-                                os.makedirs(out_dir)
-
-                            with open(html_name, "w", encoding="utf-8") as write_html:
-                                write_html.write(html_formatted)
-                                write_html.close()
-                            command = [
-                                wkhtmltopdf,
-                                "--disable-javascript",
-                                os.path.abspath(html_name),
-                                os.path.abspath(pdf_name),
-                            ]
-                            log.debug("Running " + " ".join(command))
-                            p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                            stdout, stderr = p.communicate()
-                            if p.returncode == 0:
-                                log.debug("Successfully created " + str(message.Mailbag_Message_ID) + ".pdf")
-                            else:
-                                if stdout:
-                                    log.debug("Output converting to " + str(message.Mailbag_Message_ID) + ".pdf: " + stdout.decode("utf-8"))
-                                if stderr:
-                                    desc = (
-                                        "Error converting to "
-                                        + str(message.Mailbag_Message_ID)
-                                        + ".pdf: "
-                                        + stderr.decode("utf-8").replace("\r", "\n").replace("\n\n", "\n")
-                                    )
-                                    errors = common.handle_error(errors, None, desc, "warn")
-                            # delete the HTML file
-                            if os.path.isfile(pdf_name):
-                                os.remove(html_name)
-
-                        except Exception as e:
-                            desc = "Error writing HTML and converting to PDF derivative"
-                            errors = common.handle_error(errors, e, desc)
+                    else:
+                        # Only converts the HTML if it was formatted
+                        if not self.args.dry_run:
+                            try:
+                                if not os.path.isdir(out_dir):
+                                    os.makedirs(out_dir)
+
+                                # Errors are added to the message when it is rendered
+                                self.pool.submit(message, html_formatted, pdf_name)
+
+                            except Exception as e:
+                                desc = "Error writing HTML and converting to PDF derivative"
+                                errors = common.handle_error(errors, e, desc)
 
             except Exception as e:
                 desc = "Error creating PDF derivative"
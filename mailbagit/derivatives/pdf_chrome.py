@@ -1,4 +1,12 @@
 import os
+import json
+import time
+import base64
+import select
+import sys
+import shutil
+import pathlib
+import tempfile
 import subprocess
 import distutils.spawn
 from mailbagit.derivative import Derivative
@@ -19,6 +27,250 @@ except:
 
 log = get_logger()
 
+
+# Moves the DevTools pipes given as the first two arguments to fds 3 and 4 and runs the rest of the arguments.
+# Duplicating both first means moving one can't overwrite the other.
+DEVTOOLS_PIPE_LAUNCHER = """
+import os, sys
+command_read, response_write = os.dup(int(sys.argv[1])), os.dup(int(sys.argv[2]))
+os.dup2(command_read, 3)
+os.dup2(response_write, 4)
+# dup2() doesn't change an fd that is already 3 or 4, so it could still be closed on exec
+os.set_inheritable(3, True)
+os.set_inheritable(4, True)
+for fd in set([int(sys.argv[1]), int(sys.argv[2]), command_read, response_write]) - set([3, 4]):
+    os.close(fd)
+os.execvp(sys.argv[3], sys.argv[3:])
+"""
+
+
+# Resolves once the images and fonts of a document set with Page.setDocumentContent have loaded
+PAGE_LOADED = (
+    "Promise.all([document.fonts.ready].concat(Array.from(document.images, "
+    "(image) => image.complete ? null : new Promise((resolve) => { image.onload = image.onerror = resolve; }))))"
+)
+
+
+class ChromeBrowser:
+    """
+    A long-running headless Chrome, controlled with the DevTools protocol over pipes (--remote-debugging-pipe).
+    Chrome reads commands from fd 3 and writes responses and events to fd 4, as null-terminated JSON.
+    Pages are rendered in a single reused tab.
+    Raises TimeoutError if Chrome does not respond in time and ConnectionError if Chrome exits.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.message_id = 0
+        self.events = []
+        self.buffer = bytearray()
+        self.profile_dir = tempfile.mkdtemp(prefix="mailbagit-chrome-")
+
+        # Chrome needs the pipes as fds 3 and 4. A small Python process moves them there and then runs Chrome,
+        # since subprocess can't move fds itself and preexec_fn isn't safe with threads.
+        command_read, self.command_pipe = os.pipe()
+        self.response_pipe, response_write = os.pipe()
+        # Commands are written without blocking, so a large page sent to a hung Chrome can't block past the deadline
+        os.set_blocking(self.command_pipe, False)
+        command = [
+            chrome,
+            "--headless",
+            "--run-all-compositor-stages-before-draw",
+            "--disable-gpu",
+            "--remote-debugging-pipe",
+            "--no-first-run",
+            "--no-default-browser-check",
+            "--user-data-dir=" + self.profile_dir,
+        ]
+        # Adds --no-sandbox arg to run as root in docker container if env variable set
+        if os.environ.get("IN_CONTAINER", "").upper() == "TRUE":
+            command.append("--no-sandbox")
+        log.debug("Running " + " ".join(command))
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable, "-c", DEVTOOLS_PIPE_LAUNCHER, str(command_read), str(response_write)] + command,
+                pass_fds=(command_read, response_write),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except Exception:
+            os.close(self.command_pipe)
+            os.close(self.response_pipe)
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            raise
+        finally:
+            os.close(command_read)
+            os.close(response_write)
+
+        try:
+            deadline = time.monotonic() + self.timeout
+            target = self.call("Target.createTarget", {"url": "about:blank"}, deadline=deadline)
+            self.session = self.call("Target.attachToTarget", {"targetId": target["targetId"], "flatten": True}, deadline=deadline)[
+                "sessionId"
+            ]
+            self.call("Page.enable", session=self.session, deadline=deadline)
+            self.frame = self.call("Page.getFrameTree", session=self.session, deadline=deadline)["frameTree"]["frame"]["id"]
+        except Exception:
+            self.close(kill=True)
+            raise
+
+    def receive(self, deadline):
+        """Reads the next message from Chrome"""
+        searched = 0
+        while True:
+            end = self.buffer.find(b"\0", searched)
+            if end >= 0:
+                message = self.buffer[:end]
+                del self.buffer[: end + 1]
+                return json.loads(message)
+            searched = len(self.buffer)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Chrome did not respond within " + str(self.timeout) + " seconds")
+            ready, _, _ = select.select([self.response_pipe], [], [], remaining)
+            if ready:
+                chunk = os.read(self.response_pipe, 1024 * 1024)
+                if not chunk:
+                    raise ConnectionError("Chrome exited unexpectedly")
+                self.buffer.extend(chunk)
+
+    def send(self, data, deadline):
+        """Writes to Chrome, waiting for the pipe to have room until the deadline"""
+        data = memoryview(data)
+        while data:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Chrome did not read commands within " + str(self.timeout) + " seconds")
+            _, ready, _ = select.select([], [self.command_pipe], [], remaining)
+            if ready:
+                try:
+                    data = data[os.write(self.command_pipe, data) :]
+                except BlockingIOError:
+                    continue
+                except BrokenPipeError as e:
+                    raise ConnectionError("Chrome exited unexpectedly") from e
+
+    def call(self, method, params=None, session=None, deadline=None):
+        """
+        Sends a DevTools protocol command and waits for its result.
+        Events received in the meantime are kept for wait_for().
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        self.message_id += 1
+        command = {"id": self.message_id, "method": method, "params": params or {}}
+        if session:
+            command["sessionId"] = session
+        data = json.dumps(command).encode("utf-8") + b"\0"
+        self.send(data, deadline)
+        while True:
+            response = self.receive(deadline)
+            if response.get("id") == self.message_id:
+                if "error" in response:
+                    raise RuntimeError(method + " failed: " + str(response["error"].get("message")))
+                return response.get("result", {})
+            elif "method" in response:
+                self.events.append(response)
+
+    def wait_for(self, event, session, deadline):
+        """Waits for a DevTools protocol event"""
+        while True:
+            for i, received in enumerate(self.events):
+                if received["method"] == event and received.get("sessionId") == session:
+                    return self.events.pop(i)
+            response = self.receive(deadline)
+            if "method" in response:
+                self.events.append(response)
+
+    def render(self, pdf_name, html=None, html_name=None):
+        """
+        Prints HTML to a PDF. The HTML is sent to Chrome over the pipe,
+        or loaded from a file if html_name is given, which is needed for pages that link to local files.
+        """
+        deadline = time.monotonic() + self.timeout
+        self.events = []
+        if html_name:
+            navigation = self.call("Page.navigate", {"url": pathlib.Path(os.path.abspath(html_name)).as_uri()}, self.session, deadline)
+            if navigation.get("errorText"):
+                raise RuntimeError("Unable to load " + html_name + ": " + navigation["errorText"])
+            self.wait_for("Page.loadEventFired", self.session, deadline)
+        else:
+            self.call("Page.setDocumentContent", {"frameId": self.frame, "html": html}, self.session, deadline)
+            self.call("Runtime.evaluate", {"expression": PAGE_LOADED, "awaitPromise": True}, self.session, deadline)
+        pdf = self.call("Page.printToPDF", {"displayHeaderFooter": False}, self.session, deadline)
+        with open(pdf_name, "wb") as f:
+            f.write(base64.b64decode(pdf["data"]))
+            f.close()
+
+    def close(self, kill=False):
+        """Closes Chrome, killing it if it does not exit or if kill is True, like after a timeout"""
+        if kill and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        if self.process.poll() is None:
+            try:
+                self.call("Browser.close", deadline=time.monotonic() + 5)
+            except Exception as e:
+                log.debug("Unable to close Chrome: " + repr(e))
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        os.close(self.command_pipe)
+        os.close(self.response_pipe)
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+
+class ChromeRenderer:
+    """
+    Renders PDFs for a RenderPool thread with a ChromeBrowser that is kept open between messages.
+    Chrome is restarted after a timeout or crash, and a page is retried once if Chrome crashed while rendering it.
+    HTML is sent to Chrome directly, unless a scratch_dir is given for pages that link to local files.
+    """
+
+    def __init__(self, timeout, scratch_dir=None):
+        self.timeout = timeout
+        self.scratch_dir = scratch_dir
+        self.browser = None
+
+    def render(self, message, html, pdf_name):
+        errors = []
+        html_name = None
+        if self.scratch_dir:
+            html_name = os.path.join(self.scratch_dir, str(message.Mailbag_Message_ID) + ".html")
+            with open(html_name, "w", encoding="utf-8") as write_html:
+                write_html.write(html)
+                write_html.close()
+        for attempt in range(2):
+            try:
+                if self.browser is None:
+                    self.browser = ChromeBrowser(self.timeout)
+                self.browser.render(pdf_name, html=html, html_name=html_name)
+                log.debug("Successfully created " + str(message.Mailbag_Message_ID) + ".pdf")
+                break
+            except Exception as e:
+                self.close(kill=True)
+                if isinstance(e, ConnectionError) and attempt == 0:
+                    log.warn("Chrome crashed converting to " + str(message.Mailbag_Message_ID) + ".pdf, retrying")
+                    continue
+                desc = "Error converting to " + str(message.Mailbag_Message_ID) + ".pdf with chrome"
+                errors = common.handle_error(errors, e, desc, "error")
+                break
+        if html_name:
+            derivative.deleteFile(html_name)
+        return errors
+
+    def close(self, kill=False):
+        if self.browser:
+            browser = self.browser
+            self.browser = None
+            try:
+                browser.close(kill)
+            except Exception as e:
+                log.debug("Unable to close Chrome: " + repr(e))
+
+
 if not skip_registry:
 
     class PDFChromeDerivative(Derivative):
@@ -32,9 +284,34 @@ if not skip_registry:
 
             # Sets up self.format_subdirectory
             super().__init__(args, mailbag_dir)
+            self.pdf_timeout = getattr(args, "pdf_timeout", 120)
+            self.pdf_workers = getattr(args, "pdf_workers", 1)
+
+            # Keeps Chrome running and renders PDFs in the background. The DevTools pipe needs POSIX fds.
+            use_pool = os.name == "posix" and not args.dry_run
+
+            # HTML files Chrome needs are written here instead of the mailbag. They are needed for pages that link
+            # to attachments, which have to be loaded from files to be allowed to load them, and without the pool.
+            self.scratch_dir = None
+            if not args.dry_run and (self.link_images or not use_pool):
+                self.scratch_dir = derivative.scratchDirectory()
+
+            if use_pool:
+                scratch_dir = self.scratch_dir
+                self.pool = derivative.RenderPool(lambda: ChromeRenderer(self.pdf_timeout, scratch_dir), self.pdf_workers)
+            else:
+                self.pool = None
 
         def do_task_per_account(self):
-            print(self.account.account_data())
+            if self.pool:
+                self.pool.close()
+            if self.scratch_dir:
+                shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+        def pending_messages(self):
+            if self.pool:
+                return self.pool.pending_messages()
+            return set()
 
         def do_task_per_message(self, message):
 
@@ -42,64 +319,42 @@ if not skip_registry:
             try:
 
                 out_dir = os.path.join(self.format_subdirectory, message.Derivatives_Path)
-                filename = os.path.join(out_dir, str(message.Mailbag_Message_ID))
+                pdf_name = os.path.join(out_dir, str(message.Mailbag_Message_ID) + ".pdf")
                 errors = common.check_path_length(out_dir, errors)
-                html_name = filename + ".html"
-                pdf_name = filename + ".pdf"
                 errors = common.check_path_length(pdf_name, errors)
 
                 if message.HTML_Body is None and message.Text_Body is None:
                     log.warn("No HTML or plain text body for " + str(message.Mailbag_Message_ID) + ". No PDF derivative will be created.")
                 else:
-                    log.debug("Writing HTML to " + str(html_name) + " and converting to " + str(pdf_name))
+                    log.debug("Converting to " + str(pdf_name))
                     # Calling helper function to get formatted html
                     try:
-                        html_formatted, encoding = derivative.htmlFormatting(message, self.args.css)
+                        html_formatted, encoding = derivative.htmlFormatting(
+                            message,
+                            self.args.css,
+                            html_parser=self.html_parser,
+                            link_images=self.link_images,
+                            compact=self.compact_html,
+                        )
                     except Exception as e:
                         desc = "Error formatting HTML for PDF derivative"
                         errors = common.handle_error(errors, e, desc)
+                    else:
+                        # Only converts the HTML if it was formatted
+                        if not self.args.dry_run:
+                            try:
+                                if not os.path.isdir(out_dir):
+                                    os.makedirs(out_dir)
 
-                    if not self.args.dry_run:
-                        try:
-                            if not os.path.isdir(out_dir):
-                                os.makedirs(out_dir)
-
-                            with open(html_name, "w", encoding="utf-8") as write_html:
-                                write_html.write(html_formatted)
-                                write_html.close()
-                            command = [
-                                chrome,
-                                "--headless",
-                                "--run-all-compositor-stages-before-draw",
-                                "--disable-gpu",
-                                "--no-pdf-header-footer",
-                                "--print-to-pdf=" + os.path.abspath(pdf_name),
-                                os.path.abspath(html_name),
-                            ]
-
-                            # Adds --no-sandbox arg to run as root in docker container if env variable set
-                            if os.environ.get("IN_CONTAINER", "").upper() == "TRUE":
-                                command.insert(4, "--no-sandbox")
-
-                            log.debug("Running " + " ".join(command))
-                            p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-                            stdout, stderr = p.communicate()
-                            if p.returncode == 0:
-                                log.debug("Successfully created " + str(message.Mailbag_Message_ID) + ".pdf")
-                            else:
-                                if stdout:
-                                    log.warn("Output converting to " + str(message.Mailbag_Message_ID) + ".pdf: " + str(stdout))
-                                if stderr:
-                                    desc = "Error converting to " + str(message.Mailbag_Message_ID) + ".pdf: " + str(stderr)
-                                    errors = common.handle_error(errors, None, desc, "error")
-                            # delete the HTML file
-                            if os.path.isfile(pdf_name):
-                                os.remove(html_name)
-
-                        except Exception as e:
-                            desc = "Error writing HTML and converting to PDF derivative"
-                            errors = common.handle_error(errors, e, desc)
+                                if self.pool:
+                                    # Errors are added to the message when it is rendered
+                                    self.pool.submit(message, html_formatted, pdf_name)
+                                else:
+                                    self.render_process(message, html_formatted, pdf_name, errors)
+
+                            except Exception as e:
+                                desc = "Error writing HTML and converting to PDF derivative"
+                                errors = common.handle_error(errors, e, desc)
 
             except Exception as e:
                 desc = "Error creating PDF derivative with chrome"
@@ -108,3 +363,45 @@ if not skip_registry:
             message.Errors.extend(errors)
 
             return message
+
+        def render_process(self, message, html_formatted, pdf_name, errors):
+            """Renders a PDF with a new Chrome process, where the DevTools pipe is not available"""
+            html_name = os.path.join(self.scratch_dir, str(message.Mailbag_Message_ID) + ".html")
+            with open(html_name, "w", encoding="utf-8") as write_html:
+                write_html.write(html_formatted)
+                write_html.close()
+            command = [
+                chrome,
+                "--headless",
+                "--run-all-compositor-stages-before-draw",
+                "--disable-gpu",
+                "--no-pdf-header-footer",
+                "--print-to-pdf=" + os.path.abspath(pdf_name),
+                os.path.abspath(html_name),
+            ]
+
+            # Adds --no-sandbox arg to run as root in docker container if env variable set
+            if os.environ.get("IN_CONTAINER", "").upper() == "TRUE":
+                command.insert(4, "--no-sandbox")
+
+            log.debug("Running " + " ".join(command))
+            p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+            try:
+                stdout, stderr = p.communicate(timeout=self.pdf_timeout)
+            except subprocess.TimeoutExpired:
+                p.kill()
+                stdout, stderr = p.communicate()
+                desc = "Timed out converting to " + str(message.Mailbag_Message_ID) + ".pdf after " + str(self.pdf_timeout) + " seconds"
+                return common.handle_error(errors, None, desc, "error")
+            if p.returncode == 0:
+                log.debug("Successfully created " + str(message.Mailbag_Message_ID) + ".pdf")
+            else:
+                if stdout:
+                    log.warn("Output converting to " + str(message.Mailbag_Message_ID) + ".pdf: " + str(stdout))
+                if stderr:
+                    desc = "Error converting to " + str(message.Mailbag_Message_ID) + ".pdf: " + str(stderr)
+                    errors = common.handle_error(errors, None, desc, "error")
+            # delete the HTML file
+            derivative.deleteFile(html_name)
+            return errors
@@ -13,6 +13,7 @@ class TxtDerivative(Derivative):
     derivative_format = "txt"
     derivative_agent = ""
     derivative_agent_version = ""
+    requires_html_body = False
 
     def __init__(self, email_account, args, mailbag_dir):
         log.debug(f"Setup {self.derivative_name} derivatives")
@@ -21,7 +22,7 @@ class TxtDerivative(Derivative):
         super().__init__(args, mailbag_dir)
 
     def do_task_per_account(self):
-        log.debug(self.account.account_data())
+        pass
 
     def do_task_per_message(self, message):
 
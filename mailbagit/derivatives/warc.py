@@ -13,7 +13,6 @@ import requests  # requests *must* be imported after capture_http
 import json
 import urllib.parse
 from io import BytesIO
-from bs4 import BeautifulSoup
 from urllib.parse import quote_plus
 from datetime import datetime
 
@@ -40,24 +39,27 @@ class WarcDerivative(Derivative):
         # Sets up self.format_subdirectory
         super().__init__(args, mailbag_dir)
 
-    def email_external_resources(self, soup):
+    def email_external_resources(self, html_string, external_links=False):
         """
         Reads an HTML body string and looks for all externally-hosted
         resources in tags that are supported by email clients
 
         Parameters:
-            soup(obj): A BeautifulSoup object
+            html_string(str): An HTML body string
+            external_links(bool): Also include <a> links
 
         Returns:
             List: A list of URLs
         """
         external_urls = []
         external_resources = {"img": "src", "link": "href", "object": "data", "source": "src"}
+        if external_links:
+            external_resources["a"] = "href"
+        values = derivative.scanTags(html_string, external_resources)
         for tag in external_resources.keys():
-            attr = external_resources[tag]
-            for tag in soup.findAll(tag):
-                if tag.get(attr) and tag.get(attr).lower().strip().startswith("http"):
-                    external_urls.append(tag.get(attr))
+            for value in values[tag]:
+                if value and value.lower().strip().startswith("http"):
+                    external_urls.append(value)
 
         return external_urls
 
@@ -86,12 +88,12 @@ class WarcDerivative(Derivative):
             errors = common.handle_error(errors, None, desc, "warn")
             return False
 
-    def html_external_resources(self, soup, url):
+    def html_external_resources(self, html_string, url):
         """
         Reads an HTML body string and looks for all externally-hosted resources
 
         Parameters:
-            soup(obj): A BeautifulSoup object
+            html_string(str): A string of HTML
             url(str): A string of the URL from where the object was requested
 
         Returns:
@@ -113,13 +115,13 @@ class WarcDerivative(Derivative):
             "input": "src",
             "track": "src",
         }
+        values = derivative.scanTags(html_string, external_resources)
         for tag in external_resources.keys():
-            attr = external_resources[tag]
-            for tag in soup.findAll(tag):
-                if tag.get(attr) and tag.get(attr).lower().strip().startswith("http"):
-                    external_urls.append(tag.get(attr))
+            for value in values[tag]:
+                if value and value.lower().strip().startswith("http"):
+                    external_urls.append(value)
                 else:
-                    full_url = urllib.parse.urljoin(url, tag.get(attr))
+                    full_url = urllib.parse.urljoin(url, value)
                     external_urls.append(full_url)
 
         return list(dict.fromkeys(external_urls))
@@ -188,8 +190,7 @@ class WarcDerivative(Derivative):
                         if "content-type" in r.headers.keys():
                             if "text/html" in r.headers["content-type"]:
                                 # Gotta get these external resources as well
-                                new_soup = BeautifulSoup(r.text, "html.parser")
-                                new_external_urls = self.html_external_resources(new_soup, r.url)
+                                new_external_urls = self.html_external_resources(r.text, r.url)
                                 url_page_requisites.extend(new_external_urls)
                             elif r.headers["content-type"] == "text/css":
                                 new_external_urls = self.css_external_resources(r.text, r.url)
@@ -201,7 +202,7 @@ class WarcDerivative(Derivative):
         return session, warc_writer, list(dict.fromkeys(url_page_requisites)), errors
 
     def do_task_per_account(self):
-        log.debug(self.account.account_data())
+        pass
 
     def do_task_per_message(self, message):
 
@@ -241,19 +242,16 @@ class WarcDerivative(Derivative):
 
                 # Format HTML for WARC file
                 try:
-                    html_formatted, encoding = derivative.htmlFormatting(message, self.args.css, headers=False)
+                    html_formatted, encoding = derivative.htmlFormatting(
+                        message, self.args.css, headers=False, html_parser=self.html_parser
+                    )
                 except Exception as e:
                     desc = "Error formatting HTML for WARC derivative"
                     errors = common.handle_error(errors, e, desc)
 
-                # Parse HTML for external resources
-                soup = BeautifulSoup(html_formatted, "html.parser")
-                external_urls = self.email_external_resources(soup)
+                # Scan HTML for external resources
                 # If external links option is selected, also crawl <a> urls and their external resources
-                if self.args.external_links:
-                    for a_tag in soup.findAll("a"):
-                        if a_tag.get("href") and a_tag.get("href").lower().strip().startswith("http"):
-                            external_urls.append(a_tag.get("href"))
+                external_urls = self.email_external_resources(html_formatted, self.args.external_links)
 
                 if not self.args.dry_run:
                     if not os.path.isdir(out_dir):
@@ -308,23 +306,26 @@ class WarcDerivative(Derivative):
                         # Write attachments
                         try:
                             for i, attachment in enumerate(message.Attachments):
+                                attachment_size = attachment.size
                                 headers_list = [
                                     ("Content-Type", attachment.MimeType),
                                     ("Content-ID", attachment.Content_ID),
                                     ("Filename", attachment.WrittenName),
-                                    ("Content-Length", str(len(attachment.File))),
+                                    ("Content-Length", str(attachment_size)),
                                     ("Date", datetime_to_http_date(datetime.now())),
                                 ]
                                 http_headers = StatusAndHeaders("200 OK", headers_list, protocol="HTTP/1.0")
-                                record = warc_writer.create_warc_record(
-                                    f"{warc_uri}/{quote_plus(attachment.WrittenName)}",
-                                    "response",
-                                    payload=BytesIO(attachment.File),
-                                    length=len(attachment.File),
-                                    http_headers=http_headers,
-                                    warc_content_type="text/html",
-                                )
-                                warc_writer.write_record(record)
+                                # stream the attachment data, since large attachments may be spooled to disk
+                                with attachment.open() as payload:
+                                    record = warc_writer.create_warc_record(
+                                        f"{warc_uri}/{quote_plus(attachment.WrittenName)}",
+                                        "response",
+                                        payload=payload,
+                                        length=attachment_size,
+                                        http_headers=http_headers,
+                                        warc_content_type="text/html",
+                                    )
+                                    warc_writer.write_record(record)
                         except Exception as e:
                             desc = "Error adding attachments to WARC derivative"
                             errors = common.handle_error(errors, e, desc)
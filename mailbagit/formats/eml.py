@@ -6,11 +6,10 @@ import mailbagit.helper.common as common
 from mailbagit.loggerx import get_logger
 from email import parser
 from mailbagit.email_account import EmailAccount
-from mailbagit.models import Email, Attachment
+from mailbagit.models import Email, Attachment, MessageSource
 import email
 import os
 import platform
-from itertools import chain
 
 log = get_logger()
 
@@ -30,10 +29,13 @@ class EML(EmailAccount):
         self.path = args.path
         self.dry_run = args.dry_run
         self.keep = args.keep
+        self.keep_strategy = getattr(args, "keep_strategy", "auto")
         self.mailbag_name = mailbag_name
         self.mailbag_dir = mailbag_dir
         self.source_parent_dir = source_parent_dir
         self.companion_files = args.companion_files
+        self.processes = getattr(args, "processes", 1)
+        self._file_lists = None
 
         log.info("Reading: " + self.path)
 
@@ -41,113 +43,43 @@ class EML(EmailAccount):
     def account_data(self):
         return self._account_data
 
+    @property
+    def file_lists(self):
+        """EML files and companion files in self.path. The source is only walked once and then cached."""
+        if self._file_lists is None:
+            self._file_lists = format.discoverFiles(
+                self.path,
+                self.mailbag_name,
+                lambda file: file.lower().endswith("." + self.format_name),
+                companion_files=self.companion_files,
+                processes=self.processes,
+            )
+        return self._file_lists
+
     @property
     def number_of_messages(self):
-        if os.path.isfile(self.path):
-            return 1
-        count = 0
-        for _ in chain((files for _, _, files in os.walk(self.path))):
-            count += 1
-        return count
+        return len(self.file_lists[0])
 
     def messages(self):
-        companion_files = []
-        if os.path.isfile(self.path):
-            fileList = [self.path]
-        else:
-            fileList = []
-            for root, dirs, files in os.walk(self.path):
-                for file in files:
-                    mailbag_path = os.path.join(self.path, self.mailbag_name) + os.sep
-                    fileRoot = root + os.sep
-                    # don't count the newly-created mailbag
-                    if not fileRoot.startswith(mailbag_path):
-                        if file.lower().endswith("." + self.format_name):
-                            fileList.append(os.path.join(root, file))
-                        elif self.companion_files:
-                            companion_files.append(os.path.join(root, file))
+        mover = format.FileMover(
+            self.dry_run, self.keep, self.source_parent_dir, self.mailbag_dir, self.mailbag_name, self.format_name, self.keep_strategy
+        )
+        fileList, companion_files = self.file_lists
 
+        jobs = []
         for filePath in fileList:
             rel_path = format.relativePath(self.path, filePath)
             if len(rel_path) < 1:
                 originalFile = Path(filePath).name
             else:
                 originalFile = Path(os.path.normpath(rel_path)).as_posix()
-            # original file is now the relative path to the MBOX from the provided path
-
-            attachments = []
-            errors = []
-            try:
-                with open(filePath, "rb") as f:
-                    msg = email.message_from_binary_file(f, policy=email.policy.default)
-
-                    try:
-                        # Parse message bodies
-                        bodies = {}
-                        bodies["html_body"] = None
-                        bodies["text_body"] = None
-                        bodies["html_encoding"] = None
-                        bodies["text_encoding"] = None
-                        if msg.is_multipart():
-                            for part in msg.walk():
-                                bodies, attachments, errors = format.parse_part(part, bodies, attachments, errors)
-                        else:
-                            bodies, attachments, errors = format.parse_part(msg, bodies, attachments, errors)
-
-                    except Exception as e:
-                        desc = "Error parsing message parts"
-                        errors = common.handle_error(errors, e, desc)
-
-                    # Look for message arrangement
-                    try:
-                        messagePath = Path(format.messagePath(msg)).as_posix()
-                        if messagePath == ".":
-                            messagePath = ""
-                        unsafePath = os.path.join(os.path.dirname(originalFile), messagePath)
-                        derivativesPath = common.normalizePath(unsafePath)
-                    except Exception as e:
-                        desc = "Error reading message path from headers"
-                        errors = common.handle_error(errors, e, desc)
-
-                    decoded_Message_ID, errors = format.parse_header(msg["message-id"], errors)
-                    decoded_Date, errors = format.parse_header(msg["date"], errors)
-                    decoded_From, errors = format.parse_header(msg["from"], errors)
-                    decoded_To, errors = format.parse_header(msg["to"], errors)
-                    decoded_Cc, errors = format.parse_header(msg["cc"], errors)
-                    decoded_Bcc, errors = format.parse_header(msg["bcc"], errors)
-                    decoded_Subject, errors = format.parse_header(msg["subject"], errors)
-
-                    message = Email(
-                        Errors=errors,
-                        Message_ID=decoded_Message_ID,
-                        Original_File=originalFile,
-                        Message_Path=messagePath,
-                        Derivatives_Path=derivativesPath,
-                        Date=decoded_Date,
-                        From=decoded_From,
-                        To=decoded_To,
-                        Cc=decoded_Cc,
-                        Bcc=decoded_Bcc,
-                        Subject=decoded_Subject,
-                        Content_Type=msg.get_content_type(),
-                        Headers=msg,
-                        HTML_Body=bodies["html_body"],
-                        HTML_Encoding=bodies["html_encoding"],
-                        Text_Body=bodies["text_body"],
-                        Text_Encoding=bodies["text_encoding"],
-                        Message=msg,
-                        Attachments=attachments,
-                    )
-
-            except (email.errors.MessageParseError, Exception) as e:
-                desc = "Error parsing message"
-                errors = common.handle_error(errors, e, desc)
-                message = Email(Errors=errors)
+            # original file is now the relative path to the EML from the provided path
+            jobs.append((filePath, originalFile))
 
+        # EMLs are parsed in worker processes, but moved here to keep moves in order
+        for (filePath, originalFile), message in zip(jobs, format.parallelMessages(parse_eml, jobs, self.processes, lambda job: job[1])):
             # Move EML to new mailbag directory structure
-            new_path, errors = format.moveWithDirectoryStructure(
-                self.dry_run, self.keep, self.source_parent_dir, self.mailbag_dir, self.mailbag_name, self.format_name, filePath, errors
-            )
+            new_path, errors = mover.move(filePath, [])
             message.Errors.extend(errors)
 
             yield message
@@ -155,14 +87,95 @@ class EML(EmailAccount):
         if self.companion_files:
             # Move all files into mailbag directory structure
             log.debug("Moving compantion files...")
+            errors = []
             for companion_file in companion_files:
-                new_path = format.moveWithDirectoryStructure(
-                    self.dry_run,
-                    self.keep,
-                    self.source_parent_dir,
-                    self.mailbag_dir,
-                    self.mailbag_name,
-                    self.format_name,
-                    companion_file,
-                    [],
-                )
+                new_path, errors = mover.move(companion_file, errors)
+
+        # Remove source directories that are empty now
+        mover.prune()
+
+
+def parse_eml(filePath, originalFile):
+    """
+    Parses a single EML file into an Email object. This is a module-level function
+    so EML.messages() can run it in worker processes.
+
+    Parameters:
+        filePath (String): Path to the EML file
+        originalFile (String): Path to the EML file relative to the provided path
+
+    Returns:
+        message (Email): Email model object defined in models.py
+    """
+    attachments = []
+    errors = []
+    try:
+        with open(filePath, "rb") as f:
+            # Keeps the bytes so worker processes pass them back instead of the parsed message
+            source = MessageSource(f.read(), email.policy.default)
+            msg = source.parse()
+
+            try:
+                # Parse message bodies
+                bodies = {}
+                bodies["html_body"] = None
+                bodies["text_body"] = None
+                bodies["html_encoding"] = None
+                bodies["text_encoding"] = None
+                if msg.is_multipart():
+                    for part in msg.walk():
+                        bodies, attachments, errors = format.parse_part(part, bodies, attachments, errors)
+                else:
+                    bodies, attachments, errors = format.parse_part(msg, bodies, attachments, errors)
+
+            except Exception as e:
+                desc = "Error parsing message parts"
+                errors = common.handle_error(errors, e, desc)
+
+            # Look for message arrangement
+            try:
+                messagePath = Path(format.messagePath(msg)).as_posix()
+                if messagePath == ".":
+                    messagePath = ""
+                unsafePath = os.path.join(os.path.dirname(originalFile), messagePath)
+                derivativesPath = common.normalizePath(unsafePath)
+            except Exception as e:
+                desc = "Error reading message path from headers"
+                errors = common.handle_error(errors, e, desc)
+
+            decoded_Message_ID, errors = format.parse_header(msg["message-id"], errors)
+            decoded_Date, errors = format.parse_header(msg["date"], errors)
+            decoded_From, errors = format.parse_header(msg["from"], errors)
+            decoded_To, errors = format.parse_header(msg["to"], errors)
+            decoded_Cc, errors = format.parse_header(msg["cc"], errors)
+            decoded_Bcc, errors = format.parse_header(msg["bcc"], errors)
+            decoded_Subject, errors = format.parse_header(msg["subject"], errors)
+
+            message = Email(
+                Errors=errors,
+                Message_ID=decoded_Message_ID,
+                Original_File=originalFile,
+                Message_Path=messagePath,
+                Derivatives_Path=derivativesPath,
+                Date=decoded_Date,
+                From=decoded_From,
+                To=decoded_To,
+                Cc=decoded_Cc,
+                Bcc=decoded_Bcc,
+                Subject=decoded_Subject,
+                Content_Type=msg.get_content_type(),
+                Headers=source,
+                HTML_Body=bodies["html_body"],
+                HTML_Encoding=bodies["html_encoding"],
+                Text_Body=bodies["text_body"],
+                Text_Encoding=bodies["text_encoding"],
+                Message=source,
+                Attachments=attachments,
+            )
+
+    except (email.errors.MessageParseError, Exception) as e:
+        desc = "Error parsing message"
+        errors = common.handle_error(errors, e, desc)
+        message = Email(Errors=errors)
+
+    return message
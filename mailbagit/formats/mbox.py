@@ -29,6 +29,7 @@ class Mbox(EmailAccount):
         self.path = args.path
         self.dry_run = args.dry_run
         self.keep = args.keep
+        self.keep_strategy = getattr(args, "keep_strategy", "auto")
         self.mailbag_name = mailbag_name
         self.mailbag_dir = mailbag_dir
         self.source_parent_dir = source_parent_dir
@@ -47,6 +48,9 @@ class Mbox(EmailAccount):
         return count
 
     def messages(self, iteration_only=False):
+        mover = format.FileMover(
+            self.dry_run, self.keep, self.source_parent_dir, self.mailbag_dir, self.mailbag_name, self.format_name, self.keep_strategy
+        )
 
         companion_files = []
         if os.path.isfile(self.path):
@@ -153,21 +157,14 @@ class Mbox(EmailAccount):
             # Move MBOX to new mailbag directory structure
             if not iteration_only:
                 # Does not check path lengths for MBOXs because `errors` was already returned to the controller
-                new_path, errors = format.moveWithDirectoryStructure(
-                    self.dry_run, self.keep, self.source_parent_dir, self.mailbag_dir, self.mailbag_name, self.format_name, filePath, errors
-                )
+                new_path, errors = mover.move(filePath, errors)
 
         if self.companion_files:
             # Move all files into mailbag directory structure
             log.debug("Moving compantion files...")
+            errors = []
             for companion_file in companion_files:
-                new_path = format.moveWithDirectoryStructure(
-                    self.dry_run,
-                    self.keep,
-                    self.source_parent_dir,
-                    self.mailbag_dir,
-                    self.mailbag_name,
-                    self.format_name,
-                    companion_file,
-                    [],
-                )
+                new_path, errors = mover.move(companion_file, errors)
+
+        # Remove source directories that are empty now
+        mover.prune()
@@ -1,4 +1,5 @@
 import extract_msg
+from extract_msg.enums import DeencapType
 import os
 from pathlib import Path
 from email import parser
@@ -14,6 +15,9 @@ import uuid
 
 log = get_logger()
 
+# The stream of the HTML body in MSG files, PidTagHtml
+MSG_HTML_BODY_STREAM = "__substg1.0_10130102"
+
 
 class MSG(EmailAccount):
     """MSG - This concrete class parses msg file format"""
@@ -30,10 +34,14 @@ class MSG(EmailAccount):
         self.path = args.path
         self.dry_run = args.dry_run
         self.keep = args.keep
+        self.keep_strategy = getattr(args, "keep_strategy", "auto")
         self.mailbag_name = mailbag_name
         self.mailbag_dir = mailbag_dir
         self.source_parent_dir = source_parent_dir
         self.companion_files = args.companion_files
+        self.processes = getattr(args, "processes", 1)
+        self.html_body = format.htmlBodyNeeded(args)
+        self._file_lists = None
 
         log.info("Reading: " + self.path)
 
@@ -42,210 +50,247 @@ class MSG(EmailAccount):
         return self._account_data
 
     @property
-    def number_of_messages(self):
-        count = 0
-        for _ in self.messages(iteration_only=True):
-            count += 1
-        return count
-
-    def messages(self, iteration_only=False):
-
-        companion_files = []
-        if os.path.isfile(self.path):
-            fileList = [self.path]
-        else:
-            fileList = []
-            for root, dirs, files in os.walk(self.path):
-                for file in files:
-                    mailbag_path = os.path.join(self.path, self.mailbag_name) + os.sep
-                    fileRoot = root + os.sep
-                    # don't count the newly-created mailbag
-                    if not fileRoot.startswith(mailbag_path):
-                        if file.lower().endswith("." + self.format_name):
-                            fileList.append(os.path.join(root, file))
-                        elif self.companion_files:
-                            companion_files.append(os.path.join(root, file))
+    def file_lists(self):
+        """MSG files and companion files in self.path. The source is only walked once and then cached."""
+        if self._file_lists is None:
+            self._file_lists = format.discoverFiles(
+                self.path,
+                self.mailbag_name,
+                lambda file: file.lower().endswith("." + self.format_name),
+                companion_files=self.companion_files,
+                processes=self.processes,
+            )
+        return self._file_lists
 
-        for filePath in fileList:
-            # Parse email matching the input file extension
+    @property
+    def number_of_messages(self):
+        return len(self.file_lists[0])
 
-            if iteration_only:
-                yield None
-                continue
+    def messages(self):
+        mover = format.FileMover(
+            self.dry_run, self.keep, self.source_parent_dir, self.mailbag_dir, self.mailbag_name, self.format_name, self.keep_strategy
+        )
+        fileList, companion_files = self.file_lists
 
+        jobs = []
+        for filePath in fileList:
             rel_path = format.relativePath(self.path, filePath)
             if len(rel_path) < 1:
                 originalFile = Path(filePath).name
             else:
                 originalFile = Path(os.path.normpath(rel_path)).as_posix()
-            # original file is now the relative path to the MBOX from the provided path
+            # original file is now the relative path to the MSG from the provided path
+            jobs.append((filePath, originalFile, self.html_body))
 
-            # originalFile = Path(format.relativePath(self.path, filePath)).as_posix()
+        # MSGs are parsed in worker processes, but moved here to keep moves in order
+        for (filePath, originalFile, html_body), message in zip(
+            jobs, format.parallelMessages(parse_msg, jobs, self.processes, lambda job: job[1])
+        ):
+            # Move MSG to new mailbag directory structure
+            new_path, errors = mover.move(filePath, [])
+            message.Errors.extend(errors)
+
+            yield message
 
-            attachments = []
+        if self.companion_files:
+            # Move all files into mailbag directory structure
+            log.debug("Moving compantion files...")
             errors = []
+            for companion_file in companion_files:
+                new_path, errors = mover.move(companion_file, errors)
+
+        # Remove source directories that are empty now
+        mover.prune()
+
+
+def deencapsulate_body(rtf_body, body_type):
+    """
+    Passed to extract_msg as deencapsulationFunc so bodies in MSG files are
+    de-encapsulated from RTF with the cached format.deencapsulate_rtf()
+
+    Parameters:
+        rtf_body (bytes): A decompressed RTF body
+        body_type (DeencapType): Whether extract_msg wants an HTML or plain text body
+
+    Returns:
+        body (bytes or str): HTML as bytes, plain text as a str, or None if the RTF doesn't contain that body type
+    """
+    try:
+        content_type, body = format.deencapsulate_rtf(rtf_body)
+    except Exception as e:
+        log.debug("Unable to de-encapsulate RTF body: " + repr(e))
+        return None
+    if body_type == DeencapType.HTML and content_type == "html":
+        return body
+    elif body_type == DeencapType.PLAIN and content_type == "text":
+        return body
+    return None
+
+
+def parse_msg(filePath, originalFile, html_body_needed=True):
+    """
+    Parses a single MSG file into an Email object. This is a module-level function
+    so MSG.messages() can run it in worker processes. The MSG file is always closed
+    before returning so OLE file handles do not pile up on large directories.
+
+    Parameters:
+        filePath (String): Path to the MSG file
+        originalFile (String): Path to the MSG file relative to the provided path
+        html_body_needed (Boolean): Whether to de-encapsulate HTML from the RTF body if there is no HTML body
+
+    Returns:
+        message (Email): Email model object defined in models.py
+    """
+    attachments = []
+    errors = []
+    mail = None
+    try:
+        mail = extract_msg.openMsg(filePath, deencapsulationFunc=deencapsulate_body)
+        # Parse message bodies
+        html_body = None
+        text_body = None
+        html_encoding = None
+        text_encoding = None
+        # encoding check priorities
+        encodings = {}
+        """
+        The listed values are apparently unreliable for HTML bodies.
+        Thus with the encodings dict empty, chardet will be used, which is apparently the least bad option.
+        try:
+            LIBPFF_ENTRY_TYPE_MESSAGE_BODY_CODEPAGE = int("0x3fde", base=16)
+            LIBPFF_ENTRY_TYPE_MESSAGE_CODEPAGE = int("0x3ffd", base=16)
+            message_body_codepage = extract_msg.encoding._CODE_PAGES[mail.getPropertyVal(LIBPFF_ENTRY_TYPE_MESSAGE_BODY_CODEPAGE)]
+            message_codepage = extract_msg.encoding._CODE_PAGES[mail.getPropertyVal(LIBPFF_ENTRY_TYPE_MESSAGE_CODEPAGE)]
+            encodings[1] = {"name": message_body_codepage, "label": "PidTagInternetCodepage"}
+            encodings[2] = {"name": message_codepage, "label": "PidTagMessageCodepage"}
+        except:
+            desc = "Error reading codepages"
+            errors = common.handle_error(errors, e, desc)
+        """
+        try:
             try:
-                mail = extract_msg.openMsg(filePath)
-                # Parse message bodies
-                html_body = None
-                text_body = None
-                html_encoding = None
-                text_encoding = None
-                # encoding check priorities
-                encodings = {}
-                """
-                The listed values are apparently unreliable for HTML bodies.
-                Thus with the encodings dict empty, chardet will be used, which is apparently the least bad option.
-                try:
-                    LIBPFF_ENTRY_TYPE_MESSAGE_BODY_CODEPAGE = int("0x3fde", base=16)
-                    LIBPFF_ENTRY_TYPE_MESSAGE_CODEPAGE = int("0x3ffd", base=16)
-                    message_body_codepage = extract_msg.encoding._CODE_PAGES[mail.getPropertyVal(LIBPFF_ENTRY_TYPE_MESSAGE_BODY_CODEPAGE)]
-                    message_codepage = extract_msg.encoding._CODE_PAGES[mail.getPropertyVal(LIBPFF_ENTRY_TYPE_MESSAGE_CODEPAGE)]
-                    encodings[1] = {"name": message_body_codepage, "label": "PidTagInternetCodepage"}
-                    encodings[2] = {"name": message_codepage, "label": "PidTagMessageCodepage"}
-                except:
-                    desc = "Error reading codepages"
-                    errors = common.handle_error(errors, e, desc)
-                """
-                try:
-                    try:
-                        if mail.htmlBody:
-                            html_body, html_encoding, errors = format.safely_decode("HTML", mail.htmlBody, encodings, errors)
-                    except Exception as e:
-                        desc = "Error parsing HTML body"
-                        errors = common.handle_error(errors, e, desc)
-                    if mail.body:
-                        text_body = mail.body
-                        text_encoding = mail.stringEncoding
-                except Exception as e:
-                    desc = "Error parsing message body"
-                    errors = common.handle_error(errors, e, desc)
+                # extract_msg de-encapsulates HTML from the RTF body if there isn't one, so only read the HTML stream unless it's needed
+                if html_body_needed:
+                    mail_html_body = mail.htmlBody
+                else:
+                    mail_html_body = mail.getStream(MSG_HTML_BODY_STREAM)
+                if mail_html_body:
+                    html_body, html_encoding, errors = format.safely_decode("HTML", mail_html_body, encodings, errors)
+            except Exception as e:
+                desc = "Error parsing HTML body"
+                errors = common.handle_error(errors, e, desc)
+            if mail.body:
+                text_body = mail.body
+                text_encoding = mail.stringEncoding
+        except Exception as e:
+            desc = "Error parsing message body"
+            errors = common.handle_error(errors, e, desc)
 
-                # Look for message arrangement
+        # Look for message arrangement
+        try:
+            messagePath = Path(format.messagePath(mail.header)).as_posix()
+            if messagePath == ".":
+                messagePath = ""
+            unsafePath = os.path.join(os.path.dirname(originalFile), messagePath)
+            derivativesPath = Path(common.normalizePath(unsafePath)).as_posix()
+        except Exception as e:
+            desc = "Error reading message path from headers"
+            errors = common.handle_error(errors, e, desc)
+
+        try:
+            for i, mailAttachment in enumerate(mail.attachments):
+                if mailAttachment.getFilename():
+                    attachmentName = mailAttachment.getFilename()
+                elif mailAttachment.longFilename:
+                    attachmentName = mailAttachment.longFilename
+                elif mailAttachment.shortFilename:
+                    attachmentName = mailAttachment.shortFilename
+                else:
+                    attachmentName = None
+                    desc = "No filename found for attachment, integer will be used instead"
+                    errors = common.handle_error(errors, None, desc)
+
+                # Handle attachments.csv conflict
+                # helper.controller.writeAttachmentsToDisk() handles this
+                if attachmentName:
+                    if attachmentName.lower() == "attachments.csv":
+                        desc = "attachment " + attachmentName + " will be renamed to avoid filename conflict with mailbag spec"
+                        errors = common.handle_error(errors, None, desc, "warn")
+                        attachmentWrittenName = str(i) + os.path.splitext(attachmentName)[1]
+                    else:
+                        attachmentWrittenName = common.normalizePath(attachmentName.replace("/", "%2F"))
+                else:
+                    attachmentWrittenName = str(i)
+
+                # Try to get the mime, guess it if this doesn't work
+                mime = None
                 try:
-                    messagePath = Path(format.messagePath(mail.header)).as_posix()
-                    if messagePath == ".":
-                        messagePath = ""
-                    unsafePath = os.path.join(os.path.dirname(originalFile), messagePath)
-                    derivativesPath = Path(common.normalizePath(unsafePath)).as_posix()
+                    mime = mailAttachment.mimetype
                 except Exception as e:
-                    desc = "Error reading message path from headers"
-                    errors = common.handle_error(errors, e, desc)
+                    desc = "Error reading mime type, guessing it instead"
+                    errors = common.handle_error(errors, e, desc, "warn")
+                if mime is None:
+                    if attachmentName:
+                        mime = format.guessMimeType(attachmentName)
+                    else:
+                        desc = "Mimetype not found. Setting it to 'application/octet-stream'"
+                        errors = common.handle_error(errors, None, desc, "warn")
+                        mime = "application/octet-stream"
 
+                contentID = None
                 try:
-                    for i, mailAttachment in enumerate(mail.attachments):
-                        if mailAttachment.getFilename():
-                            attachmentName = mailAttachment.getFilename()
-                        elif mailAttachment.longFilename:
-                            attachmentName = mailAttachment.longFilename
-                        elif mailAttachment.shortFilename:
-                            attachmentName = mailAttachment.shortFilename
-                        else:
-                            attachmentName = None
-                            desc = "No filename found for attachment, integer will be used instead"
-                            errors = common.handle_error(errors, None, desc)
-
-                        # Handle attachments.csv conflict
-                        # helper.controller.writeAttachmentsToDisk() handles this
-                        if attachmentName:
-                            if attachmentName.lower() == "attachments.csv":
-                                desc = "attachment " + attachmentName + " will be renamed to avoid filename conflict with mailbag spec"
-                                errors = common.handle_error(errors, None, desc, "warn")
-                                attachmentWrittenName = str(i) + os.path.splitext(attachmentName)[1]
-                            else:
-                                attachmentWrittenName = common.normalizePath(attachmentName.replace("/", "%2F"))
-                        else:
-                            attachmentWrittenName = str(i)
-
-                        # Try to get the mime, guess it if this doesn't work
-                        mime = None
-                        try:
-                            mime = mailAttachment.mimetype
-                        except Exception as e:
-                            desc = "Error reading mime type, guessing it instead"
-                            errors = common.handle_error(errors, e, desc, "warn")
-                        if mime is None:
-                            if attachmentName:
-                                mime = format.guessMimeType(attachmentName)
-                            else:
-                                desc = "Mimetype not found. Setting it to 'application/octet-stream'"
-                                errors = common.handle_error(errors, None, desc, "warn")
-                                mime = "application/octet-stream"
-
-                        contentID = None
-                        try:
-                            contentID = mailAttachment.contentId
-                        except Exception as e:
-                            desc = "Error reading ContentID, creating an ID instead"
-                            errors = common.handle_error(errors, e, desc, "warn")
-                        if contentID is None:
-                            contentID = uuid.uuid4().hex
-
-                        attachment = Attachment(
-                            Name=attachmentName,
-                            WrittenName=attachmentWrittenName,
-                            File=mailAttachment.data,
-                            MimeType=mime,
-                            Content_ID=contentID,
-                        )
-                        attachments.append(attachment)
-
+                    contentID = mailAttachment.contentId
                 except Exception as e:
-                    desc = "Error parsing attachments"
-                    errors = common.handle_error(errors, e, desc)
-
-                message = Email(
-                    Errors=errors,
-                    Message_ID=mail.messageId,
-                    Original_File=originalFile,
-                    Message_Path=messagePath,
-                    Derivatives_Path=derivativesPath,
-                    Date=str(mail.date),
-                    From=mail.sender,
-                    To=mail.to,
-                    Cc=mail.cc,
-                    Bcc=mail.bcc,
-                    Subject=mail.subject,
-                    Content_Type=mail.header.get_content_type(),
-                    # mail.header appears to be a headers object oddly enough
-                    Headers=mail.header,
-                    HTML_Body=html_body,
-                    HTML_Encoding=html_encoding,
-                    Text_Body=text_body,
-                    Text_Encoding=text_encoding,
-                    # Doesn't look like we can feasibly get a full email.message.Message object for .msg
-                    Message=None,
-                    Attachments=attachments,
+                    desc = "Error reading ContentID, creating an ID instead"
+                    errors = common.handle_error(errors, e, desc, "warn")
+                if contentID is None:
+                    contentID = uuid.uuid4().hex
+
+                attachment = Attachment(
+                    Name=attachmentName,
+                    WrittenName=attachmentWrittenName,
+                    File=mailAttachment.data,
+                    MimeType=mime,
+                    Content_ID=contentID,
                 )
-                # Make sure the MSG file is closed
-                mail.close()
+                attachments.append(attachment)
 
-            except (email.errors.MessageParseError, Exception) as e:
-                desc = "Error parsing message"
-                errors = common.handle_error(errors, e, desc)
-                message = Email(Errors=errors)
-                # Make sure the MSG file is closed
-                mail.close()
+        except Exception as e:
+            desc = "Error parsing attachments"
+            errors = common.handle_error(errors, e, desc)
 
-            # Move MSG to new mailbag directory structure
-            new_path, errors = format.moveWithDirectoryStructure(
-                self.dry_run, self.keep, self.source_parent_dir, self.mailbag_dir, self.mailbag_name, self.format_name, filePath, errors
-            )
-            message.Errors.extend(errors)
+        message = Email(
+            Errors=errors,
+            Message_ID=mail.messageId,
+            Original_File=originalFile,
+            Message_Path=messagePath,
+            Derivatives_Path=derivativesPath,
+            Date=str(mail.date),
+            From=mail.sender,
+            To=mail.to,
+            Cc=mail.cc,
+            Bcc=mail.bcc,
+            Subject=mail.subject,
+            Content_Type=mail.header.get_content_type(),
+            # mail.header appears to be a headers object oddly enough
+            Headers=mail.header,
+            HTML_Body=html_body,
+            HTML_Encoding=html_encoding,
+            Text_Body=text_body,
+            Text_Encoding=text_encoding,
+            # Doesn't look like we can feasibly get a full email.message.Message object for .msg
+            Message=None,
+            Attachments=attachments,
+        )
 
-            yield message
+    except (email.errors.MessageParseError, Exception) as e:
+        desc = "Error parsing message"
+        errors = common.handle_error(errors, e, desc)
+        message = Email(Errors=errors)
 
-        if self.companion_files:
-            # Move all files into mailbag directory structure
-            log.debug("Moving compantion files...")
-            for companion_file in companion_files:
-                new_path = format.moveWithDirectoryStructure(
-                    self.dry_run,
-                    self.keep,
-                    self.source_parent_dir,
-                    self.mailbag_dir,
-                    self.mailbag_name,
-                    self.format_name,
-                    companion_file,
-                    [],
-                )
+    finally:
+        # Make sure the MSG file is closed, even if openMsg() or parsing failed
+        if mail is not None:
+            mail.close()
+
+    return message
@@ -1,9 +1,7 @@
 import os
 import email
 from pathlib import Path
-import chardet
 from extract_msg.encoding import _CODE_PAGES
-from RTFDE.deencapsulate import DeEncapsulator
 from mailbagit.loggerx import get_logger
 from mailbagit.email_account import EmailAccount
 from mailbagit.models import Email, Attachment
@@ -21,8 +19,284 @@ except:
 
 log = get_logger()
 
+# Entry types found here: https://github.com/libyal/libpff/blob/main/libpff/libpff_mapi.h#L333-L335
+# Docs say to use MESSAGE_CODEPAGE: https://github.com/libyal/libfmapi/blob/main/documentation/MAPI%20definitions.asciidoc#51-the-message-body
+LIBPFF_ENTRY_TYPE_MESSAGE_BODY_CODEPAGE = int("0x3fde", base=16)
+LIBPFF_ENTRY_TYPE_MESSAGE_CODEPAGE = int("0x3ffd", base=16)
+LIBPFF_ENTRY_TYPE_ATTACHMENT_FILENAME_LONG = int("0x3707", base=16)
+LIBPFF_ENTRY_TYPE_ATTACHMENT_FILENAME_SHORT = int("0x3704", base=16)
+LIBPFF_ENTRY_TYPE_ATTACHMENT_MIME_TAG = int("0x370e", base=16)
+
 if not skip_registry:
 
+    def read_entries(item):
+        """
+        Reads the record set entries of a PST message or attachment in a single pass
+
+        Parameters:
+            item (pypff.message or pypff.attachment): The item to read entries from
+
+        Returns:
+            entries (dict): Entries that contain data, keyed by entry type.
+                If an entry type occurs more than once, the last one is used.
+        """
+        entries = {}
+        for record_set in item.record_sets:
+            for entry in record_set.entries:
+                if entry.data:
+                    entries[entry.entry_type] = entry
+        return entries
+
+    # Folders with more messages than this are split into several jobs for parallel parsing
+    PST_CHUNK_SIZE = 50
+    # pypff handles opened by parse_folder_messages() in each worker process, keyed by PST path
+    open_psts = {}
+
+    def parse_message(folder, index, path, originalFile, html_body_needed=True, spool_dir=None):
+        """
+        Parses a single message in a PST folder into an Email object
+
+        Parameters:
+            folder (pypff.folder): The email folder containing the message
+            index (int): Index of the message in the folder
+            path (String): The email folder path of the message, separated by "/"
+            originalFile (String): Path to the PST file relative to the provided path
+            html_body_needed (Boolean): Whether to de-encapsulate HTML from RTF bodies if there is no HTML body
+            spool_dir (String): Directory for temporary files holding large attachments
+
+        Returns:
+            message (Email): Email model object defined in models.py
+        """
+        attachments = []
+        # Temporary files holding large attachments, which are removed if the attachments are not added to the message
+        spool_paths = []
+        errors = []
+        try:
+            messageObj = folder.get_sub_message(index)
+
+            try:
+                headerParser = email.parser.HeaderParser()
+                if messageObj.transport_headers:
+                    headers = headerParser.parsestr(messageObj.transport_headers)
+                else:
+                    # often returns none for deleted and sent items in OSTs
+                    desc = "Unable to read headers. An empty headers object will be created."
+                    errors = common.handle_error(errors, None, desc)
+                    # just make an empty object
+                    headers = headerParser.parsestr("headers: not found")
+            except Exception as e:
+                desc = "Error parsing message body"
+                errors = common.handle_error(errors, e, desc)
+
+            try:
+                # Parse message bodies
+                html_body = None
+                text_body = None
+                html_encoding = None
+                text_encoding = None
+
+                # Codepages are 32bit encoded integers
+                encodings = {}
+                entries = read_entries(messageObj)
+                if LIBPFF_ENTRY_TYPE_MESSAGE_BODY_CODEPAGE in entries:
+                    value = entries[LIBPFF_ENTRY_TYPE_MESSAGE_BODY_CODEPAGE].get_data_as_integer()
+                    # Use the extract_msg code page in constants.py
+                    encodings[1] = {"name": _CODE_PAGES[value], "label": "PidTagInternetCodepage"}
+                if LIBPFF_ENTRY_TYPE_MESSAGE_CODEPAGE in entries:
+                    value = entries[LIBPFF_ENTRY_TYPE_MESSAGE_CODEPAGE].get_data_as_integer()
+                    # Use the extract_msg code page in constants.py
+                    encodings[2] = {"name": _CODE_PAGES[value], "label": "PidTagMessageCodepage"}
+                # messageObj.html_body sometimes fails. This seems to often be the case for email in "Deleted Items"
+                try:
+                    if messageObj.html_body:
+                        html_body, html_encoding, errors = format.safely_decode("HTML", messageObj.html_body, encodings, errors)
+                    elif html_body_needed and messageObj.rtf_body:
+                        # Try to pull the HTML out of the RTF body
+                        # HT to extract_msg for this https://github.com/TeamMsgExtractor/msg-extractor/blob/3cffc2e0d82a0301cfaca2b05c5ef35bfc96a8cb/extract_msg/message_base.py#L958
+                        # This is skipped if no requested derivatives use HTML bodies
+                        try:
+                            content_type, deencapsulated_body = format.deencapsulate_rtf(messageObj.rtf_body)
+                            if content_type == "html":
+                                html_body, html_encoding, errors = format.safely_decode("HTML", deencapsulated_body, encodings, errors)
+                        except Exception as e:
+                            desc = "Error parsing RTF body"
+                            errors = common.handle_error(errors, e, desc)
+                except Exception as e:
+                    desc = "Error parsing HTML or RTF body"
+                    errors = common.handle_error(errors, e, desc)
+                if messageObj.plain_text_body:
+                    encodings[len(encodings.keys()) + 1] = {
+                        "name": "utf-8",
+                        "label": "manual",
+                    }
+                    text_body, text_encoding, errors = format.safely_decode("plain text", messageObj.plain_text_body, encodings, errors)
+
+            except Exception as e:
+                desc = "Error parsing message body"
+                errors = common.handle_error(errors, e, desc)
+
+            # Build message and derivatives paths
+            try:
+                messagePath = path
+                if len(messagePath) > 0:
+                    messagePath = Path(messagePath).as_posix()
+                derivativesPath = Path(os.path.splitext(originalFile)[0], common.normalizePath(messagePath)).as_posix()
+            except Exception as e:
+                desc = "Error reading message path"
+                errors = common.handle_error(errors, e, desc)
+
+            try:
+                total_attachment_size_bytes = 0
+                for i, attachmentObj in enumerate(messageObj.attachments):
+                    attachment_size = attachmentObj.get_size()
+                    total_attachment_size_bytes = total_attachment_size_bytes + attachment_size
+                    # large attachments are streamed to a temporary file instead of being read into memory at once
+                    attachment_content, attachment_path = format.readAttachment(attachmentObj.read_buffer, attachment_size, spool_dir)
+                    if attachment_path:
+                        spool_paths.append(attachment_path)
+
+                    attachmentName = None
+                    try:
+                        # attachmentName = attachmentObj.get_name()
+                        attachmentLong = ""
+                        attachmentShort = ""
+                        mime = None
+                        entries = read_entries(attachmentObj)
+                        if LIBPFF_ENTRY_TYPE_ATTACHMENT_FILENAME_LONG in entries:
+                            attachmentLong = entries[LIBPFF_ENTRY_TYPE_ATTACHMENT_FILENAME_LONG].get_data_as_string()
+                        if LIBPFF_ENTRY_TYPE_ATTACHMENT_FILENAME_SHORT in entries:
+                            attachmentShort = entries[LIBPFF_ENTRY_TYPE_ATTACHMENT_FILENAME_SHORT].get_data_as_string()
+                        if LIBPFF_ENTRY_TYPE_ATTACHMENT_MIME_TAG in entries:
+                            mime = entries[LIBPFF_ENTRY_TYPE_ATTACHMENT_MIME_TAG].get_data_as_string()
+                        # Use the Long filename preferably
+                        if len(attachmentLong) > 0:
+                            attachmentName = attachmentLong
+                        elif len(attachmentShort) > 0:
+                            attachmentName = attachmentShort
+                        else:
+                            attachmentName = None
+                            desc = "No filename found for attachment, integer will be used instead"
+                            errors = common.handle_error(errors, None, desc)
+
+                        # Handle attachments.csv conflict
+                        # helper.controller.writeAttachmentsToDisk() handles this
+                        if attachmentName:
+                            if attachmentName.lower() == "attachments.csv":
+                                desc = "attachment " + attachmentName + " will be renamed to avoid filename conflict with mailbag spec"
+                                errors = common.handle_error(errors, None, desc, "warn")
+                                attachmentWrittenName = str(i) + os.path.splitext(attachmentName)[1]
+                            else:
+                                attachmentWrittenName = common.normalizePath(attachmentName.replace("/", "%2F"))
+                        else:
+                            attachmentWrittenName = str(i)
+
+                        # Guess the mime if we can't find it
+                        if mime is None:
+                            if attachmentName:
+                                mime = format.guessMimeType(attachmentName)
+                            else:
+                                desc = "Mimetype not found. Setting it to 'application/octet-stream'"
+                                errors = common.handle_error(errors, None, desc, "warn")
+                                mime = "application/octet-stream"
+
+                        # MSGs & PSTs don't seem to have a reliable content ID so we make one since emails may have multiple attachments with the same filename
+                        contentID = uuid.uuid4().hex
+
+                    except Exception as e:
+                        attachmentName = str(len(attachments))
+                        desc = "No filename found for attachment " + attachmentName + " for message " + str(headers["Message-ID"])
+                        errors = common.handle_error(errors, e, desc)
+
+                    attachment = Attachment(
+                        Name=attachmentName,
+                        WrittenName=attachmentWrittenName,
+                        File=attachment_content,
+                        FilePath=attachment_path,
+                        MimeType=mime,
+                        Content_ID=contentID,
+                    )
+                    attachments.append(attachment)
+
+            except Exception as e:
+                desc = "Error parsing attachments"
+                errors = common.handle_error(errors, e, desc)
+                format.removeSpooled(set(spool_paths) - set(attachment.FilePath for attachment in attachments))
+
+            decoded_Message_ID, errors = format.parse_header(headers["Message-ID"], errors)
+            decoded_Date, errors = format.parse_header(headers["Date"], errors)
+            decoded_From, errors = format.parse_header(headers["From"], errors)
+            decoded_To, errors = format.parse_header(headers["To"], errors)
+            decoded_Cc, errors = format.parse_header(headers["Cc"], errors)
+            decoded_Bcc, errors = format.parse_header(headers["Bcc"], errors)
+            decoded_Subject, errors = format.parse_header(headers["Subject"], errors)
+
+            message = Email(
+                Errors=errors,
+                Message_ID=decoded_Message_ID,
+                Original_File=originalFile,
+                Message_Path=messagePath,
+                Derivatives_Path=derivativesPath,
+                Date=decoded_Date,
+                From=decoded_From,
+                To=decoded_To,
+                Cc=decoded_Cc,
+                Bcc=decoded_Bcc,
+                Subject=decoded_Subject,
+                Content_Type=headers.get_content_type(),
+                Headers=headers,
+                HTML_Body=html_body,
+                HTML_Encoding=html_encoding,
+                Text_Body=text_body,
+                Text_Encoding=text_encoding,
+                Message=None,
+                Attachments=attachments,
+            )
+
+        except (Exception) as e:
+            desc = "Error parsing message"
+            errors = common.handle_error(errors, e, desc)
+            format.removeSpooled(spool_paths)
+            message = Email(Errors=errors)
+
+        return message
+
+    def parse_folder_messages(filePath, folder_indexes, path, originalFile, start, stop, html_body_needed=True, spool_dir=None):
+        """
+        Parses a range of messages in a PST folder for parallelMessages().
+        Each worker process opens its own pypff handle for a PST and keeps it open for later jobs on the same file.
+
+        Parameters:
+            filePath (String): Path to the PST file
+            folder_indexes (tuple): Sub folder indexes leading from the root folder to the email folder
+            path (String): The email folder path of the messages, separated by "/"
+            originalFile (String): Path to the PST file relative to the provided path
+            start (int): Index of the first message to parse
+            stop (int): Index after the last message to parse
+            html_body_needed (Boolean): Whether to de-encapsulate HTML from RTF bodies if there is no HTML body
+            spool_dir (String): Directory for temporary files holding large attachments
+
+        Returns:
+            messages (List): Email model objects defined in models.py
+        """
+        if filePath not in open_psts:
+            pst = pypff.file()
+            pst.open(filePath)
+            open_psts[filePath] = pst
+        folder = open_psts[filePath].get_root_folder()
+        for folder_index in folder_indexes:
+            folder = folder.get_sub_folder(folder_index)
+        if start == 0:
+            log.debug("Reading folder: " + folder.name)
+        return [parse_message(folder, index, path, originalFile, html_body_needed, spool_dir) for index in range(start, stop)]
+
+    def close_psts():
+        """
+        Closes any pypff handles opened by parse_folder_messages() in this process
+        """
+        for pst in open_psts.values():
+            pst.close()
+        open_psts.clear()
+
     class PST(EmailAccount):
         # pst - This concrete class parses PST file format
         format_name = "pst"
@@ -40,10 +314,17 @@ if not skip_registry:
             self.path = args.path
             self.dry_run = args.dry_run
             self.keep = args.keep
+            self.keep_strategy = getattr(args, "keep_strategy", "auto")
             self.mailbag_name = mailbag_name
             self.mailbag_dir = mailbag_dir
             self.source_parent_dir = source_parent_dir
             self.companion_files = args.companion_files
+            self.html_body = format.htmlBodyNeeded(args)
+            # Large attachments are spooled next to the mailbag instead of the default temporary directory
+            self.spool_dir = os.path.dirname(os.path.abspath(mailbag_dir))
+            self.processes = getattr(args, "processes", 1)
+            self._file_lists = None
+            self._census = None
             log.info("Reading: " + self.path)
             self.count = 0
 
@@ -51,282 +332,93 @@ if not skip_registry:
         def account_data(self):
             return self._account_data
 
+        @property
+        def file_lists(self):
+            if self._file_lists is None:
+                self._file_lists = format.discoverFiles(
+                    self.path,
+                    self.mailbag_name,
+                    lambda name: name.lower().endswith("." + self.format_name),
+                    self.companion_files,
+                    self.processes,
+                )
+            return self._file_lists
+
+        @property
+        def census(self):
+            # Counts the messages in every email folder of each PST without reading any messages
+            # returns a dict of PST paths to a dict of:
+            #   "folders": a list of (folder indexes, folder path, number of messages) for each folder with messages, in traversal order
+            #   "empty_folders": a list of folder paths that do not contain any messages or subfolders
+            if self._census is None:
+                self._census = {}
+                for filePath in self.file_lists[0]:
+                    folders = []
+                    empty_folders = []
+                    pst = pypff.file()
+                    pst.open(filePath)
+                    root = pst.get_root_folder()
+                    for folder_index, folder in enumerate(root.sub_folders):
+                        if folder.number_of_sub_folders:
+                            # call recursive function to count email folder
+                            self.count_folder(folder, (folder_index,), folder.name, folders, empty_folders)
+                        else:
+                            empty_folders.append(folder.name)
+                    pst.close()
+                    self._census[filePath] = {"folders": folders, "empty_folders": empty_folders}
+            return self._census
+
         @property
         def number_of_messages(self):
             count = 0
-            for _ in self.messages(iteration_only=True):
-                count += 1
+            for pst_census in self.census.values():
+                for folder_indexes, path, message_count in pst_census["folders"]:
+                    count += message_count
             return count
 
-        def folders(self, folder, path, originalFile, iteration_only=False):
+        def count_folder(self, folder, folder_indexes, path, folders, empty_folders):
+            # recursive function that calls itself on any subfolders
+            # folder_indexes are the sub folder indexes leading from the root folder to this folder
+            # path is the email folder path of the message, separated by "/"
+            if folder.number_of_sub_messages:
+                folders.append((folder_indexes, path, folder.number_of_sub_messages))
+
+            # iterate over any subfolders too
+            if folder.number_of_sub_folders:
+                for folder_index in range(folder.number_of_sub_folders):
+                    subfolder = folder.get_sub_folder(folder_index)
+                    self.count_folder(subfolder, folder_indexes + (folder_index,), path + "/" + subfolder.name, folders, empty_folders)
+            elif not folder.number_of_sub_messages:
+                empty_folders.append(path)
+
+        def folders(self, folder, path, originalFile):
             # recursive function that calls itself on any subfolders and
-            # returns a generator of messages
+            # returns a generator of messages parsed in this process
             # path is the email folder path of the message, separated by "/"
             if folder.number_of_sub_messages:
                 log.debug("Reading folder: " + folder.name)
                 for index in range(folder.number_of_sub_messages):
-
-                    if iteration_only:
-                        yield None
-                        continue
-                    attachments = []
-                    errors = []
-                    try:
-                        messageObj = folder.get_sub_message(index)
-
-                        try:
-                            headerParser = email.parser.HeaderParser()
-                            if messageObj.transport_headers:
-                                headers = headerParser.parsestr(messageObj.transport_headers)
-                            else:
-                                # often returns none for deleted and sent items in OSTs
-                                desc = "Unable to read headers. An empty headers object will be created."
-                                errors = common.handle_error(errors, None, desc)
-                                # just make an empty object
-                                headers = headerParser.parsestr("headers: not found")
-                        except Exception as e:
-                            desc = "Error parsing message body"
-                            errors = common.handle_error(errors, e, desc)
-
-                        try:
-                            # Parse message bodies
-                            html_body = None
-                            text_body = None
-                            html_encoding = None
-                            text_encoding = None
-
-                            # Codepage integers found here: https://github.com/libyal/libpff/blob/main/libpff/libpff_mapi.h#L333-L335
-                            # Docs say to use MESSAGE_CODEPAGE: https://github.com/libyal/libfmapi/blob/main/documentation/MAPI%20definitions.asciidoc#51-the-message-body
-                            # this is a 32bit encoded integer
-                            encodings = {}
-                            LIBPFF_ENTRY_TYPE_MESSAGE_BODY_CODEPAGE = int("0x3fde", base=16)
-                            LIBPFF_ENTRY_TYPE_MESSAGE_CODEPAGE = int("0x3ffd", base=16)
-                            for record_set in messageObj.record_sets:
-                                for entry in record_set.entries:
-                                    if entry.entry_type == LIBPFF_ENTRY_TYPE_MESSAGE_BODY_CODEPAGE:
-                                        if entry.data:
-                                            value = entry.get_data_as_integer()
-                                            # Use the extract_msg code page in constants.py
-                                            encodings[1] = {"name": _CODE_PAGES[value], "label": "PidTagInternetCodepage"}
-                                    if entry.entry_type == LIBPFF_ENTRY_TYPE_MESSAGE_CODEPAGE:
-                                        if entry.data:
-                                            value = entry.get_data_as_integer()
-                                            # Use the extract_msg code page in constants.py
-                                            encodings[2] = {"name": _CODE_PAGES[value], "label": "PidTagMessageCodepage"}
-                            # messageObj.html_body sometimes fails. This seems to often be the case for email in "Deleted Items"
-                            try:
-                                if messageObj.html_body:
-                                    html_body, html_encoding, errors = format.safely_decode("HTML", messageObj.html_body, encodings, errors)
-                                elif messageObj.rtf_body:
-                                    # Try to pull the HTML out of the RTF body
-                                    # HT to extract_msg for this https://github.com/TeamMsgExtractor/msg-extractor/blob/3cffc2e0d82a0301cfaca2b05c5ef35bfc96a8cb/extract_msg/message_base.py#L958
-                                    rtf_body = messageObj.rtf_body
-                                    # I dunno why this needs a len of 125 ¯\_(ツ)_/¯
-                                    while rtf_body and rtf_body[-1] != 125:
-                                        rtf_body = rtf_body[:-1]
-                                    # decode it before using DeEncapsulator
-                                    rtf_string, html_encoding, errors = format.safely_decode("HTML", rtf_body, encodings, errors)
-
-                                    # Some sort of encoding issue can cause multiple EOF characters which is malformed RTF
-                                    """
-                                    eof_index = rtf_string.find('\x1a')
-                                    self.count += 1
-                                    if eof_index != -1:
-                                        print (rtf_string.count('\x1a'))
-                                    """
-
-                                    try:
-                                        deencapsulated_body = DeEncapsulator(rtf_body)
-                                        deencapsulated_body.deencapsulate()
-                                        html_body, html_encoding, errors = format.safely_decode(
-                                            "HTML", deencapsulated_body.html, encodings, errors
-                                        )
-                                        # html_body = deencapsulated_body.html.decode(html_encoding)
-                                    except Exception as e:
-                                        desc = "Error parsing RTF body"
-                                        errors = common.handle_error(errors, e, desc)
-                            except Exception as e:
-                                desc = "Error parsing HTML or RTF body"
-                                errors = common.handle_error(errors, e, desc)
-                            if messageObj.plain_text_body:
-                                encodings[len(encodings.keys()) + 1] = {
-                                    "name": "utf-8",
-                                    "label": "manual",
-                                }
-                                encodings[len(encodings.keys()) + 2] = {
-                                    "name": chardet.detect(messageObj.plain_text_body)["encoding"],
-                                    "label": "detected",
-                                }
-                                text_body, text_encoding, errors = format.safely_decode(
-                                    "plain text", messageObj.plain_text_body, encodings, errors
-                                )
-
-                        except Exception as e:
-                            desc = "Error parsing message body"
-                            errors = common.handle_error(errors, e, desc)
-
-                        # Build message and derivatives paths
-                        try:
-                            messagePath = path
-                            if len(messagePath) > 0:
-                                messagePath = Path(messagePath).as_posix()
-                            derivativesPath = Path(os.path.splitext(originalFile)[0], common.normalizePath(messagePath)).as_posix()
-                        except Exception as e:
-                            desc = "Error reading message path"
-                            errors = common.handle_error(errors, e, desc)
-
-                        try:
-                            total_attachment_size_bytes = 0
-                            for i, attachmentObj in enumerate(messageObj.attachments):
-                                total_attachment_size_bytes = total_attachment_size_bytes + attachmentObj.get_size()
-                                attachment_content = attachmentObj.read_buffer(attachmentObj.get_size())
-
-                                attachmentName = None
-                                try:
-                                    # attachmentName = attachmentObj.get_name()
-                                    # Entries found here: https://github.com/libyal/libpff/blob/main/libpff/libpff_mapi.h#L333-L335
-                                    LIBPFF_ENTRY_TYPE_ATTACHMENT_FILENAME_LONG = int("0x3707", base=16)
-                                    LIBPFF_ENTRY_TYPE_ATTACHMENT_FILENAME_SHORT = int("0x3704", base=16)
-                                    LIBPFF_ENTRY_TYPE_ATTACHMENT_MIME_TAG = int("0x370e", base=16)
-                                    attachmentLong = ""
-                                    attachmentShort = ""
-                                    mime = None
-                                    for record_set in attachmentObj.record_sets:
-                                        for entry in record_set.entries:
-                                            if entry.entry_type == LIBPFF_ENTRY_TYPE_ATTACHMENT_FILENAME_LONG:
-                                                if entry.data:
-                                                    attachmentLong = entry.get_data_as_string()
-                                            if entry.entry_type == LIBPFF_ENTRY_TYPE_ATTACHMENT_FILENAME_SHORT:
-                                                if entry.data:
-                                                    attachmentShort = entry.get_data_as_string()
-                                            if entry.entry_type == LIBPFF_ENTRY_TYPE_ATTACHMENT_MIME_TAG:
-                                                if entry.data:
-                                                    mime = entry.get_data_as_string()
-                                    # Use the Long filename preferably
-                                    if len(attachmentLong) > 0:
-                                        attachmentName = attachmentLong
-                                    elif len(attachmentShort) > 0:
-                                        attachmentName = attachmentShort
-                                    else:
-                                        attachmentName = None
-                                        desc = "No filename found for attachment, integer will be used instead"
-                                        errors = common.handle_error(errors, None, desc)
-
-                                    # Handle attachments.csv conflict
-                                    # helper.controller.writeAttachmentsToDisk() handles this
-                                    if attachmentName:
-                                        if attachmentName.lower() == "attachments.csv":
-                                            desc = (
-                                                "attachment "
-                                                + attachmentName
-                                                + " will be renamed to avoid filename conflict with mailbag spec"
-                                            )
-                                            errors = common.handle_error(errors, None, desc, "warn")
-                                            attachmentWrittenName = str(i) + os.path.splitext(attachmentName)[1]
-                                        else:
-                                            attachmentWrittenName = common.normalizePath(attachmentName.replace("/", "%2F"))
-                                    else:
-                                        attachmentWrittenName = str(i)
-
-                                    # Guess the mime if we can't find it
-                                    if mime is None:
-                                        if attachmentName:
-                                            mime = format.guessMimeType(attachmentName)
-                                        else:
-                                            desc = "Mimetype not found. Setting it to 'application/octet-stream'"
-                                            errors = common.handle_error(errors, None, desc, "warn")
-                                            mime = "application/octet-stream"
-
-                                    # MSGs & PSTs don't seem to have a reliable content ID so we make one since emails may have multiple attachments with the same filename
-                                    contentID = uuid.uuid4().hex
-
-                                except Exception as e:
-                                    attachmentName = str(len(attachments))
-                                    desc = (
-                                        "No filename found for attachment " + attachmentName + " for message " + str(headers["Message-ID"])
-                                    )
-                                    errors = common.handle_error(errors, e, desc)
-
-                                attachment = Attachment(
-                                    Name=attachmentName,
-                                    WrittenName=attachmentWrittenName,
-                                    File=attachment_content,
-                                    MimeType=mime,
-                                    Content_ID=contentID,
-                                )
-                                attachments.append(attachment)
-
-                        except Exception as e:
-                            desc = "Error parsing attachments"
-                            errors = common.handle_error(errors, e, desc)
-
-                        decoded_Message_ID, errors = format.parse_header(headers["Message-ID"], errors)
-                        decoded_Date, errors = format.parse_header(headers["Date"], errors)
-                        decoded_From, errors = format.parse_header(headers["From"], errors)
-                        decoded_To, errors = format.parse_header(headers["To"], errors)
-                        decoded_Cc, errors = format.parse_header(headers["Cc"], errors)
-                        decoded_Bcc, errors = format.parse_header(headers["Bcc"], errors)
-                        decoded_Subject, errors = format.parse_header(headers["Subject"], errors)
-
-                        message = Email(
-                            Errors=errors,
-                            Message_ID=decoded_Message_ID,
-                            Original_File=originalFile,
-                            Message_Path=messagePath,
-                            Derivatives_Path=derivativesPath,
-                            Date=decoded_Date,
-                            From=decoded_From,
-                            To=decoded_To,
-                            Cc=decoded_Cc,
-                            Bcc=decoded_Bcc,
-                            Subject=decoded_Subject,
-                            Content_Type=headers.get_content_type(),
-                            Headers=headers,
-                            HTML_Body=html_body,
-                            HTML_Encoding=html_encoding,
-                            Text_Body=text_body,
-                            Text_Encoding=text_encoding,
-                            Message=None,
-                            Attachments=attachments,
-                        )
-
-                    except (Exception) as e:
-                        desc = "Error parsing message"
-                        errors = common.handle_error(errors, e, desc)
-                        message = Email(Errors=errors)
-
-                    yield message
+                    yield parse_message(folder, index, path, originalFile, self.html_body, self.spool_dir)
 
             # iterate over any subfolders too
             if folder.number_of_sub_folders:
                 for folder_index in range(folder.number_of_sub_folders):
                     subfolder = folder.get_sub_folder(folder_index)
-                    yield from self.folders(subfolder, path + "/" + subfolder.name, originalFile, iteration_only=iteration_only)
-            else:
-                if not iteration_only:
-                    if not folder.number_of_sub_messages:
-                        # This is an email folder that does not contain any messages.
-                        # Add it to self.account_data['empty_folder_paths']
-                        if not "empty_folder_paths" in self.account_data:
-                            self.account_data["empty_folder_paths"] = []
-                        self.account_data["empty_folder_paths"].append(os.path.splitext(originalFile)[0] + "/" + path)
-
-        def messages(self, iteration_only=False):
-            companion_files = []
-            if os.path.isfile(self.path):
-                fileList = [self.path]
-            else:
-                fileList = []
-                for root, dirs, files in os.walk(self.path):
-                    for file in files:
-                        mailbag_path = os.path.join(self.path, self.mailbag_name) + os.sep
-                        fileRoot = root + os.sep
-                        # don't count the newly-created mailbag
-                        if not fileRoot.startswith(mailbag_path):
-                            if file.lower().endswith("." + self.format_name):
-                                fileList.append(os.path.join(root, file))
-                            elif self.companion_files:
-                                companion_files.append(os.path.join(root, file))
+                    yield from self.folders(subfolder, path + "/" + subfolder.name, originalFile)
+            elif not folder.number_of_sub_messages:
+                self.add_empty_folder(originalFile, path)
+
+        def add_empty_folder(self, originalFile, path):
+            # Add an email folder that does not contain any messages to self.account_data['empty_folder_paths']
+            if not "empty_folder_paths" in self.account_data:
+                self.account_data["empty_folder_paths"] = []
+            self.account_data["empty_folder_paths"].append(os.path.splitext(originalFile)[0] + "/" + path)
+
+        def messages(self):
+            mover = format.FileMover(
+                self.dry_run, self.keep, self.source_parent_dir, self.mailbag_dir, self.mailbag_name, self.format_name, self.keep_strategy
+            )
+            fileList, companion_files = self.file_lists
 
             for filePath in fileList:
                 rel_path = format.relativePath(self.path, filePath)  # returns "" when path is a file
@@ -337,47 +429,41 @@ if not skip_registry:
                 # original file is now the relative path to the PST from the provided path
 
                 errors = []
-                pst = pypff.file()
-                pst.open(filePath)
-                root = pst.get_root_folder()
-                for folder in root.sub_folders:
-                    if folder.number_of_sub_folders:
-                        # call recursive function to parse email folder
-                        yield from self.folders(folder, folder.name, originalFile, iteration_only=iteration_only)
-                    else:
-                        if not iteration_only:
-                            # This is an email folder that does not contain any messages.
-                            # Add it to self.account_data['empty_folder_paths']
-                            if not "empty_folder_paths" in self.account_data:
-                                self.account_data["empty_folder_paths"] = []
-                            self.account_data["empty_folder_paths"].append(os.path.splitext(originalFile)[0] + "/" + folder.name)
-                pst.close()
+                if self.processes > 1:
+                    pst_census = self.census[filePath]
+                    # Split large folders into chunks of messages to balance worker processes
+                    jobs = []
+                    for folder_indexes, path, message_count in pst_census["folders"]:
+                        for start in range(0, message_count, PST_CHUNK_SIZE):
+                            stop = min(start + PST_CHUNK_SIZE, message_count)
+                            jobs.append((filePath, folder_indexes, path, originalFile, start, stop, self.html_body, self.spool_dir))
+                    # Each worker process opens its own handle on the PST
+                    yield from format.parallelMessages(parse_folder_messages, jobs, self.processes, lambda job: job[3])
+                    # parallelMessages() parses in this process with too few jobs
+                    close_psts()
+                    for path in pst_census["empty_folders"]:
+                        self.add_empty_folder(originalFile, path)
+                else:
+                    pst = pypff.file()
+                    pst.open(filePath)
+                    root = pst.get_root_folder()
+                    for folder in root.sub_folders:
+                        if folder.number_of_sub_folders:
+                            yield from self.folders(folder, folder.name, originalFile)
+                        else:
+                            self.add_empty_folder(originalFile, folder.name)
+                    pst.close()
 
                 # Move PST to new mailbag directory structure
-                if not iteration_only:
-                    new_path, errors = format.moveWithDirectoryStructure(
-                        self.dry_run,
-                        self.keep,
-                        self.source_parent_dir,
-                        self.mailbag_dir,
-                        self.mailbag_name,
-                        self.format_name,
-                        filePath,
-                        # Does not check path lengths for PSTs
-                        errors,
-                    )
+                # Does not check path lengths for PSTs
+                new_path, errors = mover.move(filePath, errors)
 
             if self.companion_files:
                 # Move all files into mailbag directory structure
                 log.debug("Moving compantion files...")
+                errors = []
                 for companion_file in companion_files:
-                    new_path = format.moveWithDirectoryStructure(
-                        self.dry_run,
-                        self.keep,
-                        self.source_parent_dir,
-                        self.mailbag_dir,
-                        self.mailbag_name,
-                        self.format_name,
-                        companion_file,
-                        [],
-                    )
+                    new_path, errors = mover.move(companion_file, errors)
+
+            # Remove source directories that are empty now
+            mover.prune()
@@ -4,8 +4,11 @@ from time import time
 import csv
 import random
 import string
+import hashlib
+import uuid
 
 import mailbagit.helper.common as common
+import mailbagit.helper.format as format
 import mailbagit.globals as globals
 
 from mailbagit.loggerx import get_logger
@@ -63,7 +66,50 @@ def progressMessage(msg, print_End="\r"):
     print(f"\r{dt} {message_type} {msg}", end=print_End)
 
 
-def writeAttachmentsToDisk(dry_run, attachments_dir, message):
+def writeAttachment(attachment, attachment_path, attachment_index=None):
+    """
+    Writes the data of an attachment to a file.
+    With an attachment_index, the data is hashed as it is written to a temporary file next to attachment_path.
+    If an attachment with the same data was already written, the temporary file is removed and
+    attachment_path is hardlinked to the existing file instead, otherwise it is renamed to attachment_path.
+
+    Parameters:
+        attachment (Attachment): An attachment object desribed in models.py
+        attachment_path (Path): Path to write the attachment to
+        attachment_index (dict): sha256 digests of attachments already written and their paths, or None to write every attachment
+    """
+    if attachment_index is None:
+        with open(attachment_path, "wb") as f, attachment.open() as data:
+            shutil.copyfileobj(data, f)
+        return
+
+    sha256 = hashlib.sha256()
+    # Opened like any other attachment so it gets the same permissions
+    temp_path = os.path.join(os.path.dirname(attachment_path), "." + uuid.uuid4().hex + ".tmp")
+    try:
+        with open(temp_path, "xb") as f, attachment.open() as data:
+            for chunk in iter(lambda: data.read(format.ATTACHMENT_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+                f.write(chunk)
+        digest = sha256.hexdigest()
+        if digest in attachment_index:
+            try:
+                os.link(attachment_index[digest], attachment_path)
+                os.remove(temp_path)
+                log.debug("Linked duplicate attachment to " + str(attachment_index[digest]))
+                return
+            except OSError as e:
+                log.debug("Unable to link duplicate attachment, writing it instead. " + str(e))
+        os.replace(temp_path, attachment_path)
+    except BaseException:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
+    if not digest in attachment_index:
+        attachment_index[digest] = attachment_path
+
+
+def writeAttachmentsToDisk(dry_run, attachments_dir, message, attachment_index=None):
     """
     Takes an email message object and writes any attachments in the model
     to the attachments subdirectory according to the mailbag spec.
@@ -73,6 +119,7 @@ def writeAttachmentsToDisk(dry_run, attachments_dir, message):
         dry_run (Boolean): Option to do a test run without writing changes
         attachments_dir (Path): Path to the attachments subdirectory
         message (Email): A full email message object desribed in models.py
+        attachment_index (dict): Index of attachments already written, used to hardlink duplicates. None writes every attachment.
     """
 
     message_attachments_dir = os.path.join(attachments_dir, str(message.Mailbag_Message_ID))
@@ -106,9 +153,7 @@ def writeAttachmentsToDisk(dry_run, attachments_dir, message):
         if not dry_run:
             attachment_path = os.path.join(message_attachments_dir, writtenName)
             try:
-                f = open(attachment_path, "wb")
-                f.write(attachment.File)
-                f.close()
+                writeAttachment(attachment, attachment_path, attachment_index)
             except Exception as e:
                 random_name = "".join(random.choices(string.ascii_letters + string.digits, k=8))
                 desc = (
@@ -117,9 +162,9 @@ def writeAttachmentsToDisk(dry_run, attachments_dir, message):
                 errors = common.handle_error([], None, desc, "error")
                 attachment_row = [attachment.Name, random_name, attachment.MimeType, attachment.Content_ID]
                 attachment_path = os.path.join(message_attachments_dir, random_name)
-                f = open(attachment_path, "wb")
-                f.write(attachment.File)
-                f.close()
+                writeAttachment(attachment, attachment_path, attachment_index)
+            # So derivatives can link to the written attachment
+            attachment.written_path = attachment_path
 
         # add line to CSV for attachment
         attachment_data.append(attachment_row)
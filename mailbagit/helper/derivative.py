@@ -1,12 +1,22 @@
 import os
 import base64
 import codecs
+import functools
+import html
+import importlib
+import pathlib
+import queue
+import tempfile
+import threading
+import urllib.request
+from html.parser import HTMLParser
 from bs4 import BeautifulSoup, Doctype
 
 import http.server
 import socketserver
 
 from mailbagit.loggerx import get_logger
+import mailbagit.helper.common as common
 
 log = get_logger()
 
@@ -16,95 +26,286 @@ def deleteFile(filePath):
         os.remove(filePath)
 
 
-def inlineAttachments(html_string, encoding):
+def scratchDirectory():
     """
-    Reads an HTML body and looks for images that might rely on inline
-    attachments. This loops through all the <img> tags and returns
-    filenames to check against attached files. Used for deciding the
-    Content-Disposition header for MBOX and EML derivatives
+    Makes a temporary directory for intermediate files that should not be written to the mailbag.
+    Uses /dev/shm when it is available, which is in memory on Linux.
+
+    Returns:
+        str: Path to the new directory. The caller removes it.
+    """
+    parent = None
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        parent = "/dev/shm"
+    return tempfile.mkdtemp(prefix="mailbagit-", dir=parent)
+
+
+# Default styling for formatted HTML
+DEFAULT_CSS = """
+            @media print {
+                /* for Chrome margins */
+                @page { margin: 10; }
+            }
+            section#mailbagHeaders table#mailbagHeadersTable {
+                width: 100%;
+                margin-bottom: 35px;
+                text-align: left;
+                border-top: 4px solid #000000;
+                padding-top: 8px;
+                border-collapse: separate;
+                border-spacing: 0 1px;
+            }
+            section#mailbagHeaders table#mailbagHeadersTable > tbody > tr > td {
+                font: 16px Arial sans-serif;
+                color:  #000000;
+                padding: 2px 5px;
+            }
+            section#mailbagHeaders table#mailbagHeadersTable tbody tr:nth-of-type(even) {
+                background-color: #f3f3f3;
+            }
+            section#mailbagHeaders h2 {
+                margin-bottom: 2px;
+                font-size: 24px;
+                font-family: Arial sans-serif;
+            }
+        """
+
+
+# BeautifulSoup tree builders that can be used for formatting HTML.
+# html.parser is always available, lxml is much faster if it is installed.
+HTML_PARSERS = ["html.parser", "lxml"]
+
+
+def htmlParser(html_parser="html.parser"):
+    """
+    Returns the name of the BeautifulSoup tree builder to use,
+    falling back to html.parser if the requested one is not installed.
 
     Parameters:
-        HTML_Body(str):
+        html_parser(str): html.parser or lxml
 
     Returns:
-        Dict: A dict with filenames as keys and full contentIDs (<filename@identifier>) as values
+        str: The tree builder to use
     """
+    if html_parser != "html.parser" and not importlib.util.find_spec(html_parser):
+        log.warning(html_parser + " is not installed, using html.parser instead")
+        return "html.parser"
+    return html_parser
 
-    inline_files = {}
 
-    # Formatting HTML with beautiful soup
-    soup = BeautifulSoup(html_string.encode(encoding), "html.parser", from_encoding=encoding)
-    tags = (tag for tag in soup.findAll("img") if tag.get("src") and tag.get("src").startswith("cid:"))
-    for tag in tags:
-        # Iterate through the attachments until we get the right one.
-        cid = tag["src"][4:]
-        if "@" in cid:
-            filename, contentID = cid.split("@", 1)
-            inline_files[filename] = cid
-        else:
-            inline_files[cid] = cid
+class TagScanner(HTMLParser):
+    """
+    A streaming tokenizer that collects attribute values for some tags without building a document tree.
+    Used where HTML only needs to be read, like finding inline images or external resources.
+    It uses the same tokenizer as BeautifulSoup's html.parser, so it finds the same tags.
+    """
 
-    return inline_files
+    def __init__(self, tag_attrs):
+        super().__init__(convert_charrefs=True)
+        self.tag_attrs = tag_attrs
+        self.values = dict((tag, []) for tag in tag_attrs)
 
+    def handle_starttag(self, tag, attrs):
+        if tag in self.tag_attrs:
+            value = None
+            for name, attr_value in attrs:
+                if name == self.tag_attrs[tag]:
+                    # Like BeautifulSoup, attributes without a value are empty strings and the last duplicate wins
+                    value = attr_value if attr_value is not None else ""
+            self.values[tag].append(value)
 
-def htmlFormatting(message, external_css, headers=True):
+
+def scanTags(html_string, tag_attrs):
     """
-    Creates a formatted html file using message text or html body
-    inserts any additional styling given by user
-    Useful for html and pdf derivative
+    Finds the values of an attribute for every occurrence of some tags in an HTML string
+
+    Parameters:
+        html_string(str): HTML to scan
+        tag_attrs(dict): tag names as keys and the attribute to read from each as values, like {"img": "src"}
+
+    Returns:
+        Dict: tag names as keys and lists of attribute values in document order as values.
+            Values are None for tags without the attribute.
+    """
+    scanner = TagScanner(tag_attrs)
+    scanner.feed(html_string)
+    scanner.close()
+    return scanner.values
+
+
+def htmlCache(message):
+    """
+    Returns a dict stored on a message object for HTML that is shared by derivatives,
+    so the message body is only parsed and formatted once no matter how many derivatives use it.
 
     Parameters:
         message:message object
-        external_css(string): path of css file to customize derivative
-        headers(boolean):option to add table of headers
 
     Returns:
-        String: formatted html for pdf, html derivatives
+        Dict: The cache for the message
     """
+    if getattr(message, "html_cache", None) is None:
+        message.html_cache = {}
+    return message.html_cache
 
-    # check to see which body to use
-    html_content = False
-    encoding = False
-    if message.HTML_Body:
-        html_content = message.HTML_Body
-        encoding = message.HTML_Encoding
-    elif message.Text_Body:
-        #  converting text body to html body
-        html_content = (
-            """
-            <!DOCTYPE html>
-            <html>
-                <head>
-                    <style>
-                        #mailbagPlainText{white-space: pre;}
-                    </style>
-                </head>
-                <body>
-                    <section id='mailbagPlainText'>"""
-            + message.Text_Body
-            + """<section>
-                </body>
-            </html>
-        """
-        )
-        # using utf-8 for ascii plain text bodies as we're adding non-ascii whitespace
-        if codecs.lookup(message.Text_Encoding).name.lower() == "ascii":
-            log.debug("Using utf-8 to better handle whitespace for plain text ascii body message " + str(message.Mailbag_Message_ID))
-            encoding = "utf-8"
-        else:
-            encoding = message.Text_Encoding
-    else:
+
+def normalizeCID(cid):
+    """
+    Normalizes a Content-ID so values from headers, generated IDs and cid: URLs can be compared.
+    Strips whitespace, surrounding <> and any cid: prefix.
+
+    Parameters:
+        cid(str): A Content-ID or cid: URL
+
+    Returns:
+        str: The normalized Content-ID
+    """
+    cid = cid.strip()
+    if cid.lower().startswith("cid:"):
+        cid = cid[4:]
+    return cid.strip("<>").strip()
+
+
+def attachmentIndex(message):
+    """
+    Indexes a message's attachments for resolving inline images, once per message.
+    Attachments are indexed by normalized Content-ID, by name and by filename without the extension,
+    as MSG and PST sources do not have reliable Content-IDs and the cids in the HTML usually reference filenames.
+    As with duplicate filenames before, the last attachment wins.
+
+    Parameters:
+        message:message object
+
+    Returns:
+        Dict: "content_id", "name" and "stem" dicts with lowercase names as keys and attachment positions as values
+    """
+    cache = htmlCache(message)
+    if "attachment_index" not in cache:
+        index = {"content_id": {}, "name": {}, "stem": {}}
+        for i, attachment in enumerate(message.Attachments):
+            if attachment.Content_ID:
+                index["content_id"][normalizeCID(attachment.Content_ID)] = i
+            if attachment.Name:
+                name = attachment.Name.strip().lower()
+                index["name"][name] = i
+                index["stem"][os.path.splitext(name)[0]] = i
+        cache["attachment_index"] = index
+    return cache["attachment_index"]
+
+
+def resolveCID(message, cid):
+    """
+    Finds the attachment an inline image cid references.
+    Checks the Content-ID, then the cid or the part before the @ against attachment names,
+    and then against attachment names without the extension.
+
+    Parameters:
+        message:message object
+        cid(str): The Content-ID from an <img> tag, without cid:
+
+    Returns:
+        int: The position of the attachment in message.Attachments, or None if none match
+    """
+    index = attachmentIndex(message)
+    cid = normalizeCID(cid)
+    if cid in index["content_id"]:
+        return index["content_id"][cid]
+    for name in (cid.lower(), cid.split("@", 1)[0].lower()):
+        if name in index["name"]:
+            return index["name"][name]
+    for name in (cid.lower(), cid.split("@", 1)[0].lower()):
+        if name in index["stem"]:
+            return index["stem"][name]
+    return None
+
+
+def inlineContentIDs(message, html_parser="html.parser"):
+    """
+    Finds the attachments used as inline images in a message's HTML body.
+    Used for deciding the Content-Disposition and Content-ID headers for MBOX and EML derivatives.
+    Uses the images found by parseHTML() if the body was already parsed, otherwise only scans the img tags.
+
+    Parameters:
+        message:message object
+        html_parser(str): BeautifulSoup tree builder the body may have been parsed with, html.parser or lxml
+
+    Returns:
+        Dict: Attachment positions in message.Attachments as keys and the cid used in the HTML as values
+    """
+    cache = htmlCache(message)
+    if "inline_cids" not in cache:
+        inline_cids = {}
+        if message.HTML_Body:
+            parsed = cache.get(("parsed", html_parser))
+            if parsed:
+                cids = [cid for tag, cid in parsed["cid_tags"]]
+            else:
+                # Only reading the img tags, so this does not need a full parse
+                cids = [src[4:] for src in scanTags(message.HTML_Body, {"img": "src"})["img"] if src and src.startswith("cid:")]
+            for cid in cids:
+                position = resolveCID(message, cid)
+                if position is not None:
+                    inline_cids[position] = cid
+        cache["inline_cids"] = inline_cids
+    return cache["inline_cids"]
+
+
+def attachmentLink(attachment_path, html_dir=None):
+    """
+    Makes a link to an attachment written to the attachments directory
+
+    Parameters:
+        attachment_path(str): Path the attachment was written to
+        html_dir(str): Directory the HTML will be written to. If None, an absolute file URI is returned instead of a relative path.
+
+    Returns:
+        str: A URL for the attachment
+    """
+    if html_dir:
+        return urllib.request.pathname2url(os.path.relpath(attachment_path, html_dir))
+    return pathlib.Path(os.path.abspath(attachment_path)).as_uri()
+
+
+def parseHTML(message, html_parser="html.parser"):
+    """
+    Parses the message body with beautiful soup, once per message.
+    Makes sure the document has html, head and body tags and a doctype, and adds meta and style tags.
+    The soup is shared by all derivatives, so htmlFormatting() changes it for each derivative and
+    serializes it, rather than parsing the body again.
+
+    Parameters:
+        message:message object
+        html_parser(str): BeautifulSoup tree builder to use, html.parser or lxml
+
+    Returns:
+        Dict: None if the message has no HTML body, otherwise:
+            "soup": The parsed message body
+            "encoding": The encoding of the body
+            "style": The style tag for the default and external CSS
+            "cid_tags": A list of (tag, Content-ID) tuples for images that rely on inline attachments
+    """
+    cache = htmlCache(message)
+    key = ("parsed", html_parser)
+    if key in cache:
+        return cache[key]
+    html_parser = htmlParser(html_parser)
+
+    # Plain text bodies are formatted by plainTextFormatting() instead
+    html_content = message.HTML_Body
+    encoding = message.HTML_Encoding
+    if not html_content:
         log.warn("Unable to format HTML, no message body found for " + str(message.Mailbag_Message_ID))
 
+    parsed = None
     if html_content:
 
         # Formatting HTML with beautiful soup
-        soup = BeautifulSoup(html_content.encode(encoding), "html.parser", from_encoding=encoding)
+        soup = BeautifulSoup(html_content.encode(encoding), html_parser, from_encoding=encoding)
 
         # Checking if message contains partial html
         if not soup.html:
             html_content = "<html>" + html_content + "</html>"
-            soup = BeautifulSoup(html_content.encode(encoding), "html.parser", from_encoding=encoding)
+            soup = BeautifulSoup(html_content.encode(encoding), html_parser, from_encoding=encoding)
         if not soup.head:
             head = soup.new_tag("head")
             soup.html.insert(0, head)
@@ -121,118 +322,322 @@ def htmlFormatting(message, external_css, headers=True):
             tag = Doctype("html")
             soup.insert(0, tag)
 
-        # optionally adds headers table to html
-        if headers:
-            # Make headers table
-            table = "<table id='mailbagHeadersTable'>"
-            if message.Subject:
-                h2 = "<h2>" + message.Subject + "</h2>"
-            else:
-                h2 = ""
-            # Headers to display
-            headerFields = [
-                "Mailbag_Message_ID",
-                "Message_ID",
-                "From",
-                "Date",
-                "To",
-                "Cc",
-                "Bcc",
-                "Subject",
-            ]
-            # Getting the values of the attrbutes and appending to HTML string
-            for headerField in headerFields:
-                value = getattr(message, headerField)
-                if not value is None and value != []:
-                    table += "<tr>"
-                    table += "<td class='header'>" + str(headerField) + "</td>"
-                    table += "<td>" + str(getattr(message, headerField)).replace("<", "&lt;").replace(">", "&gt;") + "</td>"
-                    table += "</tr>"
-            if len(message.Attachments) > 0:
-                attachmentNumber = len(message.Attachments)
-                table += "<tr>"
-                table += "<td class='header'>Attachments</td><td>"
-                for i, attachment in enumerate(message.Attachments):
-                    if attachment.Name:
-                        table += attachment.Name
-                    else:
-                        table += str(i)
-                    if i + 1 < attachmentNumber:
-                        table += "<br/>"
-                table += "</td>"
-                table += "</tr>"
-            tableSection = "<section id='mailbagHeaders'>" + h2 + table + "</table></section>"
-            soupTable = BeautifulSoup(tableSection, "html.parser")
-
-            # Add headers table to HTML body
-            soup.body.insert(0, soupTable)
-
         # Embedding Encoding with meta
         meta = soup.new_tag("meta")
         meta["charset"] = "utf-8"
         soup.head.insert(0, meta)
 
-        # Embedding default styling
-        default_css = """
-            @media print {
-                /* for Chrome margins */
-                @page { margin: 10; }
-            }
-            section#mailbagHeaders table#mailbagHeadersTable {
-                width: 100%;
-                margin-bottom: 35px;
-                text-align: left;
-                border-top: 4px solid #000000;
-                padding-top: 8px;
-                border-collapse: separate;
-                border-spacing: 0 1px;
-            }
-            section#mailbagHeaders table#mailbagHeadersTable > tbody > tr > td {
-                font: 16px Arial sans-serif;
-                color:  #000000;
-                padding: 2px 5px;
-            }
-            section#mailbagHeaders table#mailbagHeadersTable tbody tr:nth-of-type(even) {
-                background-color: #f3f3f3;
-            }
-            section#mailbagHeaders h2 {
-                margin-bottom: 2px;
-                font-size: 24px;
-                font-family: Arial sans-serif;
-            }
-        """
+        # Styling is added by htmlFormatting()
         style = soup.new_tag("style")
-        style.string = default_css
-        # Adding external_css
-        if external_css:
-            with open(external_css) as css_file:
-                style.string = style.string + "\n" + css_file.read()
-                css_file.close()
         soup.head.append(style)
 
+        # Find images that rely on inline attachments
+        cid_tags = [(tag, tag["src"][4:]) for tag in soup.find_all("img") if tag.get("src") and tag.get("src").startswith("cid:")]
+
+        parsed = {"soup": soup, "encoding": encoding, "style": style, "cid_tags": cid_tags}
+
+    cache[key] = parsed
+    return parsed
+
+
+def plainTextEncoding(message):
+    """
+    Returns the encoding to use for HTML made from a plain text body
+
+    Parameters:
+        message:message object
+
+    Returns:
+        str: The encoding
+    """
+    # using utf-8 for ascii plain text bodies as we're adding non-ascii whitespace
+    if codecs.lookup(message.Text_Encoding).name.lower() == "ascii":
+        log.debug("Using utf-8 to better handle whitespace for plain text ascii body message " + str(message.Mailbag_Message_ID))
+        return "utf-8"
+    return message.Text_Encoding
+
+
+def headersTable(message):
+    """
+    Makes the table of message headers for HTML and PDF derivatives
+
+    Parameters:
+        message:message object
+
+    Returns:
+        str: HTML for a section with the headers table
+    """
+    # Make headers table
+    table = "<table id='mailbagHeadersTable'>"
+    if message.Subject:
+        h2 = "<h2>" + message.Subject + "</h2>"
+    else:
+        h2 = ""
+    # Headers to display
+    headerFields = [
+        "Mailbag_Message_ID",
+        "Message_ID",
+        "From",
+        "Date",
+        "To",
+        "Cc",
+        "Bcc",
+        "Subject",
+    ]
+    # Getting the values of the attrbutes and appending to HTML string
+    for headerField in headerFields:
+        value = getattr(message, headerField)
+        if not value is None and value != []:
+            table += "<tr>"
+            table += "<td class='header'>" + str(headerField) + "</td>"
+            table += "<td>" + str(getattr(message, headerField)).replace("<", "&lt;").replace(">", "&gt;") + "</td>"
+            table += "</tr>"
+    if len(message.Attachments) > 0:
+        attachmentNumber = len(message.Attachments)
+        table += "<tr>"
+        table += "<td class='header'>Attachments</td><td>"
+        for i, attachment in enumerate(message.Attachments):
+            if attachment.Name:
+                table += attachment.Name
+            else:
+                table += str(i)
+            if i + 1 < attachmentNumber:
+                table += "<br/>"
+        table += "</td>"
+        table += "</tr>"
+    tableSection = "<section id='mailbagHeaders'>" + h2 + table + "</table></section>"
+    return tableSection
+
+
+@functools.lru_cache(maxsize=None)
+def styleCSS(external_css):
+    """
+    Combines the default styling with an optional CSS file given by the user.
+    Cached, so the CSS file is only read once per run.
+
+    Parameters:
+        external_css(string): path of css file to customize derivative
+
+    Returns:
+        str: The CSS
+    """
+    css = DEFAULT_CSS
+    if external_css:
+        with open(external_css) as css_file:
+            css = css + "\n" + css_file.read()
+            css_file.close()
+    return css
+
+
+def plainTextFormatting(message, external_css, headers=True):
+    """
+    Formats a plain text body as HTML directly from a template.
+    The text is escaped, so unlike the message HTML this never needs to be parsed.
+    Makes the same document as parsing the text body would, but the text is kept exactly as-is
+    instead of being re-indented, and any <...> in it stays text rather than becoming tags.
+
+    Parameters:
+        message:message object
+        external_css(string): path of css file to customize derivative
+        headers(boolean):option to add table of headers
+
+    Returns:
+        String: formatted html for pdf, html derivatives
+        String: encoding of the HTML
+    """
+    css = styleCSS(external_css).strip()
+    if headers:
+        tableSection = "\n  " + headersTable(message)
+    else:
+        tableSection = ""
+    html_content = (
+        "<!DOCTYPE html>\n"
+        "<html>\n"
+        " <head>\n"
+        '  <meta charset="utf-8"/>\n'
+        "  <style>\n"
+        "   #mailbagPlainText{white-space: pre;}\n"
+        "  </style>\n"
+        "  <style>\n"
+        "   " + css + "\n"
+        "  </style>\n"
+        " </head>\n"
+        " <body>" + tableSection + "\n"
+        '  <section id="mailbagPlainText">' + html.escape(message.Text_Body, quote=False) + "</section>\n"
+        " </body>\n"
+        "</html>\n"
+    )
+    return html_content, plainTextEncoding(message)
+
+
+def htmlFormatting(message, external_css, headers=True, html_parser="html.parser", link_images=False, html_dir=None, compact=False):
+    """
+    Creates a formatted html file using message text or html body
+    inserts any additional styling given by user
+    Useful for html and pdf derivative
+    Results are cached on the message, so each variant is only formatted once per message.
+
+    Parameters:
+        message:message object
+        external_css(string): path of css file to customize derivative
+        headers(boolean):option to add table of headers
+        html_parser(str): BeautifulSoup tree builder to use, html.parser or lxml
+        link_images(boolean): link inline images to the attachments directory instead of embedding them.
+            Images are still embedded for attachments that were not written, like during a dry run.
+        html_dir(str): directory the HTML will be written to, to link images with relative paths. If None, file URIs are used.
+        compact(boolean): serialize the HTML as-is instead of re-indenting it with prettify(), which is faster and smaller
+
+    Returns:
+        String: formatted html for pdf, html derivatives
+    """
+    cache = htmlCache(message)
+    key = ("formatted", headers, external_css, html_parser, link_images, html_dir, compact)
+    if key in cache:
+        return cache[key]
+
+    if not message.HTML_Body and message.Text_Body:
+        # No need to parse plain text bodies
+        cache[key] = plainTextFormatting(message, external_css, headers)
+        return cache[key]
+
+    parsed = parseHTML(message, html_parser)
+    if parsed is None:
+        cache[key] = (False, False)
+        return cache[key]
+    soup = parsed["soup"]
+    encoding = parsed["encoding"]
+
+    # The soup is shared with other derivatives, so the changes made here are undone once it is serialized
+    tableTag = None
+    original_srcs = [(tag, tag.get("src")) for tag, cid in parsed["cid_tags"]]
+    try:
+        # optionally adds headers table to html
+        if headers:
+            tableSection = headersTable(message)
+            tableTag = BeautifulSoup(tableSection, "html.parser").find("section")
+
+            # Add headers table to HTML body
+            soup.body.insert(0, tableTag)
+
+        # Embedding default styling
+        style = parsed["style"]
+        style.string = styleCSS(external_css)
+
         # Embedding Images
         # HT to extract_msg for this approach
         # https://github.com/TeamMsgExtractor/msg-extractor/blob/6bed8213de1a7a41739fcf5c9363322508711fce/extract_msg/message_base.py#L403-L414
-        tags = (tag for tag in soup.findAll("img") if tag.get("src") and tag.get("src").startswith("cid:"))
-        for tag in tags:
-            # Iterate through the attachments until we get the right one.
+        for tag, cid in parsed["cid_tags"]:
             data = None
-            cid = tag["src"][4:]
-
-            for attachment in message.Attachments:
-                if attachment.Name:
-                    if attachment.Name in cid:
-                        data = attachment.File
-            if data == None:
-                for attachment in message.Attachments:
-                    if attachment.Content_ID:
-                        if attachment.Content_ID in cid:
-                            data = attachment.File
+            position = resolveCID(message, cid)
+            if position is not None:
+                attachment = message.Attachments[position]
+                written_path = getattr(attachment, "written_path", None)
+                if link_images and written_path:
+                    tag["src"] = attachmentLink(written_path, html_dir)
+                    continue
+                data = attachment.read()
 
             # If we found anything, inject it.
             if data:
                 tag["src"] = (b"data:image;base64," + base64.b64encode(data)).decode(encoding)
+            else:
+                tag["src"] = "cid:" + cid
+
+        if compact:
+            html_content = soup.encode(encoding).decode(encoding)
+        else:
+            html_content = soup.prettify(encoding).decode(encoding)
+    finally:
+        if tableTag:
+            tableTag.extract()
+        for tag, src in original_srcs:
+            tag["src"] = src
+
+    cache[key] = (html_content, encoding)
+    return cache[key]
+
+
+class RenderPool:
+    """
+    Converts messages in background threads, so a derivative can keep taking messages while earlier ones are rendered.
+    Each thread has its own renderer, made with make_renderer(), which can keep state like a running browser between messages.
+    Renderers have a render(message, *job) method that returns a list of errors, and a close() method.
+    Errors are added to the message when its job is finished, and pending_messages() lists the messages still being rendered.
+    With retry, jobs that fail with an error level Error are rendered once more at the end of the run,
+    and only the errors from the last attempt are kept.
+    """
+
+    def __init__(self, make_renderer, workers=1, retry=False):
+        self.make_renderer = make_renderer
+        self.retry = retry
+        # Bounded, so messages are not read much faster than they can be rendered
+        self.jobs = queue.Queue(maxsize=workers * 2)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.failed = []
+        self.threads = [threading.Thread(target=self.work, daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, message, *job):
+        """
+        Queues a message to be rendered, waiting if the queue is full
+
+        Parameters:
+            message: message object
+            job: arguments passed to the renderer after the message
+        """
+        with self.lock:
+            self.pending.add(message.Mailbag_Message_ID)
+        self.jobs.put((message, job, False))
+
+    def pending_messages(self):
+        """Returns the Mailbag_Message_IDs of messages that are queued, being rendered, or waiting to be retried"""
+        with self.lock:
+            return set(self.pending)
 
-        html_content = soup.prettify(encoding).decode(encoding)
+    def work(self):
+        # If a renderer can't be made, the thread still takes jobs and records the error for each of them,
+        # so submit() and close() don't wait on a queue nothing is reading
+        try:
+            renderer = self.make_renderer()
+            renderer_error = None
+        except Exception as e:
+            renderer = None
+            renderer_error = e
+            log.error("Unable to start renderer: " + repr(e))
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                break
+            message, job, retried = item
+            try:
+                if renderer is None:
+                    raise RuntimeError("Unable to start renderer") from renderer_error
+                errors = renderer.render(message, *job)
+            except Exception as e:
+                desc = "Error rendering " + str(message.Mailbag_Message_ID)
+                errors = common.handle_error([], e, desc)
+            with self.lock:
+                if self.retry and not retried and any(error.Level == "error" for error in errors):
+                    log.warn("Will retry rendering " + str(message.Mailbag_Message_ID) + " at the end")
+                    self.failed.append((message, job))
+                else:
+                    message.Errors.extend(errors)
+                    self.pending.discard(message.Mailbag_Message_ID)
+            self.jobs.task_done()
+        if renderer:
+            renderer.close()
 
-    return html_content, encoding
+    def close(self):
+        """Waits for all queued messages to be rendered, retries any failures, and stops the threads"""
+        self.jobs.join()
+        with self.lock:
+            failed = self.failed
+            self.failed = []
+        for message, job in failed:
+            self.jobs.put((message, job, True))
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -1,17 +1,58 @@
 import os, shutil, glob
+import errno
 from pathlib import Path
 import mimetypes
 import chardet, codecs
+from chardet import UniversalDetector
+import importlib.util
 from email.header import Header, decode_header, make_header
-from mailbagit.models import Attachment
+from mailbagit.models import Email, Attachment
+from mailbagit.derivative import Derivative
 import mailbagit.helper.common as common
 import html
 import uuid
+import hashlib
+import tempfile
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from mailbagit.loggerx import get_logger
 
 log = get_logger()
 
+# Number of de-encapsulated RTF bodies to keep in memory
+RTF_CACHE_SIZE = 256
+rtf_cache = OrderedDict()
+
+# Number of decoded header values to keep in memory
+# From, To and Cc values repeat heavily within an account
+HEADER_CACHE_SIZE = 4096
+header_cache = OrderedDict()
+
+# Charset detection only reads this many bytes, fed to incremental detectors in chunks of CHARSET_CHUNK_SIZE
+CHARSET_SAMPLE_SIZE = 64 * 1024
+CHARSET_CHUNK_SIZE = 4096
+# Encodings that worked after declared charsets failed, keyed by the failed charsets
+# Mail clients tend to repeat the same bad labels, so this skips detecting them again
+# Only strict encodings are kept, since decoding with a permissive one like latin-1 doesn't show it was right
+DETECTED_ENCODINGS_SIZE = 1024
+detected_encodings = {}
+# Whether each detected encoding is strict
+strict_encodings = {}
+
+# Strategies for copying source files with --keep
+KEEP_STRATEGIES = ["reflink", "hardlink", "copy"]
+# Strategies "auto" tries, in order. Hardlinks share the source files with the mailbag,
+# so changing a source file would change the mailbag too, and they are only used when requested.
+AUTO_KEEP_STRATEGIES = ["reflink", "copy"]
+# Errors from reflink or hardlink attempts meaning the strategy will fail for any file on the same source device
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS}
+
+# Attachments are read in chunks of this many bytes
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+# Attachments larger than this are spooled to a temporary file instead of being kept in memory
+ATTACHMENT_SPOOL_SIZE = 16 * 1024 * 1024
+
 
 def relativePath(mainPath, file):
     """
@@ -26,15 +67,279 @@ def relativePath(mainPath, file):
         String: emailFolder
     """
 
-    fullPath = Path(mainPath).resolve()
-    fullFilePath = Path(file).resolve()
-    relPath = str(fullFilePath.relative_to(fullPath))
+    # Files are always found by joining paths onto mainPath, so this does not need to touch the filesystem
+    relPath = os.path.relpath(os.path.abspath(file), os.path.abspath(mainPath))
     if relPath == ".":
         return ""
     else:
         return relPath
 
 
+def scanDirectory(directory):
+    """
+    Lists a single directory with os.scandir(), like one step of os.walk().
+    Symlinked directories are not followed and unreadable directories are skipped.
+
+    Parameters:
+        directory (String): Directory path
+
+    Returns:
+        files (List): Sorted file paths in the directory
+        subdirs (List): Sorted subdirectory paths in the directory
+    """
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    else:
+                        files.append(entry.path)
+                except OSError:
+                    files.append(entry.path)
+    except OSError as e:
+        log.warn("Unable to read directory " + str(directory) + ": " + str(e))
+
+    return sorted(files), sorted(subdirs)
+
+
+def discoverFiles(path, mailbag_name, matches, companion_files=False, processes=1):
+    """
+    Finds all the email files to be packaged with a single scandir pass over the source directory.
+    The newly-created mailbag directory is pruned from the walk instead of being checked for every file.
+    When processes > 1, each level of the directory tree is listed in parallel, which helps
+    for wide trees on network filesystems. The order of the results does not depend on this.
+
+    Parameters:
+        path (String): The path provided to mailbagit, a file or a directory
+        mailbag_name (String): Mailbag name
+        matches (function): Takes a file name and returns True if it is an email file of the input format
+        companion_files (Boolean): Option to also list all other files as companion files
+        processes (int): Number of threads to use listing directories
+
+    Returns:
+        fileList (List): Email file paths, depth-first with each directory's files before its subdirectories
+        companionList (List): All other file paths if companion_files is True, otherwise empty
+    """
+    if os.path.isfile(path):
+        return [path], []
+
+    # don't walk the newly-created mailbag
+    mailbag_path = os.path.join(path, mailbag_name)
+
+    listings = {}
+    level = [path]
+    executor = ThreadPoolExecutor(max_workers=processes) if processes > 1 else None
+    try:
+        while level:
+            if executor and len(level) > 1:
+                scanned = list(executor.map(scanDirectory, level))
+            else:
+                scanned = [scanDirectory(directory) for directory in level]
+            next_level = []
+            for directory, (files, subdirs) in zip(level, scanned):
+                subdirs = [subdir for subdir in subdirs if subdir != mailbag_path]
+                listings[directory] = (files, subdirs)
+                next_level.extend(subdirs)
+            level = next_level
+    finally:
+        if executor:
+            executor.shutdown()
+
+    fileList = []
+    companionList = []
+    stack = [path]
+    while stack:
+        files, subdirs = listings[stack.pop()]
+        for file in files:
+            if matches(os.path.basename(file)):
+                fileList.append(file)
+            elif companion_files:
+                companionList.append(file)
+        stack.extend(reversed(subdirs))
+
+    return fileList, companionList
+
+
+def parseRecord(parse, job):
+    """
+    Runs in a worker process for parallelMessages().
+    Returns the parsed message(s) as records, since Email objects cannot be pickled.
+    """
+    parsed = parse(*job)
+    if isinstance(parsed, list):
+        return [message.to_record() for message in parsed]
+    return parsed.to_record()
+
+
+def parallelMessages(parse, jobs, processes=1, original_file=None):
+    """
+    Parses independent email files, or independent parts of them, and yields Email objects in the same order as jobs.
+    With processes > 1, jobs are parsed in a pool of worker processes, with at most two jobs
+    per process in flight so parsed messages do not pile up in memory ahead of the controller.
+
+    Parameters:
+        parse (function): A module-level function that takes the items in a job and returns an Email, or a list of Emails
+        jobs (List): Tuples of arguments for parse, such as (filePath, originalFile)
+        processes (int): Number of worker processes
+        original_file (function): Takes a job and returns its Original_File, for the error if a worker process fails
+
+    Yields:
+        message (Email): Email model object defined in models.py
+    """
+    if processes < 2 or len(jobs) < 2:
+        for job in jobs:
+            parsed = parse(*job)
+            if isinstance(parsed, list):
+                yield from parsed
+            else:
+                yield parsed
+        return
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        in_flight = deque()
+        jobs = iter(jobs)
+        while True:
+            for job in jobs:
+                in_flight.append((job, executor.submit(parseRecord, parse, job)))
+                if len(in_flight) >= processes * 2:
+                    break
+            if not in_flight:
+                break
+            job, future = in_flight.popleft()
+            try:
+                records = future.result()
+                if not isinstance(records, list):
+                    records = [records]
+                messages = [Email.from_record(record) for record in records]
+            except Exception as e:
+                desc = "Error parsing message in worker process"
+                errors = common.handle_error([], e, desc)
+                messages = [Email(Errors=errors, Original_File=original_file(job) if original_file else None)]
+            yield from messages
+
+
+def detect_with_chardet(sample):
+    detector = UniversalDetector()
+    for start in range(0, len(sample), CHARSET_CHUNK_SIZE):
+        detector.feed(sample[start : start + CHARSET_CHUNK_SIZE])
+        if detector.done:
+            break
+    detector.close()
+    return detector.result["encoding"]
+
+
+def detect_with_cchardet(sample):
+    import cchardet
+
+    return cchardet.detect(sample)["encoding"]
+
+
+def detect_with_charset_normalizer(sample):
+    from charset_normalizer import from_bytes
+
+    match = from_bytes(sample).best()
+    if match:
+        return match.encoding
+    return None
+
+
+# Charset detection backends in order of preference, keyed by the module each one needs
+charset_detectors = OrderedDict(
+    [
+        ("cchardet", detect_with_cchardet),
+        ("chardet", detect_with_chardet),
+        ("charset_normalizer", detect_with_charset_normalizer),
+    ]
+)
+# Name of the first installed backend, found the first time it is needed
+charset_detector = None
+
+
+def detectEncoding(binary_text, sample=True):
+    """
+    Detects the encoding of binary text, from its first CHARSET_SAMPLE_SIZE bytes unless sample is False.
+    Uses the first installed backend in charset_detectors.
+
+    Parameters:
+        binary_text (binary): an encoded string
+        sample (Boolean): Whether to only read the first CHARSET_SAMPLE_SIZE bytes
+
+    Returns:
+        encoding (str): The detected encoding, or None
+    """
+    global charset_detector
+    if charset_detector is None:
+        charset_detector = next(name for name in charset_detectors if importlib.util.find_spec(name))
+        log.debug("Detecting charsets with " + charset_detector)
+    if sample:
+        binary_text = binary_text[:CHARSET_SAMPLE_SIZE]
+    return charset_detectors[charset_detector](binary_text)
+
+
+def strictEncoding(encoding):
+    """
+    Checks if an encoding rejects most invalid input, like multibyte encodings such as utf-8 or shift_jis.
+    Single byte encodings like latin-1 or cp1252 decode nearly any bytes, so decoding without errors doesn't show they are right.
+
+    Parameters:
+        encoding (str): The name of an encoding
+
+    Returns:
+        Boolean
+    """
+    if not encoding in strict_encodings:
+        invalid = 0
+        for byte in range(128, 256):
+            try:
+                bytes([byte]).decode(encoding, errors="strict")
+            except UnicodeDecodeError:
+                invalid += 1
+        strict_encodings[encoding] = invalid > 32
+    return strict_encodings[encoding]
+
+
+def decodeDetected(binary_text, failed=()):
+    """
+    Decodes binary text with a detected encoding after the listed encodings failed.
+    If the same encodings failed before, the strict encoding that worked then is tried first without detection.
+
+    Parameters:
+        binary_text (binary): an encoded string
+        failed (List): Names of the encodings that failed to decode the text
+
+    Returns:
+        text (str): a decoded unicode string, or None if the detected encoding failed too
+        detected (str): The encoding used or detected
+        error (UnicodeDecodeError): The error if the detected encoding failed, otherwise None
+    """
+    key = tuple(name.lower() for name in failed)
+    if key in detected_encodings:
+        try:
+            return binary_text.decode(detected_encodings[key], errors="strict"), detected_encodings[key], None
+        except UnicodeDecodeError:
+            pass
+
+    detected = detectEncoding(binary_text)
+    try:
+        text = binary_text.decode(detected, errors="strict")
+    except UnicodeDecodeError as e:
+        if len(binary_text) <= CHARSET_SAMPLE_SIZE:
+            return None, detected, e
+        # The sample didn't include the characters that matter, like when it is all ASCII, so read everything
+        detected = detectEncoding(binary_text, sample=False)
+        try:
+            text = binary_text.decode(detected, errors="strict")
+        except UnicodeDecodeError as e:
+            return None, detected, e
+    if key and len(detected_encodings) < DETECTED_ENCODINGS_SIZE and strictEncoding(detected):
+        detected_encodings[key] = detected
+    return text, detected, None
+
+
 def safely_decode(body_type, binary_text, encodings, errors):
     """
     Tries to safely decode text for message bodies using an encodings dict.
@@ -77,8 +382,9 @@ def safely_decode(body_type, binary_text, encodings, errors):
 
     if success == False:
         try:
-            detected = chardet.detect(binary_text)["encoding"]
-            text = binary_text.decode(detected, errors="strict")
+            text, detected, e = decodeDetected(binary_text, failed)
+            if e:
+                raise e
             used = detected
             if len(valid) < 1:
                 # desc = "No valid listed encodings, but successfully decoded " + body_type + " body with detected encoding " + detected
@@ -110,6 +416,128 @@ def safely_decode(body_type, binary_text, encodings, errors):
     return text, used, errors
 
 
+def htmlBodyNeeded(args):
+    """
+    Checks if any of the requested derivatives use HTML bodies, so formats can skip
+    building them when they are expensive, like for RTF bodies in MSG and PST files.
+
+    Parameters:
+        args (Namespace): Arguments from argparse/Gooey
+
+    Returns:
+        Boolean
+    """
+    derivatives = getattr(args, "derivatives", None)
+    if derivatives is None:
+        return True
+    for derivative in derivatives:
+        if getattr(Derivative.registry.get(derivative), "requires_html_body", True):
+            return True
+    return False
+
+
+def deencapsulate_rtf(rtf_body):
+    """
+    Pulls an encapsulated HTML or plain text body out of an RTF body with RTFDE.
+    This is one of the most expensive steps for MSG and PST files, so results are
+    cached by a hash of the RTF and identical bodies, like templated notices, are
+    only de-encapsulated once per run (or once per worker process).
+    RTFDE is only imported the first time this is needed.
+    Like extract_msg, ignorable RTF groups are stripped first, which makes RTFDE much faster on large bodies.
+
+    Parameters:
+        rtf_body (bytes): A decompressed RTF body
+
+    Returns:
+        content_type (str): "html" or "text"
+        body (bytes or str): The de-encapsulated HTML as bytes or plain text as a str
+    """
+    key = hashlib.sha256(rtf_body).digest()
+    if key in rtf_cache:
+        rtf_cache.move_to_end(key)
+        content_type, body, exception = rtf_cache[key]
+    else:
+        from RTFDE.deencapsulate import DeEncapsulator
+        from extract_msg.utils import stripRtf
+
+        # RTFDE can't handle anything after the final closing bracket
+        rtf_body = stripRtf(rtf_body[: rtf_body.rfind(b"}") + 1])
+        content_type, body, exception = None, None, None
+        try:
+            deencapsulator = DeEncapsulator(rtf_body)
+            deencapsulator.deencapsulate()
+            content_type = deencapsulator.content_type
+            if content_type == "html":
+                body = deencapsulator.html
+            else:
+                body = deencapsulator.text
+        except Exception as e:
+            # Cache failures too, so they aren't tried again for the same body
+            exception = e
+        rtf_cache[key] = (content_type, body, exception)
+        if len(rtf_cache) > RTF_CACHE_SIZE:
+            rtf_cache.popitem(last=False)
+
+    if exception:
+        raise exception
+    return content_type, body
+
+
+def readAttachment(read_buffer, size, spool_dir=None):
+    """
+    Reads attachment data in chunks of ATTACHMENT_CHUNK_SIZE bytes, so memory use is bounded
+    regardless of attachment size. Data larger than ATTACHMENT_SPOOL_SIZE is written to a
+    temporary file as it is read, which Attachment.cleanup() removes later.
+
+    Parameters:
+        read_buffer (function): Reads up to a given number of bytes, such as pypff's attachment.read_buffer
+        size (int): Size of the attachment data in bytes
+        spool_dir (String): Directory for temporary files, like the directory the mailbag is written to.
+            None uses the default temporary directory, which is often small.
+
+    Returns:
+        data (bytes): The attachment data, or None if it was spooled to disk
+        spool_path (String): Path to the temporary file, or None if data is in memory
+    """
+    if size <= ATTACHMENT_SPOOL_SIZE:
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = read_buffer(min(ATTACHMENT_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks), None
+
+    spool = tempfile.NamedTemporaryFile(prefix="mailbag-attachment-", suffix=".tmp", dir=spool_dir, delete=False)
+    try:
+        remaining = size
+        while remaining > 0:
+            chunk = read_buffer(min(ATTACHMENT_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            spool.write(chunk)
+            remaining -= len(chunk)
+        spool.close()
+    except Exception:
+        spool.close()
+        os.remove(spool.name)
+        raise
+    return None, spool.name
+
+
+def removeSpooled(spool_paths):
+    """
+    Removes temporary files made by readAttachment(), like when parsing a message fails after its attachments were read
+
+    Parameters:
+        spool_paths (List): Paths to temporary files
+    """
+    for spool_path in spool_paths:
+        Attachment(FilePath=spool_path).cleanup()
+
+
 def parse_part(part, bodies, attachments, errors):
     """
     Used for EML and MBOX parsers
@@ -135,34 +563,49 @@ def parse_part(part, bodies, attachments, errors):
     content_disposition = part.get_content_disposition()
     content_id = part["Content-ID"]
 
+    # Classify the part first, so its payload is only decoded once, and only if it is needed
+    is_body = content_disposition != "attachment" and content_disposition != "inline"
+    is_body = is_body and (content_type == "text/html" or content_type == "text/plain")
+    if part.get_content_maintype() == "multipart":
+        is_attachment = False
+    elif content_disposition is None and content_id is None:
+        is_attachment = False
+    else:
+        is_attachment = True
+
+    payload = None
+    if is_body or is_attachment:
+        try:
+            payload = part.get_payload(decode=True)
+        except Exception as e:
+            desc = "Error decoding message part"
+            errors = common.handle_error(errors, e, desc)
+            return bodies, attachments, errors
+
     # Extract body
     try:
-        if content_disposition != "attachment" and content_disposition != "inline":
-            if content_type == "text/html" or content_type == "text/plain":
-                encodings = {}
-                encodings[1] = {"name": part.get_content_charset(), "label": "listed charset"}
-                message_body, part_encoding, errors = safely_decode(content_type, part.get_payload(decode=True), encodings, errors)
-                if content_type == "text/html":
-                    bodies["html_encoding"] = part_encoding
-                    bodies["html_body"] = message_body
-                elif content_type == "text/plain":
-                    bodies["text_encoding"] = part_encoding
-                    bodies["text_body"] = message_body
+        if is_body:
+            encodings = {}
+            encodings[1] = {"name": part.get_content_charset(), "label": "listed charset"}
+            message_body, part_encoding, errors = safely_decode(content_type, payload, encodings, errors)
+            if content_type == "text/html":
+                bodies["html_encoding"] = part_encoding
+                bodies["html_body"] = message_body
+            elif content_type == "text/plain":
+                bodies["text_encoding"] = part_encoding
+                bodies["text_body"] = message_body
     except Exception as e:
         desc = "Error parsing message body"
         errors = common.handle_error(errors, e, desc)
 
     # Extract attachments
     attachmentCount = 0
-    if part.get_content_maintype() == "multipart":
-        pass
-    elif content_disposition is None and content_id is None:
-        pass
-    else:
+    if is_attachment:
         try:
-            if not part.get_payload(decode=True):
-                if part.get_filename():
-                    desc = "Missing attachment content, failed to read attachment " + part.get_filename()
+            filename = part.get_filename()
+            if not payload:
+                if filename:
+                    desc = "Missing attachment content, failed to read attachment " + filename
                 else:
                     desc = "Missing attachment content and filename, failed to read attachment"
                 errors = common.handle_error(errors, None, desc)
@@ -171,9 +614,8 @@ def parse_part(part, bodies, attachments, errors):
                 if content_id is None:
                     content_id = uuid.uuid4().hex
 
-                attachmentFile = part.get_payload(decode=True)
-                if part.get_filename():
-                    attachmentName = part.get_filename()
+                if filename:
+                    attachmentName = filename
                 else:
                     attachmentName = None
                     desc = "No filename found for attachment, integer will be used instead"
@@ -194,7 +636,7 @@ def parse_part(part, bodies, attachments, errors):
                 attachment = Attachment(
                     Name=attachmentName,
                     WrittenName=attachmentWrittenName,
-                    File=attachmentFile,
+                    File=payload,
                     MimeType=content_type,
                     Content_ID=content_id,
                 )
@@ -232,7 +674,7 @@ def decode_header_part(header, errors):
                 encoding = codecs.lookup(encoding).name.lower()
             except:
                 # If not, might as well try to detect it.
-                encoding = chardet.detect(headerObj)["encoding"]
+                encoding = decodeDetected(headerObj, [encoding])[1]
             try:
                 header_string.append(headerObj.decode(encoding))
             except UnicodeDecodeError as e:
@@ -271,11 +713,24 @@ def parse_header(header, errors):
         header_string = None
     else:
         if isinstance(header, str):
+            if not "=?" in header:
+                # No RFC 1342 encoded words, so there is nothing to decode
+                return header, errors
+            if header in header_cache:
+                header_cache.move_to_end(header)
+                return header_cache[header], errors
+
+            error_count = len(errors)
             header_list = []
             for header_part in header.split(" "):
                 decoded_part, errors = decode_header_part(header_part, errors)
                 header_list.append(decoded_part)
             header_string = " ".join(header_list)
+            # Only cache values that decoded cleanly, so errors are still reported for every message
+            if len(errors) == error_count:
+                header_cache[header] = header_string
+                if len(header_cache) > HEADER_CACHE_SIZE:
+                    header_cache.popitem(last=False)
         else:
             decoded_part, errors = decode_header_part(header, errors)
             header_string = html.unescape(decoded_part)
@@ -302,56 +757,220 @@ def messagePath(headers):
     return messagePath
 
 
-def moveFile(dry_run, keep, oldPath, newPath):
-    os.makedirs(os.path.dirname(newPath), exist_ok=True)
+def reflinkFile(oldPath, newPath):
+    """
+    Clones a file without copying its data, using the FICLONE ioctl on Linux filesystems
+    that support it, such as Btrfs and XFS. Raises an OSError or ImportError if cloning is not supported.
+    """
+    import fcntl
+
+    FICLONE = 0x40049409
+    with open(oldPath, "rb") as src, open(newPath, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def kernelCopyFile(oldPath, newPath):
+    """
+    Copies a file with os.copy_file_range() so the data does not pass through Python.
+    Falls back to shutil.copyfile(), which uses sendfile() or a buffered copy.
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(oldPath, "rb") as src, open(newPath, "wb") as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            return
+        except OSError:
+            # Not supported by this kernel or filesystem
+            pass
+    shutil.copyfile(oldPath, newPath)
+
+
+def copyFile(oldPath, newPath, keep_strategy="auto", failed_strategies=None):
+    """
+    Copies a source file into the mailbag for --keep.
+    "reflink" clones the file on filesystems that support it, "hardlink" links it if it is on the same filesystem,
+    and "copy" copies it with copy_file_range(), sendfile(), or a buffered copy.
+    "auto" tries reflink, then copy, so the mailbag never shares files with the source unless "hardlink" is requested.
+    "reflink" and "hardlink" fall back to "copy" for each file they fail on.
+
+    Parameters:
+        oldPath (String): Path to the source file
+        newPath (String): Path to copy the file to
+        keep_strategy (String): auto, reflink, hardlink, or copy
+        failed_strategies (set): (strategy, device) pairs for strategies that are not supported for files
+            on a source device, which are skipped and added to
+
+    Returns:
+        strategy (String): The strategy used
+    """
+    if failed_strategies is None:
+        failed_strategies = set()
+    if keep_strategy == "auto":
+        strategies = AUTO_KEEP_STRATEGIES
+    elif keep_strategy == "copy":
+        strategies = ["copy"]
+    else:
+        strategies = [keep_strategy, "copy"]
+    device = os.stat(oldPath).st_dev
+
+    for strategy in strategies:
+        if (strategy, device) in failed_strategies:
+            continue
+        try:
+            if strategy == "reflink":
+                reflinkFile(oldPath, newPath)
+                shutil.copystat(oldPath, newPath)
+            elif strategy == "hardlink":
+                os.link(oldPath, newPath)
+            else:
+                kernelCopyFile(oldPath, newPath)
+                shutil.copystat(oldPath, newPath)
+            return strategy
+        except (OSError, ImportError) as e:
+            if strategy == "copy":
+                raise
+            log.debug(f"Unable to {strategy} {oldPath}, trying the next strategy. {e}")
+            # Only skip the strategy for other files if the platform or filesystems don't support it,
+            # other failures, like too many links to one file, only fall back for this file
+            if isinstance(e, ImportError) or e.errno in UNSUPPORTED_ERRNOS:
+                failed_strategies.add((strategy, device))
+            if strategy == "reflink" and os.path.isfile(newPath):
+                os.remove(newPath)
+
+
+def transferFile(keep, oldPath, newPath, errors, keep_strategy="auto", failed_strategies=None):
+    """
+    Moves a file, or copies it if keep is True, into a directory that already exists.
+    Moves use os.rename() and fall back to shutil.move() across filesystems.
+    Copies use copyFile() with the keep_strategy.
+
+    Returns:
+        errors (List): List of Error objects defined in models.py
+    """
     try:
         log.debug("from: " + str(oldPath))
         log.debug("to: " + str(newPath))
         if keep:
-            shutil.copy2(oldPath, newPath)
+            copyFile(oldPath, newPath, keep_strategy, failed_strategies)
         else:
-            shutil.move(oldPath, newPath)
+            try:
+                os.rename(oldPath, newPath)
+            except OSError:
+                shutil.move(oldPath, newPath)
     except IOError as e:
-        log.error("Unable to move file. %s" % e)
+        if keep:
+            desc = "Unable to copy " + str(oldPath) + " into the mailbag"
+        else:
+            desc = "Unable to move " + str(oldPath) + " into the mailbag"
+        errors = common.handle_error(errors, e, desc)
+    return errors
 
 
-def getFileBeforeAfterPath(source_parent_dir, mailbag_dir, mailbag_name, input, file):
+def moveFile(dry_run, keep, oldPath, newPath, keep_strategy="auto"):
+    os.makedirs(os.path.dirname(newPath), exist_ok=True)
+    transferFile(keep, oldPath, newPath, [], keep_strategy)
+
+
+class FileMover:
     """
-    Creates file paths for input mail files and new paths. This is really for moving hierarchies of
-    EML or MSG files, as the we need to recreate the directory structure relative to source_parent_dir
-    in the mailbag. However, this is called for moving (copy with --keep) all source files into the
-    mailbag, including single PST or MBOX files and companion files, which also may have relative
-    subdirectories that need to be recreated.
+    Moves source files into the mailbag (or copies them with --keep) while maintaining the input data's directory structure.
+    The source directory is resolved once and created directories are remembered, so moving many files
+    does not repeat the same filesystem calls. Source directories that are emptied by moves
+    are removed in one pass by prune() once all files are moved.
 
     Parameters:
+        dry_run (Boolean): option to perform a test creation of a mailbag
+        keep (Boolean): option to preserve source data
         source_parent_dir (String): Parent directory of the source files
         mailbag_dir (String): Path where the mailbag will be written
         mailbag_name (String): Mailbag name
         input (String): Email file format to be packaged into a mailbag
-        file (String): Email file path
-
-    Returns:
-        full_source_parent_path (Path): Absolute path for source_parent_dir
-        full_file_path (Path): Absolute path for file that is being moved
-        file_new_path (str): Output path where the file will be moved
-        relative_path (Path): Path for file relative to source directory. Used for logging/debugging.
+        keep_strategy (String): How to copy files with --keep: auto, reflink, hardlink, or copy
     """
-    full_source_parent_path = Path(source_parent_dir).resolve()
-    full_file_path = Path(file).resolve()
-
-    relative_path = full_file_path.relative_to(full_source_parent_path).parents[0]
-    filename = full_file_path.name
 
-    folder_new = os.path.join(mailbag_dir, "data", input)
-    file_new_path = os.path.join(folder_new, relative_path, filename)
+    def __init__(self, dry_run, keep, source_parent_dir, mailbag_dir, mailbag_name, input, keep_strategy="auto"):
+        self.dry_run = dry_run
+        self.keep = keep
+        self.keep_strategy = keep_strategy
+        # (strategy, device) pairs that are not supported, so they are not tried again for every file on a device
+        self.failed_strategies = set()
+        self.input = input
+        self.source_parent_path = os.path.abspath(source_parent_dir)
+        self.folder_new = os.path.join(mailbag_dir, "data", input)
+        self.created_dirs = set()
+        self.source_dirs = set()
+
+    def move(self, file, errors):
+        """
+        Moves a single email file or companion file
+
+        Parameters:
+            file (String): Email file path
+            errors (List): List of Error objects for the message defined in models.py. Companion files do not have error objects since they are not messages. In that case errors should be an empty list ([]).
+
+        Returns:
+            file_new_path (String): The path where the file was moved
+            errors (List): List of Error objects defined in models.py
+        """
+        full_file_path = os.path.abspath(file)
+        source_dir, filename = os.path.split(full_file_path)
+        relative_path = os.path.relpath(source_dir, self.source_parent_path)
+        new_dir = os.path.normpath(os.path.join(self.folder_new, relative_path))
+        file_new_path = os.path.join(new_dir, filename)
+
+        if self.keep:
+            verb = "Copying"
+        else:
+            verb = "Moving"
+        if file.lower().endswith("." + self.input.lower()):
+            log.debug(f"{verb}: {full_file_path} to: {file_new_path} SubFolder: {relative_path}")
+        else:
+            log.debug(f"{verb} companion file: {full_file_path} to: {file_new_path} SubFolder: {relative_path}")
+
+        errors = common.check_path_length(file_new_path, errors)
+        if not self.dry_run:
+            if not new_dir in self.created_dirs:
+                os.makedirs(new_dir, exist_ok=True)
+                self.created_dirs.add(new_dir)
+            errors = transferFile(self.keep, full_file_path, file_new_path, errors, self.keep_strategy, self.failed_strategies)
+            self.source_dirs.add(source_dir)
+
+        return file_new_path, errors
+
+    def prune(self):
+        """
+        Cleans up the old directory structure by removing source directories that are empty after moving files
+        """
+        if self.keep:
+            return
+        # deepest directories first, so parents are empty by the time they are checked
+        for source_dir in sorted(self.source_dirs, key=lambda path: path.count(os.sep), reverse=True):
+            p = source_dir
+            while p != os.path.dirname(p) and p != self.source_parent_path and p.startswith(self.source_parent_path):
+                try:
+                    os.rmdir(p)
+                except OSError:
+                    # not empty, or already removed
+                    break
+                log.debug("Cleaning: " + p)
+                # dirty hack since rmdir is not synchronous on Windows
+                if os.name == "nt":
+                    import time
 
-    return full_source_parent_path, full_file_path, file_new_path, relative_path
+                    time.sleep(0.01)
+                p = os.path.dirname(p)
+        self.source_dirs = set()
 
 
 def moveWithDirectoryStructure(dry_run, keep, source_parent_dir, mailbag_dir, mailbag_name, input, file, errors):
     """
     Create new mailbag directory structure while maintaining the input data's directory structure.
-    Uses for both email files matching the input file extension and companion files if that option is selected
+    Moves a single file with FileMover. Formats that move many files should use a FileMover directly.
 
     Parameters:
         dry_run (Boolean): option to perform a test creation of a mailbag
@@ -367,34 +986,9 @@ def moveWithDirectoryStructure(dry_run, keep, source_parent_dir, mailbag_dir, ma
         file_new_path (Path): The path where the file was moved
         errors (List): List of Error objects defined in models.py
     """
-    full_source_parent_path, full_file_path, file_new_path, relative_path = getFileBeforeAfterPath(
-        source_parent_dir, mailbag_dir, mailbag_name, input, file
-    )
-    if keep:
-        verb = "Copying"
-    else:
-        verb = "Moving"
-    if file.lower().endswith("." + input.lower()):
-        log.debug(f"{verb}: {str(full_file_path)} to: {str(file_new_path)} SubFolder: {str(relative_path)}")
-    else:
-        log.debug(f"{verb} companion file: {str(full_file_path)} to: {str(file_new_path)} SubFolder: {str(relative_path)}")
-
-    errors = common.check_path_length(file_new_path, errors)
-    if not dry_run:
-        moveFile(dry_run, keep, full_file_path, file_new_path)
-        # clean up old directory structure
-        p = full_file_path.parents[0]
-        while p != p.root and p != full_source_parent_path:
-            if not os.listdir(p):
-                log.debug("Cleaning: " + str(p))
-                os.rmdir(p)
-                # dirty hack since rmdir is not synchronous on Windows
-                if os.name == "nt":
-                    import time
-
-                    time.sleep(0.01)
-            p = p.parent
-
+    mover = FileMover(dry_run, keep, source_parent_dir, mailbag_dir, mailbag_name, input)
+    file_new_path, errors = mover.move(file, errors)
+    mover.prune()
     return file_new_path, errors
 
 
@@ -1,5 +1,7 @@
 from jsonmodels import models, fields, errors, validators
 from email.message import Message
+import email.policy
+from io import BytesIO
 import os, pickle
 
 
@@ -7,9 +9,76 @@ class Attachment(models.Base):
     Name = fields.StringField()
     WrittenName = fields.StringField()
     File = fields.EmbeddedField(bytes)
+    # Path to a temporary file holding the data of large attachments instead of File
+    FilePath = fields.StringField()
     MimeType = fields.StringField()
     Content_ID = fields.StringField()
 
+    def open(self):
+        """Returns a binary file object for the attachment data, whether it is in memory or spooled to disk"""
+        if self.FilePath:
+            return open(self.FilePath, "rb")
+        return BytesIO(self.File or b"")
+
+    def read(self):
+        """Returns the attachment data as bytes"""
+        if self.FilePath:
+            with open(self.FilePath, "rb") as f:
+                return f.read()
+        return self.File
+
+    @property
+    def size(self):
+        if self.FilePath:
+            return os.path.getsize(self.FilePath)
+        return len(self.File or b"")
+
+    def cleanup(self):
+        """Removes the temporary file of a spooled attachment"""
+        if self.FilePath:
+            if os.path.isfile(self.FilePath):
+                os.remove(self.FilePath)
+            self.FilePath = None
+
+
+class MessageSource:
+    """
+    The bytes an email.message.Message was parsed from. Records made by Email.to_record() carry
+    these instead of the parsed Message, which is parsed again the first time it is used.
+    """
+
+    def __init__(self, data, policy=email.policy.compat32):
+        self.data = data
+        self.policy = policy
+        self.message = None
+
+    def parse(self):
+        if self.message is None:
+            self.message = email.message_from_bytes(self.data, policy=self.policy)
+        return self.message
+
+    def __getstate__(self):
+        # Only the bytes are passed between processes
+        return {"data": self.data, "policy": self.policy, "message": None}
+
+
+class MessageField(fields.EmbeddedField):
+    """Field for an email.message.Message, which can be set to a MessageSource to parse it when it is first read"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__([Message, MessageSource], *args, **kwargs)
+
+    def __get__(self, instance, owner=None):
+        value = super().__get__(instance, owner)
+        if isinstance(value, MessageSource):
+            return value.parse()
+        return value
+
+    def stored_value(self, instance):
+        """Returns the MessageSource if the field was set to one, without parsing it"""
+        self._check_value(instance)
+        return self.memory[instance._cache_key]
+
 
 class Error(models.Base):
     Level = fields.StringField()
@@ -33,14 +102,39 @@ class Email(models.Base):
     Bcc = fields.StringField()
     Subject = fields.StringField()
     Content_Type = fields.StringField()
-    Headers = fields.EmbeddedField(Message)
+    Headers = MessageField()
     HTML_Body = fields.StringField()
     HTML_Encoding = fields.StringField()
     Text_Body = fields.StringField()
     Text_Encoding = fields.StringField()
-    Message = fields.EmbeddedField(Message)
+    Message = MessageField()
     Attachments = fields.ListField(Attachment)
 
+    def to_record(self):
+        """
+        Returns the message as a plain dict of field values. Unlike Email objects, records can be
+        pickled, so this is used to pass messages back from worker processes.
+        Messages parsed from a MessageSource are passed as their source bytes.
+        """
+        record = {}
+        for name, field in self:
+            if isinstance(field, MessageField):
+                value = field.stored_value(self)
+            else:
+                value = getattr(self, name)
+            if isinstance(value, list):
+                value = [dict((subname, getattr(item, subname)) for subname, subfield in item) for item in value]
+            record[name] = value
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        """Creates an Email object from a dict made by to_record()"""
+        record = dict(record)
+        record["Errors"] = [Error(**error) for error in record["Errors"]]
+        record["Attachments"] = [Attachment(**attachment) for attachment in record["Attachments"]]
+        return cls(**record)
+
     def dump_string(self, value, outpath, encoding=None):
         with open(outpath + ".txt", "w", encoding="utf-8", newline="\n") as f:
             f.write(value)
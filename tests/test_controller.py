@@ -2,7 +2,8 @@ import pytest
 import os
 from mailbagit.controller import Controller
 from mailbagit.email_account import EmailAccount
-from mailbagit.models import Email
+from mailbagit.models import Email, Attachment
+import mailbagit.helper.controller as controller
 from mailbagit.formats import mbox, msg, pst
 from argparse import Namespace
 
@@ -100,3 +101,16 @@ def test_organizeFileStructure():
     # Assumes data/sample1.msg file exists
     assert os.path.exists(os.path.join('data', 'faculty', 'data', 'msg', 'sample1.msg')) is True
 """
+
+
+def test_writeAttachment_dedup(tmp_path):
+    attachment_index = {}
+    for i, data in enumerate([b"logo" * 1000, b"report" * 1000, b"logo" * 1000]):
+        (tmp_path / str(i)).mkdir()
+        controller.writeAttachment(Attachment(File=data), str(tmp_path / str(i) / "file.bin"), attachment_index)
+
+    assert [(tmp_path / str(i) / "file.bin").read_bytes()[:6] for i in range(3)] == [b"logolo", b"report", b"logolo"]
+    assert os.path.samefile(str(tmp_path / "0" / "file.bin"), str(tmp_path / "2" / "file.bin"))
+    assert len(attachment_index) == 2
+    # Temporary files are renamed or removed
+    assert [os.listdir(str(tmp_path / str(i))) for i in range(3)] == [["file.bin"]] * 3
@@ -0,0 +1,422 @@
+import csv
+import glob
+import os
+import email
+import mailbox
+import importlib
+import sys
+import threading
+import time
+from bs4 import BeautifulSoup
+import mailbagit.helper.derivative as derivative
+import mailbagit.helper.common as common
+from mailbagit.models import Email, Attachment
+from mailbagit.derivatives.html import HtmlDerivative
+from mailbagit.derivatives.mbox import MboxDerivative
+import mailbagit.derivatives.pdf_chrome as pdf_chrome
+from mailbagit.derivatives.warc import WarcDerivative
+from warcio.archiveiterator import ArchiveIterator
+from argparse import Namespace
+import pytest
+
+# tags and attributes scanned for inline images and WARC external resources
+tag_attrs = {"img": "src", "link": "href", "a": "href", "object": "data", "source": "src", "script": "src", "iframe": "src"}
+
+sample_html = [
+    '<p>A<img src="cid:logo.png@01D5"><img SRC=http://example.com/a.png><img src></p><a href="http://a.com">x</a><a>y</a>',
+    '<html><head><link rel=stylesheet href="style.css"><script>var x = "<img src=no.png>";</script></head>'
+    + '<body><img src="a.png" src="b.png"/><object data="&amp;x.swf"></object></body></html>',
+]
+for body in glob.glob(os.path.join("data", "*", "*", "HTML_Body.txt")):
+    with open(body, "r", encoding="utf-8") as f:
+        sample_html.append(f.read())
+
+
+@pytest.mark.parametrize("html_string", sample_html)
+def test_scanTags(html_string):
+    # The streaming tokenizer should find the same values as a full BeautifulSoup parse
+    values = derivative.scanTags(html_string, tag_attrs)
+    soup = BeautifulSoup(html_string, "html.parser")
+    for tag, attr in tag_attrs.items():
+        assert values[tag] == [found.get(attr) for found in soup.find_all(tag)]
+
+
+def test_htmlParser():
+    assert derivative.htmlParser("html.parser") == "html.parser"
+    if importlib.util.find_spec("lxml"):
+        assert derivative.htmlParser("lxml") == "lxml"
+    else:
+        assert derivative.htmlParser("lxml") == "html.parser"
+
+
+def test_resolveCID():
+    attachments = [
+        Attachment(Name="image001.png", Content_ID="<part1.ABC@example.com>"),
+        Attachment(Name="Logo.PNG", Content_ID="f0e1d2c3"),
+        Attachment(Name="report.pdf", Content_ID="a1b2c3d4"),
+    ]
+    message = Email(Attachments=attachments)
+    assert derivative.resolveCID(message, "part1.ABC@example.com") == 0
+    assert derivative.resolveCID(message, "image001.png@01D5A2B3.C4D5E6F0") == 0
+    assert derivative.resolveCID(message, "logo.png") == 1
+    assert derivative.resolveCID(message, "logo@example.com") == 1
+    assert derivative.resolveCID(message, "a1b2c3d4") == 2
+    assert derivative.resolveCID(message, "missing.png@01D5") is None
+
+
+def test_inlineContentIDs():
+    attachments = [Attachment(Name="image001.png", Content_ID="<part1.ABC@example.com>"), Attachment(Name="report.pdf")]
+    html_body = '<p><img src="cid:part1.ABC@example.com"><IMG SRC=cid:missing.png><img src="image001.png"></p>'
+    messages = [Email(HTML_Body=html_body, HTML_Encoding="utf-8", Attachments=attachments) for i in range(2)]
+    derivative.parseHTML(messages[1])
+
+    for message in messages:
+        assert derivative.inlineContentIDs(message) == {0: "part1.ABC@example.com"}
+    # The body is only scanned, not parsed, unless it was already parsed for another derivative
+    assert ("parsed", "html.parser") not in messages[0].html_cache
+
+
+def test_htmlFormatting_link_images(tmp_path):
+    attachment = Attachment(Name="logo.png", WrittenName="logo.png", File=b"\x89PNG", Content_ID="abc123")
+    message = Email(Mailbag_Message_ID=1, HTML_Body='<p><img src="cid:logo.png@01D5"></p>', HTML_Encoding="utf-8", Attachments=[attachment])
+
+    # Embedded until the attachment is written
+    html_formatted, encoding = derivative.htmlFormatting(message, None, headers=False, link_images=True)
+    assert "data:image;base64," in html_formatted
+
+    attachment.written_path = os.path.join(str(tmp_path), "data", "attachments", "1", "logo.png")
+    html_dir = os.path.join(str(tmp_path), "data", "html")
+    html_formatted, encoding = derivative.htmlFormatting(message, None, headers=False, link_images=True, html_dir=html_dir)
+    assert 'src="../attachments/1/logo.png"' in html_formatted
+    html_formatted, encoding = derivative.htmlFormatting(message, None, link_images=True)
+    assert 'src="file://' in html_formatted
+    html_formatted, encoding = derivative.htmlFormatting(message, None, headers=False)
+    assert "data:image;base64," in html_formatted
+
+
+def test_plainTextFormatting():
+    text_body = "Hello <someone@example.com> & co\n\n    indented line\nlast line"
+    message = Email(
+        Mailbag_Message_ID=1, Subject="Hello", From="me@example.com", Text_Body=text_body, Text_Encoding="ascii", Attachments=[]
+    )
+    html_formatted, encoding = derivative.htmlFormatting(message, None)
+    assert encoding == "utf-8"
+
+    soup = BeautifulSoup(html_formatted, "html.parser")
+    assert soup.find("section", id="mailbagPlainText").get_text() == text_body
+    assert soup.head.meta["charset"] == "utf-8"
+    styles = soup.head.find_all("style")
+    assert styles[0].string.strip() == "#mailbagPlainText{white-space: pre;}"
+    assert styles[1].string.strip() == derivative.DEFAULT_CSS.strip()
+    assert soup.find("section", id="mailbagHeaders").h2.string == "Hello"
+
+    html_formatted, encoding = derivative.htmlFormatting(message, None, headers=False)
+    assert BeautifulSoup(html_formatted, "html.parser").find("section", id="mailbagHeaders") is None
+
+
+def test_htmlFormatting_compact(tmp_path):
+    css = tmp_path / "custom.css"
+    css.write_text("p { color: red; }")
+    message = Email(Mailbag_Message_ID=1, Subject="Hello", HTML_Body="<p>Some <b>bold</b> text</p>", HTML_Encoding="utf-8", Attachments=[])
+    pretty, encoding = derivative.htmlFormatting(message, str(css))
+    compact, encoding = derivative.htmlFormatting(message, str(css), compact=True)
+    assert len(compact) < len(pretty)
+    assert "<p>Some <b>bold</b> text</p>" in compact
+    assert "p { color: red; }" in compact
+
+    # The CSS file is only read once per run
+    css.write_text("p { color: blue; }")
+    assert derivative.styleCSS(str(css)).endswith("p { color: red; }")
+
+
+class SlowRenderer:
+    def __init__(self, log):
+        self.log = log
+
+    def render(self, message, delay):
+        time.sleep(delay)
+        self.log.append(message.Mailbag_Message_ID)
+        if message.Mailbag_Message_ID == 2:
+            raise ValueError("bad message")
+        return []
+
+    def close(self):
+        self.log.append("closed")
+
+
+def test_RenderPool():
+    rendered = []
+    pool = derivative.RenderPool(lambda: SlowRenderer(rendered), workers=2)
+    messages = [Email(Mailbag_Message_ID=i, Errors=[]) for i in range(1, 6)]
+    for message in messages:
+        pool.submit(message, 0.05)
+    assert len(pool.pending_messages()) > 0
+    pool.close()
+
+    assert pool.pending_messages() == set()
+    assert sorted(message_id for message_id in rendered if message_id != "closed") == [1, 2, 3, 4, 5]
+    assert rendered.count("closed") == 2
+    assert [len(message.Errors) for message in messages] == [0, 1, 0, 0, 0]
+
+
+class FlakyRenderer:
+    def __init__(self, attempts):
+        self.attempts = attempts
+
+    def render(self, message, fail_times):
+        self.attempts[message.Mailbag_Message_ID] = self.attempts.get(message.Mailbag_Message_ID, 0) + 1
+        if self.attempts[message.Mailbag_Message_ID] <= fail_times:
+            return common.handle_error([], None, "Failed to render", "error")
+        return common.handle_error([], None, "Rendered with a warning", "warn")
+
+    def close(self):
+        pass
+
+
+def test_RenderPool_retry():
+    attempts = {}
+    pool = derivative.RenderPool(lambda: FlakyRenderer(attempts), workers=2, retry=True)
+    messages = [Email(Mailbag_Message_ID=i, Errors=[]) for i in range(3)]
+    for fail_times, message in enumerate(messages):
+        pool.submit(message, fail_times)
+    pool.close()
+
+    # Failures are retried once at the end, and only the errors from the last attempt are kept
+    assert attempts == {0: 1, 1: 2, 2: 2}
+    assert [[error.Level for error in message.Errors] for message in messages] == [["warn"], ["warn"], ["error"]]
+
+
+def test_htmlFormatting_failure(monkeypatch):
+    attachments = [Attachment(Name="image001.png", Content_ID="<part1.ABC@example.com>", File=b"png")]
+    message = Email(
+        Subject="Inline image", HTML_Body='<p><img src="cid:part1.ABC@example.com"></p>', HTML_Encoding="utf-8", Attachments=attachments
+    )
+
+    def failing_read():
+        raise IOError("Unable to read attachment")
+
+    monkeypatch.setattr(attachments[0], "read", failing_read, raising=False)
+    with pytest.raises(IOError):
+        derivative.htmlFormatting(message, None, headers=True)
+    monkeypatch.undo()
+
+    # The shared soup does not keep the headers table or rewritten images from the failed variant
+    html_content, encoding = derivative.htmlFormatting(message, None, headers=False)
+    assert "<h2>Inline image</h2>" not in html_content
+    assert "data:image;base64," in html_content
+    assert derivative.parseHTML(message)["cid_tags"][0][0]["src"] == "cid:part1.ABC@example.com"
+
+
+def test_RenderPool_renderer_failure():
+    def make_renderer():
+        raise OSError("Unable to start browser")
+
+    pool = derivative.RenderPool(make_renderer, workers=2)
+    messages = [Email(Mailbag_Message_ID=i, Errors=[]) for i in range(10)]
+
+    # More messages than the queue holds, so this would block if the threads stopped taking jobs
+    def render_all():
+        for message in messages:
+            pool.submit(message)
+        pool.close()
+
+    thread = threading.Thread(target=render_all, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert pool.pending_messages() == set()
+    assert [[error.Level for error in message.Errors] for message in messages] == [["error"]] * 10
+
+
+def test_HtmlDerivative_default_options(tmp_path):
+    message = Email(
+        Mailbag_Message_ID=1,
+        Derivatives_Path="",
+        Headers=email.message_from_string("Subject: Defaults\n\n"),
+        HTML_Body="<p>Body</p>",
+        HTML_Encoding="utf-8",
+        Attachments=[],
+        Errors=[],
+    )
+    # Options added after the args were first built, like --html-parser, default to the CLI defaults
+    args = Namespace(dry_run=False, css=None)
+    html_derivative = HtmlDerivative(None, args, str(tmp_path / "bag"))
+    assert (html_derivative.html_parser, html_derivative.link_images, html_derivative.compact_html) == ("html.parser", False, False)
+    html_derivative.do_task_per_message(message)
+    assert message.Errors == []
+    with open(str(tmp_path / "bag" / "data" / "html" / "1.html"), "r", encoding="utf-8") as f:
+        assert "<p>\n   Body\n  </p>" in f.read()
+
+
+def test_WarcDerivative_spooled_attachment(tmp_path):
+    data = bytes(range(256)) * 1000
+    spool_path = tmp_path / "spooled.tmp"
+    spool_path.write_bytes(data)
+    attachments = [
+        Attachment(
+            Name="large.bin", WrittenName="large.bin", FilePath=str(spool_path), MimeType="application/octet-stream", Content_ID="a1"
+        ),
+        Attachment(Name="small.txt", WrittenName="small.txt", File=b"small", MimeType="text/plain", Content_ID="a2"),
+    ]
+    message = Email(
+        Mailbag_Message_ID=1,
+        Message_ID="<spooled@example.com>",
+        Derivatives_Path="",
+        Headers=email.message_from_string("Subject: Spooled\n\n"),
+        HTML_Body="<p>Attachments</p>",
+        HTML_Encoding="utf-8",
+        Attachments=attachments,
+        Errors=[],
+    )
+    args = Namespace(dry_run=False, css=None, external_links=False)
+    WarcDerivative(None, args, str(tmp_path / "bag")).do_task_per_message(message)
+    assert message.Errors == []
+
+    # Attachments are streamed from spool files and from memory
+    payloads = {}
+    with open(str(tmp_path / "bag" / "data" / "warc" / "1.warc.gz"), "rb") as f:
+        for record in ArchiveIterator(f):
+            if record.rec_type != "response":
+                continue
+            # The records are written with a text/html WARC content type, so the HTTP headers are part of the payload
+            http_headers, payload = record.content_stream().read().split(b"\r\n\r\n", 1)
+            payloads[record.rec_headers.get_header("WARC-Target-URI")] = payload
+    assert payloads["mailto:spooled@example.com/large.bin"] == data
+    assert payloads["mailto:spooled@example.com/small.txt"] == b"small"
+
+
+def test_MboxDerivative_open_files(tmp_path):
+    args = Namespace(dry_run=False, mailbag="bag")
+    mbox_derivative = MboxDerivative(None, args, str(tmp_path))
+    mbox_derivative.max_open_files = 2
+    folders = ["Inbox", "Sent", "Inbox", "Archive", "Inbox", "Sent"]
+    for i, folder in enumerate(folders, start=1):
+        message = Email(Mailbag_Message_ID=i, Derivatives_Path=folder, Errors=[])
+        message.Message = email.message_from_string("Subject: Message " + str(i) + "\n\nFrom the body of message " + str(i) + "\n")
+        message.Message.set_unixfrom("From sender@example.com Sat Jan  1 00:00:00 2022")
+        mbox_derivative.do_task_per_message(message)
+        assert message.Errors == []
+        assert len(mbox_derivative.open_files) <= 2
+    mbox_derivative.do_task_per_account()
+    assert mbox_derivative.open_files == {}
+
+    for folder in set(folders):
+        path = os.path.join(str(tmp_path), "data", "mbox", folder + ".mbox")
+        mbox = mailbox.mbox(path)
+        subjects = [mbox_message["Subject"] for mbox_message in mbox]
+        assert subjects == ["Message " + str(i) for i, name in enumerate(folders, start=1) if name == folder]
+        assert ">From the body" in mbox[0].get_payload()
+        # Files are written the same way as the mailbox module writes them
+        expected = mailbox.mbox(str(tmp_path / (folder + ".mbox")))
+        for mbox_message in mbox:
+            expected.add(mbox_message)
+        expected.close()
+        with open(path, "rb") as f, open(str(tmp_path / (folder + ".mbox")), "rb") as expected_file:
+            assert f.read() == expected_file.read()
+
+
+def test_MboxDerivative_max_size(tmp_path):
+    args = Namespace(dry_run=False, mailbag="bag", html_parser="html.parser", mbox_max_size=1)
+    mbox_derivative = MboxDerivative(None, args, str(tmp_path))
+    mbox_derivative.max_size = 150
+    for i in range(1, 6):
+        message = Email(Mailbag_Message_ID=i, Derivatives_Path="Inbox", Errors=[])
+        message.Message = email.message_from_string("Subject: Message " + str(i) + "\n\nBody of message " + str(i) + "\n")
+        mbox_derivative.do_task_per_message(message)
+        assert message.Errors == []
+    mbox_derivative.do_task_per_account()
+
+    mbox_dir = os.path.join(str(tmp_path), "data", "mbox")
+    assert sorted(os.listdir(mbox_dir)) == ["Inbox.0001.mbox", "Inbox.0002.mbox", "Inbox.0003.mbox"]
+    # The index is a tag file next to mailbag.csv, not in the mbox derivatives directory
+    with open(os.path.join(str(tmp_path), "mbox-index.csv"), "r", encoding="utf-8", newline="") as f:
+        index = list(csv.DictReader(f))
+    files = ["data/mbox/Inbox.0001.mbox", "data/mbox/Inbox.0002.mbox", "data/mbox/Inbox.0003.mbox"]
+    assert [row["File"] for row in index] == files[:1] * 2 + files[1:2] * 2 + files[2:]
+    for row in index:
+        with open(os.path.join(str(tmp_path), row["File"]), "rb") as f:
+            f.seek(int(row["Offset"]))
+            mbox_message = email.message_from_bytes(f.read(int(row["Length"])))
+        assert mbox_message.get_unixfrom().startswith("From ")
+        assert mbox_message["Subject"] == "Message " + row["Mailbag-Message-ID"]
+
+
+# A fake Chrome for the DevTools pipe client. It reads null-terminated JSON commands from fd 3,
+# writes responses to fd 4, "prints" the HTML as the PDF, and stops reading when the HTML contains HANG.
+FAKE_CHROME = """
+import base64, json, os, sys, time, urllib.parse
+
+commands, responses = os.fdopen(3, "rb", buffering=0), os.fdopen(4, "wb", buffering=0)
+buffer, html = b"", ""
+
+
+def send(response):
+    responses.write(json.dumps(response).encode("utf-8") + b"\\0")
+
+
+while True:
+    chunk = commands.read(65536)
+    if not chunk:
+        break
+    buffer += chunk
+    while b"\\0" in buffer:
+        command, buffer = buffer.split(b"\\0", 1)
+        command = json.loads(command)
+        method, params, session = command["method"], command["params"], command.get("sessionId")
+        result = {}
+        if method == "Target.createTarget":
+            result = {"targetId": "target"}
+        elif method == "Target.attachToTarget":
+            result = {"sessionId": "session"}
+        elif method == "Page.getFrameTree":
+            result = {"frameTree": {"frame": {"id": "frame"}}}
+        elif method == "Page.setDocumentContent":
+            html = params["html"]
+            if "HANG" in html:
+                time.sleep(60)
+        elif method == "Page.navigate":
+            with open(urllib.parse.unquote(urllib.parse.urlparse(params["url"]).path), "r", encoding="utf-8") as f:
+                html = f.read()
+            send({"method": "Page.loadEventFired", "sessionId": session, "params": {}})
+        elif method == "Page.printToPDF":
+            result = {"data": base64.b64encode(b"%PDF-" + html.encode("utf-8")).decode("ascii")}
+        send({"id": command["id"], "sessionId": session, "result": result})
+        if method == "Browser.close":
+            sys.exit(0)
+"""
+
+
+@pytest.fixture
+def fake_chrome(tmp_path, monkeypatch):
+    if os.name != "posix":
+        raise pytest.skip("The DevTools pipe needs POSIX fds")
+    path = tmp_path / "fake-chrome"
+    path.write_text("#!" + sys.executable + "\n" + FAKE_CHROME)
+    path.chmod(0o755)
+    monkeypatch.setattr(pdf_chrome, "chrome", str(path))
+
+
+def test_ChromeBrowser(tmp_path, fake_chrome):
+    browser = pdf_chrome.ChromeBrowser(10)
+    browser.render(str(tmp_path / "1.pdf"), html="<p>Sent over the pipe</p>")
+    (tmp_path / "2.html").write_text("<p>Loaded from a file</p>", encoding="utf-8")
+    browser.render(str(tmp_path / "2.pdf"), html_name=str(tmp_path / "2.html"))
+    browser.close()
+
+    assert (tmp_path / "1.pdf").read_bytes() == b"%PDF-<p>Sent over the pipe</p>"
+    assert (tmp_path / "2.pdf").read_bytes() == b"%PDF-<p>Loaded from a file</p>"
+    assert browser.process.returncode == 0
+    assert not os.path.exists(browser.profile_dir)
+
+
+def test_ChromeBrowser_timeout(tmp_path, fake_chrome):
+    browser = pdf_chrome.ChromeBrowser(1)
+    with pytest.raises(TimeoutError):
+        browser.render(str(tmp_path / "1.pdf"), html="<p>HANG</p>")
+
+    # A page larger than the pipe buffer can't block writing to a Chrome that stopped reading
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        browser.call("Page.setDocumentContent", {"frameId": browser.frame, "html": "x" * 4 * 1024 * 1024}, browser.session)
+    assert time.monotonic() - start < 5
+    browser.close(kill=True)
@@ -1,11 +1,19 @@
 from mailbagit.controller import Controller
-from mailbagit.models import Email
+from mailbagit.models import Email, Attachment, MessageSource
+from mailbagit.formats.eml import parse_eml
+import mailbagit.formats.msg as msg
+import mailbagit.helper.format as format
 from argparse import Namespace
 from mailbagit.email_account import EmailAccount
 import mailbagit
 import pytest
 import email
+import errno
+import io
 import os
+import pickle
+import shutil
+import sys
 
 # This is a mock object representing the args returned from argparse/Gooey
 @pytest.fixture
@@ -179,3 +187,515 @@ def test_PST(cli_args):
                     assert match == True
             else:
                 assert str(getattr(message, field[0])).strip() == str(getattr(expected, field[0])).strip()
+
+
+def test_EML_discovery(cli_args, tmp_path):
+    for path in ["inbox/b.eml", "inbox/notes.txt", "a.EML", "New_Mailbag/data/eml/a.eml"]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_bytes(b"Subject: test\n\nbody\n")
+    cli_args.path = str(tmp_path)
+    cli_args.companion_files = True
+
+    source_parent_dir, mailbag_dir, mailbag_name = setup_paths(cli_args)
+    account = EmailAccount.registry["eml"](cli_args, source_parent_dir, mailbag_dir, mailbag_name)
+    fileList, companion_files = account.file_lists
+
+    assert account.number_of_messages == 2
+    assert fileList == [str(tmp_path / "a.EML"), str(tmp_path / "inbox" / "b.eml")]
+    assert companion_files == [str(tmp_path / "inbox" / "notes.txt")]
+
+
+def test_EML_parallel(cli_args, tmp_path):
+    testfile = os.path.join("data", "2016-06-23_144430_6e449c77fe.eml")
+    with open(testfile, "rb") as f:
+        eml = f.read()
+    for i in range(5):
+        (tmp_path / "inbox").mkdir(exist_ok=True)
+        (tmp_path / "inbox" / f"{i}.eml").write_bytes(eml)
+    cli_args.path = str(tmp_path)
+
+    source_parent_dir, mailbag_dir, mailbag_name = setup_paths(cli_args)
+    messages = {}
+    for processes in [1, 2]:
+        cli_args.processes = processes
+        account = EmailAccount.registry["eml"](cli_args, source_parent_dir, mailbag_dir, mailbag_name)
+        messages[processes] = [
+            (message.Original_File, message.Subject, message.HTML_Body, message.Message.as_bytes(), message.Headers is message.Message)
+            for message in account.messages()
+        ]
+
+    assert len(messages[2]) == 5
+    assert messages[1] == messages[2]
+
+
+def test_MSG_parallel(cli_args, tmp_path):
+    testfile = os.path.join("data", "Digitization Archiving Solutions.msg")
+    for i in range(5):
+        (tmp_path / "inbox").mkdir(exist_ok=True)
+        shutil.copyfile(testfile, tmp_path / "inbox" / f"{i}.msg")
+    cli_args.path = str(tmp_path)
+
+    source_parent_dir, mailbag_dir, mailbag_name = setup_paths(cli_args)
+    messages = {}
+    for processes in [1, 2]:
+        cli_args.processes = processes
+        account = EmailAccount.registry["msg"](cli_args, source_parent_dir, mailbag_dir, mailbag_name)
+        messages[processes] = [
+            (message.Original_File, message.Subject, message.HTML_Body, message.Text_Body, len(message.Errors))
+            for message in account.messages()
+        ]
+
+    assert len(messages[2]) == 5
+    assert [message[0] for message in messages[2]] == [os.path.join("inbox", f"{i}.msg") for i in range(5)]
+    assert messages[1] == messages[2]
+
+
+def test_parse_msg_closes(monkeypatch):
+    testfile = os.path.join("data", "Digitization Archiving Solutions.msg")
+    opened = []
+    openMsg = msg.extract_msg.openMsg
+
+    def recordingOpenMsg(*args, **kwargs):
+        mail = openMsg(*args, **kwargs)
+        close = mail.close
+        opened.append([mail, False])
+
+        def recordingClose():
+            opened[-1][1] = True
+            close()
+
+        mail.close = recordingClose
+        return mail
+
+    monkeypatch.setattr(msg.extract_msg, "openMsg", recordingOpenMsg)
+    message = msg.parse_msg(testfile, "Digitization Archiving Solutions.msg")
+    assert message.Subject == "The Crowley Company - Digitization & Archiving Solutions"
+    assert len(opened) == 1 and opened[0][1]
+
+    # The MSG is still closed when building the Email fails after it was opened
+    def failingEmail(**kwargs):
+        if "Message_ID" in kwargs:
+            raise ValueError("broken message")
+        return Email(**kwargs)
+
+    monkeypatch.setattr(msg, "Email", failingEmail)
+    message = msg.parse_msg(testfile, "Digitization Archiving Solutions.msg")
+    assert "Error parsing message" in message.Errors[-1].Description
+    assert len(opened) == 2 and opened[1][1]
+
+
+def test_Email_record():
+    testfile = os.path.join("data", "2016-06-23_144430_6e449c77fe.eml")
+    message = parse_eml(testfile, "2016-06-23_144430_6e449c77fe.eml")
+    record = pickle.loads(pickle.dumps(message.to_record()))
+
+    # Records carry the bytes of the EML instead of the parsed message
+    assert isinstance(record["Message"], MessageSource)
+    assert record["Message"].message is None
+    copy = Email.from_record(record)
+    assert copy.Message.as_bytes() == message.Message.as_bytes()
+    assert copy.Headers is copy.Message
+
+
+def fail_parse(filePath, originalFile):
+    raise ValueError("Unable to parse " + filePath)
+
+
+def test_parallelMessages_failure():
+    jobs = [("a.eml", "inbox/a.eml"), ("b.eml", "inbox/b.eml")]
+    messages = list(format.parallelMessages(fail_parse, jobs, 2, lambda job: job[1]))
+
+    assert [message.Original_File for message in messages] == ["inbox/a.eml", "inbox/b.eml"]
+    assert all(message.Errors[0].Level == "error" for message in messages)
+
+
+def test_PST_parallel(cli_args, tmp_path, monkeypatch):
+    if not "pst" in EmailAccount.registry:
+        raise pytest.skip("PST not installed, cannot test")
+    # split the sample folder into one job per message
+    monkeypatch.setattr(sys.modules[EmailAccount.registry["pst"].__module__], "PST_CHUNK_SIZE", 1)
+
+    testfile = "outlook2019_MSO_16.0.10377.20023_64-bit.pst"
+    shutil.copy(os.path.join("data", testfile), tmp_path / testfile)
+    cli_args.path = str(tmp_path)
+
+    source_parent_dir, mailbag_dir, mailbag_name = setup_paths(cli_args)
+    messages = {}
+    empty_folders = {}
+    for processes in [1, 2]:
+        cli_args.processes = processes
+        account = EmailAccount.registry["pst"](cli_args, source_parent_dir, mailbag_dir, mailbag_name)
+        messages[processes] = [(message.Message_Path, message.Message_ID, message.Text_Body) for message in account.messages()]
+        empty_folders[processes] = account.account_data.get("empty_folder_paths")
+        assert account.number_of_messages == len(messages[processes])
+
+    assert len(messages[2]) > 0
+    assert messages[1] == messages[2]
+    assert empty_folders[1] == empty_folders[2]
+
+
+def test_PST_census(cli_args):
+    if not "pst" in EmailAccount.registry:
+        raise pytest.skip("PST not installed, cannot test")
+
+    cli_args.path = os.path.join("data", "outlook2019_MSO_16.0.10377.20023_64-bit.pst")
+    source_parent_dir, mailbag_dir, mailbag_name = setup_paths(cli_args)
+    account = EmailAccount.registry["pst"](cli_args, source_parent_dir, mailbag_dir, mailbag_name)
+
+    assert account.number_of_messages == 2
+    assert account.census[cli_args.path] == {
+        "folders": [((1, 1, 0), "Top of Outlook data file/Inbox/Today at UAlbany", 2)],
+        "empty_folders": ["SPAM Search Folder 2", "Top of Outlook data file/Deleted Items", "Search Root"],
+    }
+
+
+def test_safely_decode_past_sample():
+    # The only non-ASCII text is after the sample used for charset detection
+    body = ("<p>" + "x" * 100 + "</p>\n") * 900 + "<p>café</p>"
+    binary_text = body.encode("utf-8")
+    assert len(binary_text) > format.CHARSET_SAMPLE_SIZE
+
+    errors = []
+    text, used, errors = format.safely_decode("HTML", binary_text, {}, errors)
+    assert text == body
+    assert errors == []
+
+
+def test_decodeDetected_memo(monkeypatch):
+    detected = []
+
+    def detect(binary_text, sample=True):
+        detected.append(binary_text)
+        return "utf-8" if binary_text.startswith(b"utf-8") else "windows-1251"
+
+    monkeypatch.setattr(format, "detectEncoding", detect)
+    monkeypatch.setattr(format, "detected_encodings", {})
+    # Permissive single byte encodings are detected every time, since they decode nearly anything
+    for body in ["Привет", "Здравствуйте"]:
+        text, used, e = format.decodeDetected(body.encode("windows-1251"), ["us-ascii"])
+        assert (text, used, e) == (body, "windows-1251", None)
+    assert len(detected) == 2
+    assert format.detected_encodings == {}
+
+    # Strict encodings are reused for the same failed labels
+    for body in ["utf-8 café", "utf-8 naïve"]:
+        text, used, e = format.decodeDetected(body.encode("utf-8"), ["ascii"])
+        assert (text, used, e) == (body, "utf-8", None)
+    assert len(detected) == 3
+    assert format.detected_encodings == {("ascii",): "utf-8"}
+    assert [format.strictEncoding(name) for name in ["utf-8", "shift_jis", "latin-1", "cp1252", "koi8-r"]] == [
+        True,
+        True,
+        False,
+        False,
+        False,
+    ]
+
+
+class FakeDeEncapsulator:
+    created = 0
+    fail = False
+
+    def __init__(self, rtf_body):
+        FakeDeEncapsulator.created += 1
+        self.rtf_body = rtf_body
+
+    def deencapsulate(self):
+        if FakeDeEncapsulator.fail:
+            raise ValueError("not encapsulated")
+        self.content_type = "html"
+        self.html = b"<html>" + self.rtf_body[:5] + b"</html>"
+
+
+def test_deencapsulate_rtf_cache(monkeypatch):
+    import RTFDE.deencapsulate
+
+    monkeypatch.setattr(RTFDE.deencapsulate, "DeEncapsulator", FakeDeEncapsulator)
+    monkeypatch.setattr(FakeDeEncapsulator, "created", 0)
+    monkeypatch.setattr(format, "rtf_cache", format.OrderedDict())
+    monkeypatch.setattr(format, "RTF_CACHE_SIZE", 2)
+
+    # Anything after the final closing bracket is dropped before de-encapsulating
+    assert format.deencapsulate_rtf(b"{\\rtf1 a}\x00\x00") == ("html", b"<html>{\\rtf</html>")
+    assert format.deencapsulate_rtf(b"{\\rtf1 a}\x00\x00") == ("html", b"<html>{\\rtf</html>")
+    assert FakeDeEncapsulator.created == 1
+    assert msg.deencapsulate_body(b"{\\rtf1 a}\x00\x00", msg.DeencapType.HTML) == b"<html>{\\rtf</html>"
+    assert msg.deencapsulate_body(b"{\\rtf1 a}\x00\x00", msg.DeencapType.PLAIN) is None
+    assert FakeDeEncapsulator.created == 1
+
+    # Failures are cached and re-raised, and extract_msg falls back to its own bodies
+    monkeypatch.setattr(FakeDeEncapsulator, "fail", True)
+    for i in range(2):
+        with pytest.raises(ValueError):
+            format.deencapsulate_rtf(b"{\\rtf1 b}")
+        assert msg.deencapsulate_body(b"{\\rtf1 b}", msg.DeencapType.HTML) is None
+    assert FakeDeEncapsulator.created == 2
+
+    # The least recently used body is evicted
+    monkeypatch.setattr(FakeDeEncapsulator, "fail", False)
+    format.deencapsulate_rtf(b"{\\rtf1 a}\x00\x00")
+    format.deencapsulate_rtf(b"{\\rtf1 c}")
+    assert len(format.rtf_cache) == 2 and FakeDeEncapsulator.created == 3
+    format.deencapsulate_rtf(b"{\\rtf1 a}\x00\x00")
+    assert format.deencapsulate_rtf(b"{\\rtf1 b}") == ("html", b"<html>{\\rtf</html>")
+    assert FakeDeEncapsulator.created == 4
+
+
+def test_parse_header_cache(monkeypatch):
+    decoded = []
+    decode_header_part = format.decode_header_part
+
+    def countingDecode(header_part, errors):
+        decoded.append(header_part)
+        return decode_header_part(header_part, errors)
+
+    monkeypatch.setattr(format, "decode_header_part", countingDecode)
+    monkeypatch.setattr(format, "header_cache", format.OrderedDict())
+    monkeypatch.setattr(format, "HEADER_CACHE_SIZE", 2)
+
+    # Plain headers are returned as they are, without being decoded or cached
+    assert format.parse_header("Plain subject", []) == ("Plain subject", [])
+    assert decoded == [] and len(format.header_cache) == 0
+
+    encoded = "=?utf-8?q?caf=C3=A9?= menu"
+    for i in range(2):
+        header, errors = format.parse_header(encoded, [])
+        assert header == "café menu" and errors == []
+    assert decoded == ["=?utf-8?q?caf=C3=A9?=", "menu"]
+
+    # The fast path matches the full decode for the same header
+    monkeypatch.setattr(format, "header_cache", format.OrderedDict())
+    assert format.parse_header(encoded, [])[0] == header
+    assert len(decoded) == 4
+
+    # The least recently used header is evicted
+    format.parse_header("=?utf-8?q?one?=", [])
+    format.parse_header(encoded, [])
+    format.parse_header("=?utf-8?q?two?=", [])
+    assert list(format.header_cache) == [encoded, "=?utf-8?q?two?="]
+
+
+def test_parse_part_decodes_once(monkeypatch):
+    message = email.message_from_bytes(
+        b"Content-Type: multipart/mixed; boundary=b\r\n\r\n"
+        b"--b\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: base64\r\n\r\nY2Fmw6k=\r\n"
+        b"--b\r\nContent-Type: application/pdf\r\nContent-Disposition: attachment; filename=a.pdf\r\n"
+        b"Content-Transfer-Encoding: base64\r\n\r\nJVBERg==\r\n"
+        b"--b--\r\n"
+    )
+    decoded = []
+    get_payload = email.message.Message.get_payload
+
+    def countingPayload(self, *args, **kwargs):
+        if kwargs.get("decode"):
+            decoded.append(self.get_content_type())
+        return get_payload(self, *args, **kwargs)
+
+    monkeypatch.setattr(email.message.Message, "get_payload", countingPayload)
+    bodies, attachments, errors = {}, [], []
+    for part in message.walk():
+        bodies, attachments, errors = format.parse_part(part, bodies, attachments, errors)
+
+    assert decoded == ["text/plain", "application/pdf"]
+    assert bodies["text_body"] == "café"
+    assert attachments[0].Name == "a.pdf" and attachments[0].File == b"%PDF"
+    assert errors == []
+
+
+def test_copyFile_fallback(tmp_path, monkeypatch):
+    for name in ["a.eml", "b.eml", "c.eml"]:
+        (tmp_path / name).write_bytes(b"Subject: " + name.encode() + b"\n\nBody\n")
+    (tmp_path / "mailbag").mkdir()
+    link = os.link
+    failures = [errno.EMLINK, errno.EXDEV]
+
+    def failing_link(src, dst):
+        if failures:
+            raise OSError(failures.pop(0), "link failed")
+        return link(src, dst)
+
+    monkeypatch.setattr(os, "link", failing_link)
+    failed_strategies = set()
+    strategies = [
+        format.copyFile(str(tmp_path / name), str(tmp_path / "mailbag" / name), "hardlink", failed_strategies)
+        for name in ["a.eml", "b.eml", "c.eml"]
+    ]
+
+    # Too many links only falls back for that file, but a cross-device link skips hardlinks for the rest of the device
+    assert strategies == ["copy", "copy", "copy"]
+    assert failed_strategies == {("hardlink", os.stat(str(tmp_path / "a.eml")).st_dev)}
+    failures.append(errno.EMLINK)
+    failed_strategies.clear()
+    assert format.copyFile(str(tmp_path / "a.eml"), str(tmp_path / "mailbag" / "d.eml"), "hardlink", failed_strategies) == "copy"
+    assert format.copyFile(str(tmp_path / "b.eml"), str(tmp_path / "mailbag" / "e.eml"), "hardlink", failed_strategies) == "hardlink"
+
+    errors = format.transferFile(True, str(tmp_path / "missing.eml"), str(tmp_path / "mailbag" / "missing.eml"), [])
+    assert [error.Level for error in errors] == ["error"]
+
+
+def test_copyFile_auto(tmp_path):
+    (tmp_path / "a.eml").write_bytes(b"Subject: a\n\nBody\n")
+    (tmp_path / "mailbag").mkdir()
+    strategy = format.copyFile(str(tmp_path / "a.eml"), str(tmp_path / "mailbag" / "a.eml"))
+
+    # auto never hardlinks, so changing the source does not change the mailbag
+    assert strategy in ["reflink", "copy"]
+    assert not os.path.samefile(str(tmp_path / "a.eml"), str(tmp_path / "mailbag" / "a.eml"))
+    (tmp_path / "a.eml").write_bytes(b"Subject: changed\n\nBody\n")
+    assert (tmp_path / "mailbag" / "a.eml").read_bytes() == b"Subject: a\n\nBody\n"
+
+
+def test_readAttachment(tmp_path, monkeypatch):
+    monkeypatch.setattr(format, "ATTACHMENT_CHUNK_SIZE", 100)
+    monkeypatch.setattr(format, "ATTACHMENT_SPOOL_SIZE", 1000)
+    reads = []
+
+    def reader(data):
+        buffer = io.BytesIO(data)
+
+        def read_buffer(size):
+            reads.append(size)
+            return buffer.read(size)
+
+        return read_buffer
+
+    data = bytes(range(256)) * 2
+    assert format.readAttachment(reader(data), len(data), str(tmp_path)) == (data, None)
+    assert max(reads) == 100
+
+    # Large attachments are spooled to the given directory
+    data = bytes(range(256)) * 10
+    content, spool_path = format.readAttachment(reader(data), len(data), str(tmp_path))
+    assert content is None
+    assert os.path.dirname(spool_path) == str(tmp_path)
+    attachment = Attachment(FilePath=spool_path)
+    assert attachment.size == len(data)
+    assert attachment.read() == data
+    with attachment.open() as f:
+        assert f.read() == data
+    attachment.cleanup()
+    assert attachment.FilePath is None
+    assert os.listdir(str(tmp_path)) == []
+
+    # Attachments in memory work the same way
+    attachment = Attachment(File=b"in memory")
+    assert attachment.size == 9
+    with attachment.open() as f:
+        assert f.read() == b"in memory"
+    attachment.cleanup()
+    assert attachment.read() == b"in memory"
+
+    # Spool files are removed if reading fails
+    read_buffer = reader(data)
+
+    def failing_read(size):
+        chunk = read_buffer(size)
+        if not chunk:
+            raise IOError("Unable to read attachment")
+        return chunk
+
+    with pytest.raises(IOError):
+        format.readAttachment(failing_read, 5000, str(tmp_path))
+    assert os.listdir(str(tmp_path)) == []
+
+
+class FakeEntry:
+    def __init__(self, entry_type, value):
+        self.entry_type = entry_type
+        self.data = value.encode("utf-8")
+        self.value = value
+
+    def get_data_as_string(self):
+        return self.value
+
+
+class FakeRecordSet:
+    def __init__(self, entries):
+        self.entries = entries
+
+
+class FakePSTAttachment:
+    def __init__(self, name, data):
+        self.data = io.BytesIO(data)
+        self.size = len(data)
+        self.record_sets = [FakeRecordSet([FakeEntry(0x3707, name), FakeEntry(0x370E, "application/octet-stream")])]
+
+    def get_size(self):
+        return self.size
+
+    def read_buffer(self, size):
+        return self.data.read(size)
+
+
+class FakePSTMessage:
+    transport_headers = "Message-ID: <fake@example.com>\nSubject: Attachments\n"
+    record_sets = []
+    html_body = None
+    rtf_body = None
+    plain_text_body = b"Body"
+
+    def __init__(self, attachments):
+        self.attachments = attachments
+
+
+class FakePSTFolder:
+    def __init__(self, messages):
+        self.messages = messages
+
+    def get_sub_message(self, index):
+        return self.messages[index]
+
+
+def test_PST_spooled_attachments(tmp_path, monkeypatch):
+    if not "pst" in EmailAccount.registry:
+        raise pytest.skip("PST not installed, cannot test")
+    parse_message = sys.modules[EmailAccount.registry["pst"].__module__].parse_message
+    monkeypatch.setattr(format, "ATTACHMENT_SPOOL_SIZE", 10)
+
+    def fake_folder():
+        return FakePSTFolder([FakePSTMessage([FakePSTAttachment("small.txt", b"small"), FakePSTAttachment("large.bin", b"x" * 100)])])
+
+    message = parse_message(fake_folder(), 0, "Inbox", "fake.pst", spool_dir=str(tmp_path))
+    assert [attachment.Name for attachment in message.Attachments] == ["small.txt", "large.bin"]
+    assert message.Attachments[0].File == b"small"
+    assert os.path.dirname(message.Attachments[1].FilePath) == str(tmp_path)
+    assert message.Attachments[1].read() == b"x" * 100
+    message.Attachments[1].cleanup()
+
+    # If parsing fails after attachments are spooled, their files are removed
+    def failing_parse_header(header, errors):
+        raise ValueError("Unable to parse header")
+
+    monkeypatch.setattr(format, "parse_header", failing_parse_header)
+    message = parse_message(fake_folder(), 0, "Inbox", "fake.pst", spool_dir=str(tmp_path))
+    assert message.Attachments == []
+    assert [error.Level for error in message.Errors] == ["error"]
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize("keep", [False, True])
+def test_FileMover(tmp_path, keep):
+    source = tmp_path / "source"
+    for name in ["1.eml", "a/b/2.eml", "a/b/notes.txt", "a/c/3.eml", "a/c/d/4.eml"]:
+        (source / name).parent.mkdir(parents=True, exist_ok=True)
+        (source / name).write_bytes(b"Subject: " + name.encode() + b"\n\nBody\n")
+    # The source is given through a symlink, which relative paths should not resolve
+    os.symlink(str(source), str(tmp_path / "link"))
+    link = str(tmp_path / "link")
+    mailbag_dir = os.path.join(link, "bag")
+
+    mover = format.FileMover(False, keep, link, mailbag_dir, "bag", "eml", "copy")
+    for name in ["1.eml", "a/b/2.eml", "a/c/3.eml", "a/c/d/4.eml"]:
+        new_path, errors = mover.move(os.path.join(link, name), [])
+        assert new_path == os.path.join(mailbag_dir, "data", "eml", os.path.normpath(name))
+        assert errors == []
+    mover.prune()
+
+    for name in ["1.eml", "a/b/2.eml", "a/c/3.eml", "a/c/d/4.eml"]:
+        assert (source / "bag" / "data" / "eml" / name).read_bytes() == b"Subject: " + name.encode() + b"\n\nBody\n"
+        assert (source / name).exists() == keep
+    # Directories that still have files are kept, and only emptied directories are removed without --keep
+    assert (source / "a" / "b" / "notes.txt").exists()
+    assert (source / "a" / "c").exists() == keep
+    assert (source / "a" / "c" / "d").exists() == keep
+    assert sorted(os.listdir(str(source))) == (["1.eml", "a", "bag"] if keep else ["a", "bag"])